@@ -36,10 +36,16 @@ Implements
 """
 
 from domogik.xpl.common.xplmessage import XplMessage
+from domogik.xpl.common.xplconnector import Listener
 from domogik.xpl.common.plugin import XplPlugin
 
 from domogik_packages.plugin_rfxcom.lib.rfxcom import Rfxcom
+from domogik_packages.plugin_rfxcom.lib.rfxcom import ReceiverMerger
 from domogik_packages.plugin_rfxcom.lib.rfxcom import RfxcomException
+from domogik_packages.plugin_rfxcom.lib.rfxcom import STATS_PERIOD
+from domogik_packages.plugin_rfxcom.lib.rfxcom import MERGE_WINDOW
+from domogik_packages.plugin_rfxcom.lib.capture import CaptureWriter
+import logging
 import threading
 import traceback
 
@@ -63,12 +69,96 @@ class RfxcomManager(XplPlugin):
         # so we don't stop the plugin if no devices are created
         self.devices = self.get_device_list(quit_if_no_device = False)
 
-        # get the rfxcom device address in the filesystem
-        self.rfxcom_device = self.get_config("rfxcom_device")
-        self.rfxcom_manager = Rfxcom(self.log, self.send_xpl, self.get_stop(), self.rfxcom_device, self.device_detected, self.send_xpl, self.register_thread, self.options.test_option)
+        # get the rfxcom devices addresses in the filesystem : the first one also sends the commands, the
+        # others are only used as additional receivers
+        self.rfxcom_devices = [device.strip() for device in (self.get_config("rfxcom_device") or "").split(",") if device.strip() != ""]
+        self.rfxcom_device = self.rfxcom_devices[0] if len(self.rfxcom_devices) > 0 else None
+        merge_readings = self.get_config("merge_readings")
+        detection_refresh = self.get_config("detection_refresh")
+        deadbands = {}
+        for kind in ("temperature", "humidity", "battery", "rssi"):
+            deadband = self.get_config("{0}_deadband".format(kind))
+            if deadband not in (None, ""):
+                deadbands[kind] = float(deadband)
+        heartbeat = self.get_config("heartbeat")
+        duplicate_window = self.get_config("duplicate_window")
+        packet_trace = self.get_config("packet_trace")
+        transmit_window = self.get_config("transmit_window")
+        transmit_queue_size = self.get_config("transmit_queue_size")
+        transmit_pacing = self.get_config("transmit_pacing")
+        receive_protocols = [name.strip().lower() for name in (self.get_config("receive_protocols") or "").split(",") if name.strip() != ""]
+        stats_period = self.get_config("stats_period")
+        if stats_period in (None, ""):
+            stats_period = STATS_PERIOD
+        transport = self.get_config("transport")
+        if transport in (None, "", "auto"):
+            transport = None
+        replay_speed = self.get_config("replay_speed")
+        if replay_speed in (None, ""):
+            replay_speed = 1
+        capture_file = self.get_config("capture_file")
+        capture_max_size = self.get_config("capture_max_size")
+        capture = None
+        if capture_file not in (None, ""):
+            try:
+                capture = CaptureWriter(capture_file, int(capture_max_size or 10) * 1024 * 1024)
+                self.log.info("The received packets are captured in {0}".format(capture_file))
+            except IOError:
+                self.log.error("Unable to open the capture file {0} : no capture. Error : {1}".format(capture_file, traceback.format_exc()))
+        merge_window = self.get_config("merge_window")
+        if merge_window in (None, ""):
+            merge_window = MERGE_WINDOW
+
+        # xPL messages reused for each send, by schema. They are shared by the readers of all the receivers and
+        # the merger : a message is filled and sent under the lock
+        self._xpl_messages = {}
+        self._xpl_lock = threading.Lock()
+
+        rfxcom_options = {"cb_send_xpl_batch" : self.send_xpl_batch,
+                          "merge_readings" : merge_readings == True,
+                          "detection_refresh" : int(detection_refresh or 0),
+                          "deadbands" : deadbands,
+                          "heartbeat" : int(heartbeat or 0),
+                          "duplicate_window" : float(duplicate_window or 0),
+                          "packet_trace" : packet_trace == True,
+                          "tx_window" : int(transmit_window or 1),
+                          "tx_queue_size" : int(transmit_queue_size or 100),
+                          "tx_pacing" : transmit_pacing != False,
+                          "receive_protocols" : receive_protocols,
+                          "stats_period" : int(stats_period),
+                          "transport" : transport,
+                          "replay_speed" : float(replay_speed),
+                          "capture" : capture}
+        self.rfxcom_manager = Rfxcom(self.log, self.send_xpl, self.get_stop(), self.rfxcom_device, self.device_detected, self.send_xpl, self.register_thread, self.options.test_option,
+                                     **rfxcom_options)
+        # additional receivers : they only receive (no write thread), the commands are sent by the first RFXCOM
+        self.receivers = [Rfxcom(self.log, self.send_xpl, self.get_stop(), device, self.device_detected, self.send_xpl, self.register_thread,
+                                 receiver_id = idx + 1, receive_only = True, **rfxcom_options) for (idx, device) in enumerate(self.rfxcom_devices[1:])]
+
+        # the devices already created don't need to be detected again
+        for a_device in self.devices:
+            for rfxcom in [self.rfxcom_manager] + self.receivers:
+                rfxcom.add_known_device(a_device["device_type_id"], self.get_parameter(a_device, "device"))
 
         # create listeners for commands send over xPL
-        # TODO
+        self._scene_encoders = {"x10.basic" : self.x10_basic_packet,
+                                "x10.security" : self.x10_security_packet,
+                                "ac.basic" : self.ac_basic_packet}
+        Listener(self.process_x10_basic, self.myxpl,
+                 {'schema': 'x10.basic',
+                  'xpltype': 'xpl-cmnd'})
+        Listener(self.process_x10_security, self.myxpl,
+                 {'schema': 'x10.security',
+                  'xpltype': 'xpl-cmnd'})
+        Listener(self.process_ac_basic, self.myxpl,
+                 {'schema': 'ac.basic',
+                  'xpltype': 'xpl-cmnd'})
+        Listener(self.process_scene, self.myxpl,
+                 {'schema': 'rfxcom.scene',
+                  'xpltype': 'xpl-cmnd'})
+        Listener(self.process_trace, self.myxpl,
+                 {'schema': 'rfxcom.trace',
+                  'xpltype': 'xpl-cmnd'})
 
         # Open the RFXCOM device
         try:
@@ -78,15 +168,40 @@ class RfxcomManager(XplPlugin):
             print(e.value)
             self.force_leave()
             return
-            
-        # Start reading RFXCOM
-        rfxcom_process = threading.Thread(None,
-                                   self.rfxcom_manager.listen,
-                                   "rfxcom-process-reader",
-                                   (self.get_stop(),),
-                                   {})
-        self.register_thread(rfxcom_process)
-        rfxcom_process.start()
+
+        # Open the additional receivers : a receiver which can't be opened is not used
+        receivers = []
+        for rfxcom in self.receivers:
+            try:
+                rfxcom.open()
+                receivers.append(rfxcom)
+            except RfxcomException as e:
+                self.log.error("The receiver {0} won't be used : {1}".format(rfxcom.rfxcom_device, e.value))
+        self.receivers = receivers
+
+        # With several receivers, the copies of a packet are merged by a single thread
+        if len(self.receivers) > 0:
+            merger = ReceiverMerger(self.rfxcom_manager, float(merge_window), int(stats_period))
+            for rfxcom in [self.rfxcom_manager] + self.receivers:
+                merger.add_receiver(rfxcom.rfxcom_device)
+                rfxcom.merger = merger
+            merger_process = threading.Thread(None,
+                                              merger.run,
+                                              "rfxcom-process-merger",
+                                              (self.get_stop(),),
+                                              {})
+            self.register_thread(merger_process)
+            merger_process.start()
+
+        # Start reading RFXCOM (one reader by receiver)
+        for (idx, rfxcom) in enumerate([self.rfxcom_manager] + self.receivers):
+            rfxcom_process = threading.Thread(None,
+                                       rfxcom.listen,
+                                       "rfxcom-process-reader" if idx == 0 else "rfxcom-process-reader-{0}".format(idx),
+                                       (self.get_stop(),),
+                                       {})
+            self.register_thread(rfxcom_process)
+            rfxcom_process.start()
 
         self.ready()
 
@@ -95,11 +210,13 @@ class RfxcomManager(XplPlugin):
         """ Send xPL message on network
         """
         if message != None:
-            self.log.debug("send_xpl : send full message : {0}".format(message))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("send_xpl : send full message : {0}".format(message))
             self.myxpl.send(message)
 
         else:
-            self.log.debug("send_xpl : Send xPL message xpl-trig : schema:{0}, data:{1}".format(schema, data))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("send_xpl : Send xPL message xpl-trig : schema:{0}, data:{1}".format(schema, data))
             msg = XplMessage()
             msg.set_type("xpl-trig")
             msg.set_schema(schema)
@@ -108,6 +225,152 @@ class RfxcomManager(XplPlugin):
             self.myxpl.send(msg)
 
 
+    def send_xpl_batch(self, messages):
+        """ Send all the xPL messages built from a packet
+            The xPL message objects are created once per schema and reused. This is called by several threads
+            (readers, merger) : a message is filled and sent under self._xpl_lock
+            @param messages : list of (schema, data)
+        """
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        for (schema, data) in messages:
+            if debug:
+                self.log.debug("send_xpl_batch : Send xPL message xpl-trig : schema:{0}, data:{1}".format(schema, data))
+            with self._xpl_lock:
+                msg = self._xpl_messages.get(schema)
+                if msg == None:
+                    msg = XplMessage()
+                    msg.set_type("xpl-trig")
+                    msg.set_schema(schema)
+                    self._xpl_messages[schema] = msg
+                else:
+                    msg.clear_data()
+                msg.add_data(data)
+                self.myxpl.send(msg)
+
+
+    # lighting1, lighting3, curtain1
+    def process_x10_basic(self, message):
+        """ Process command xpl message and call the librairy for processing command
+            @param message : xpl message
+        """
+        self.process_command(message, self.x10_basic_packet)
+
+
+    # security1
+    def process_x10_security(self, message):
+        """ Process command xpl message and call the librairy for processing command
+            @param message : xpl message
+        """
+        self.process_command(message, self.x10_security_packet)
+
+
+    # lighting2
+    def process_ac_basic(self, message):
+        """ Process command xpl message and call the librairy for processing command
+            @param message : xpl message
+        """
+        self.process_command(message, self.ac_basic_packet)
+
+
+    def process_command(self, message, encode):
+        """ Send the command of a xpl message
+            @param message : xpl message
+            @param encode : function which builds the command packet from the message keys
+        """
+        # Prepare xpl-trig to send if success
+        trig_msg = message
+        trig_msg.set_type("xpl-trig")
+
+        try:
+            self.rfxcom_manager.queue_packet(encode(message.data), trig_msg)
+        except RfxcomException as e:
+            self.log.error("Bad {0} command : {1}".format(message.schema, e.value))
+        except (KeyError, ValueError):
+            self.log.error("Bad {0} command : {1}".format(message.schema, traceback.format_exc()))
+
+
+    def process_scene(self, message):
+        """ Send the commands of a scene in one batch
+            xpl-cmnd rfxcom.scene message : scene=<name>, c01=<schema>:<key>=<value>,<key>=<value>..., c02=...
+            The commands are sent in the order of their number. The end of the scene is reported by a
+            xpl-trig rfxcom.scene message
+            @param message : xpl message
+        """
+        name = message.data.get("scene", "")
+        keys = sorted([key for key in message.data if key[0:1] == "c" and key[1:].isdigit()], key = lambda key : int(key[1:]))
+        packets = []
+        try:
+            for key in keys:
+                (schema, fields) = message.data[key].split(":", 1)
+                data = dict(item.split("=", 1) for item in fields.split(","))
+                packets.append(self._scene_encoders[schema](data))
+        except RfxcomException as e:
+            self.log.error("Bad command in the scene '{0}' : {1}".format(name, e.value))
+            return
+        except (KeyError, ValueError):
+            self.log.error("Bad command in the scene '{0}' : {1}".format(name, traceback.format_exc()))
+            return
+        self.rfxcom_manager.send_scene(name, packets)
+
+
+    def x10_basic_packet(self, data):
+        """ Build the command packet of a x10.basic message
+            @param data : keys of the message
+        """
+        address = data["device"].lower()
+        command = data["command"].lower()
+        level = data.get("level", 0)
+        protocol = data.get("protocol", "x10").lower()
+        if protocol == "koppla":
+            return self.rfxcom_manager.encode_12(address, command, level)
+        elif protocol == "harrison":
+            return self.rfxcom_manager.encode_18(address, command)
+        else:
+            return self.rfxcom_manager.encode_10(address, command, protocol)
+
+
+    def x10_security_packet(self, data):
+        """ Build the command packet of a x10.security message
+            @param data : keys of the message
+        """
+        address = data["device"].lower()
+        command = data["command"].lower()
+        delay = data.get("delay", "").lower()
+        return self.rfxcom_manager.encode_20(address, command, delay)
+
+
+    def ac_basic_packet(self, data):
+        """ Build the command packet of a ac.basic message
+            @param data : keys of the message
+        """
+        address = data["address"].lower()
+        unit = data["unit"]
+        if unit.lower() == "group":
+            unit = 0
+            group = True
+        else:
+            unit = int(unit)
+            group = False
+        command = data["command"].lower()
+        if command == "preset":
+            level = int(data["level"])
+        else:
+            level = 0
+        eu = data.get("eu", "false").lower() == "true"
+        return self.rfxcom_manager.encode_11(address, unit, command, level, eu, group)
+
+
+    def process_trace(self, message):
+        """ Switch the packet trace on or off
+            @param message : xpl-cmnd rfxcom.trace message with trace=on|off
+        """
+        trace = message.data.get("trace", "")
+        if trace in ("on", "off"):
+            self.rfxcom_manager.set_packet_trace(trace == "on")
+        else:
+            self.log.warning("Bad value for the trace key of the rfxcom.trace message : '{0}' (expected on or off)".format(trace))
+
+
 
 if __name__ == "__main__":
     RfxcomManager()
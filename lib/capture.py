@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Plugin purpose
+==============
+
+Capture of the raw packets received from the RFXCOM in a binary file, to replay them later (see ReplayTransport)
+
+Implements
+==========
+
+- CaptureWriter
+- read_capture
+
+@author: Fritz <fritz.smh@gmail.com>
+@copyright: (C) 2007-2013 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import os
+import struct
+import threading
+import time
+
+# monotonic clock (not available in python 2)
+monotonic = getattr(time, "monotonic", time.time)
+
+# Capture file format
+# header : magic, wall clock time and monotonic time when the capture session was started. A header is written at
+# the start of the file and at the start of each capture session appended to it (plugin restart)
+# then one record by packet : monotonic time when the packet was received, receiver id, and the packet with
+# its length byte
+CAPTURE_MAGIC = b"RFXCAP1\n"
+STRUCT_CAPTURE_HEADER = struct.Struct(">8sdd")
+STRUCT_CAPTURE_RECORD = struct.Struct(">dB")
+
+# write buffer size of the capture file (bytes) and max delay before the buffered records are written, even when
+# no other packet is received (seconds)
+CAPTURE_BUFFER_SIZE = 65536
+CAPTURE_FLUSH_PERIOD = 1
+
+# number of full capture files kept : <file>.1 (the most recent) to <file>.<CAPTURE_BACKUPS>
+CAPTURE_BACKUPS = 5
+
+
+class CaptureWriter:
+    """ Append the received packets to a capture file
+        The records are buffered and written at most CAPTURE_FLUSH_PERIOD seconds after they are received (by a
+        timer, so that the last packets are not lost if no other packet comes). When the file is bigger than
+        max_size, it is renamed <file>.1 (the previous ones are shifted up to <file>.<CAPTURE_BACKUPS>) and a new
+        file is started. The readers of several receivers can share a writer.
+    """
+
+    def __init__(self, path, max_size = 10 * 1024 * 1024):
+        """ @param path : capture file. If it exists, a new capture session is appended to it (see read_capture)
+            @param max_size : size of the file which triggers the rotation (bytes)
+        """
+        self.path = path
+        self.max_size = max_size
+        self.records = 0
+        self._lock = threading.Lock()
+        self._file = None
+        # timer which writes the buffered records
+        self._timer = None
+        self._open()
+
+    def _open(self):
+        """ Open the capture file and write the header of the capture session
+        """
+        self._file = open(self.path, "ab", CAPTURE_BUFFER_SIZE)
+        self._size = os.fstat(self._file.fileno()).st_size + STRUCT_CAPTURE_HEADER.size
+        self._file.write(STRUCT_CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time(), monotonic()))
+        self._file.flush()
+
+    def _rotate(self):
+        """ Keep the full file as <file>.1 and start a new one
+        """
+        self._file.close()
+        for idx in range(CAPTURE_BACKUPS - 1, 0, -1):
+            backup = "{0}.{1}".format(self.path, idx)
+            if os.path.exists(backup):
+                os.rename(backup, "{0}.{1}".format(self.path, idx + 1))
+        os.rename(self.path, self.path + ".1")
+        self._open()
+
+    def write(self, receiver, packet):
+        """ Append a packet
+            @param receiver : receiver id (0 to 255)
+            @param packet : packet (without the length byte) as a bytearray
+        """
+        now = monotonic()
+        record = STRUCT_CAPTURE_RECORD.pack(now, receiver) + bytes(bytearray([len(packet)])) + bytes(packet)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(record)
+            self._size += len(record)
+            self.records += 1
+            if self._size >= self.max_size:
+                self._rotate()
+            elif self._timer is None:
+                self._timer = threading.Timer(CAPTURE_FLUSH_PERIOD, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _cancel_timer(self):
+        """ Cancel the pending flush (the lock must be held)
+        """
+        if self._timer != None:
+            self._timer.cancel()
+            self._timer = None
+
+    def flush(self):
+        """ Write the buffered records
+        """
+        with self._lock:
+            self._cancel_timer()
+            if self._file != None:
+                self._file.flush()
+
+    def close(self):
+        """ Write the buffered records and close the file. The packets written after are not captured
+        """
+        with self._lock:
+            self._cancel_timer()
+            if self._file != None:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(path):
+    """ Read the records of a capture file. A truncated last record (capture interrupted) is ignored
+        The monotonic times of each capture session are only meaningful within the session : the times of a session
+        are shifted so that it starts at the last record of the previous one (the time between the sessions, when
+        nothing was captured, is not kept)
+        @param path : capture file
+        @return : generator of (monotonic time, receiver id, packet with its length byte)
+    """
+    with open(path, "rb") as capture:
+        header = capture.read(STRUCT_CAPTURE_HEADER.size)
+        if len(header) < STRUCT_CAPTURE_HEADER.size or STRUCT_CAPTURE_HEADER.unpack(header)[0] != CAPTURE_MAGIC:
+            raise IOError("{0} is not a RFXCOM capture file".format(path))
+        # time of the last record and shift of the times of the current session
+        last = STRUCT_CAPTURE_HEADER.unpack(header)[2]
+        shift = 0
+        while True:
+            record = capture.read(STRUCT_CAPTURE_RECORD.size + 1)
+            if len(record) < STRUCT_CAPTURE_RECORD.size + 1:
+                return
+            if record[0:len(CAPTURE_MAGIC)] == CAPTURE_MAGIC:
+                # header of an appended session
+                header = record + capture.read(STRUCT_CAPTURE_HEADER.size - len(record))
+                if len(header) < STRUCT_CAPTURE_HEADER.size:
+                    return
+                shift = last - STRUCT_CAPTURE_HEADER.unpack(header)[2]
+                continue
+            (timestamp, receiver) = STRUCT_CAPTURE_RECORD.unpack_from(record)
+            timestamp += shift
+            last = timestamp
+            length = bytearray(record[-1:])[0]
+            packet = capture.read(length)
+            if len(packet) < length:
+                return
+            yield (timestamp, receiver, record[-1:] + packet)
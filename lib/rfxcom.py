@@ -36,75 +36,316 @@ Implements
 """
 
 import binascii
+import errno
+import logging
+import os
+import random
+import struct
 import traceback
 import threading
 import time
-from Queue import Queue, Empty, Full
+from collections import deque
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    # python 3
+    from queue import Queue, Empty, Full
 import serial as serial
-import domogik.tests.common.testserial as testserial
+from domogik_packages.plugin_rfxcom.lib.transport import open_transport
 
+# transmit : a NAKed command or a command which is not acknowledged after ACK_TIMEOUT seconds is sent again
+# after a delay which doubles at each try (from WAIT_BETWEEN_TRIES to WAIT_BETWEEN_TRIES_MAX seconds, with jitter).
+# A command is sent at most TRANSMIT_TRIES times and is given up if it is not acknowledged COMMAND_DEADLINE
+# seconds after being queued
 WAIT_BETWEEN_TRIES = 1
+WAIT_BETWEEN_TRIES_MAX = 8
+ACK_TIMEOUT = 5
+TRANSMIT_TRIES = 3
+COMMAND_DEADLINE = 30
+
+# startup handshake (see Rfxcom.open) : wait after the reset (SDK : at least 50 ms), delay between two get status
+# messages and deadline to get the status message (seconds)
+HANDSHAKE_RESET_WAIT = 0.05
+HANDSHAKE_STATUS_INTERVAL = 0.2
+HANDSHAKE_DEADLINE = 10
+
+# serial read timeout while waiting for a dedicated message (see Rfxcom.wait_for), so the deadline is checked often
+WAIT_FOR_READ_TIMEOUT = 0.05
+
+# transmit priorities : the queued commands of a lower class are sent first
+PRIORITY_SECURITY = 0
+PRIORITY_SWITCHING = 1
+PRIORITY_DIMMING = 2
+PRIORITY_BULK = 3
+PRIORITIES = (PRIORITY_SECURITY, PRIORITY_SWITCHING, PRIORITY_DIMMING, PRIORITY_BULK)
+
+# default size of the transmit queue (commands not yet sent)
+TRANSMIT_QUEUE_SIZE = 100
+
+# estimated airtime (seconds) of a command by packet type : time during which the transmitter is busy, repeats
+# included. These are rough estimates used to pace the commands (see TransmitPacer)
+PACKET_AIRTIME = {
+  0x10 : 0.2,   # Lighting1
+  0x11 : 0.3,   # Lighting2
+  0x12 : 0.2,   # Lighting3
+  0x13 : 0.2,   # Lighting4
+  0x14 : 0.2,   # Lighting5
+  0x15 : 0.2,   # Lighting6
+  0x16 : 0.2,   # Chime
+  0x18 : 0.2,   # Curtain1
+  0x19 : 0.2,   # Blinds1
+  0x1A : 0.4,   # RFY
+  0x20 : 0.2,   # Security1
+}
+AIRTIME_DEFAULT = 0.2
+
+# max duty cycle of the transmitter by receiver/transceiver type (ETSI EN 300 220 : 10% at 433.92MHz, 1% in the
+# 868.0-868.6MHz band, 0.1% in the 868.7-869.2MHz band). The duty cycle is measured over DUTY_CYCLE_PERIOD seconds
+# The other types have no duty cycle limit
+DUTY_CYCLES = {
+  0x53 : 0.1,
+  0x55 : 0.01,
+  0x56 : 0.01,
+  0x57 : 0.01,
+  0x58 : 0.01,
+  0x59 : 0.01,
+  0x5A : 0.01,
+  0x5B : 0.001,
+}
+DUTY_CYCLE_PERIOD = 3600
+
+# sensor.basic types and the kind of sensor whose deadband applies to them
+DEADBAND_KINDS = {
+  "temp" : "temperature",
+  "humidity" : "humidity",
+  "status" : "humidity",
+  "battery" : "battery",
+  "rssi" : "rssi",
+}
+
+# monotonic clock (not available in python 2)
+monotonic = getattr(time, "monotonic", time.time)
+
+# the min length of a valid message is for :
+# 0x02: Receiver/Transmitter Message
+# it is 4
+MIN_PACKET_LENGTH = 4
+# the max length of a valid message is for :
+# 0x03: Undecoded RF Message
+# it is 36
+MAX_PACKET_LENGTH = 37
+
+# once this amount of bytes has been consumed at the head of the receive buffer, the buffer is compacted
+RX_BUFFER_COMPACT_SIZE = 4096
 
 RECEIVER_TRANSCEIVER = {
-  "0x50" : "310MHz",
-  "0x51" : "315MHz",
-  "0x52" : "433.92MHz receiver only",
-  "0x53" : "433.92MHz transceiver",
-  "0x55" : "868.00MHz",
-  "0x56" : "868.00MHz FSK",
-  "0x57" : "868.30MHz",
-  "0x58" : "868.30MHz FSK",
-  "0x59" : "868.35MHz",
-  "0x5A" : "868.35MHz FSK",
-  "0x5B" : "868.95MHz",
+  0x50 : "310MHz",
+  0x51 : "315MHz",
+  0x52 : "433.92MHz receiver only",
+  0x53 : "433.92MHz transceiver",
+  0x55 : "868.00MHz",
+  0x56 : "868.00MHz FSK",
+  0x57 : "868.30MHz",
+  0x58 : "868.30MHz FSK",
+  0x59 : "868.35MHz",
+  0x5A : "868.35MHz FSK",
+  0x5B : "868.95MHz",
 }
 
 TYPE_20_MODELS = {
-  "0x00" : "X10 security door/window sensor",
-  "0x01" : "X10 security motion sensor",
-  "0x02" : "X10 security remote (no alive packets)",
-  "0x03" : "KD101 (no alive packets)",
-  "0x04" : "Visonic PowerCode door/window sensor – primary contact (with alive packets)",
-  "0x05" : "Visonic PowerCode motion sensor (with alive packets)",
-  "0x06" : "Visonic CodeSecure (no alive packets)",
-  "0x07" : "Visonic PowerCode door/window sensor – auxiliary contact (no alive packets)",
-  "0x08" : "Meiantech",
-  "0x09" : "SA30 (no alive packets)"
+  0x00 : "X10 security door/window sensor",
+  0x01 : "X10 security motion sensor",
+  0x02 : "X10 security remote (no alive packets)",
+  0x03 : "KD101 (no alive packets)",
+  0x04 : "Visonic PowerCode door/window sensor – primary contact (with alive packets)",
+  0x05 : "Visonic PowerCode motion sensor (with alive packets)",
+  0x06 : "Visonic CodeSecure (no alive packets)",
+  0x07 : "Visonic PowerCode door/window sensor – auxiliary contact (no alive packets)",
+  0x08 : "Meiantech",
+  0x09 : "SA30 (no alive packets)"
 }
 
 TYPE_50_MODELS = {
-  "0x01" : "THR128/138, THC138",
-  "0x02" : "THC238/268,THN132,THWR288,THRN122,THN122,AW129/131",
-  "0x03" : "THWR800",
-  "0x04" : "RTHN318",
-  "0x05" : "La Crosse TX2, TX3, TX4, TX17",
-  "0x06" : "TS15C",
-  "0x07" : "Viking 02811",
-  "0x08" : "La Crosse WS2300",
-  "0x09" : "RUBiCSON",
-  "0x0A" : "TFA 30.3133"
+  0x01 : "THR128/138, THC138",
+  0x02 : "THC238/268,THN132,THWR288,THRN122,THN122,AW129/131",
+  0x03 : "THWR800",
+  0x04 : "RTHN318",
+  0x05 : "La Crosse TX2, TX3, TX4, TX17",
+  0x06 : "TS15C",
+  0x07 : "Viking 02811",
+  0x08 : "La Crosse WS2300",
+  0x09 : "RUBiCSON",
+  0x0A : "TFA 30.3133"
 }
 
 TYPE_52_HUMIDITY_STATUS = {
-  "0x00" : "dry",
-  "0x01" : "comfort",
-  "0x02" : "normal",
-  "0x03" : "wet",
+  0x00 : "dry",
+  0x01 : "comfort",
+  0x02 : "normal",
+  0x03 : "wet",
 }
 
 TYPE_52_MODELS = {
-  "0x01" : "THGN122/123, THGN132, THGR122/228/238/268",
-  "0x02" : "THGR810, THGN800, THGR810",
-  "0x03" : "RTGR328",
-  "0x04" : "THGR328",
-  "0x05" : "WTGR800",
-  "0x06" : "THGR918/928, THGRN228, THGN500",
-  "0x07" : "TFA TS34C, Cresta",
-  "0x08" : "WT260,WT260H,WT440H,WT450,WT450H",
-  "0x09" : "Viking 02035,02038 (02035 has no humidity)",
-  "0x0A" : "Rubicson",
+  0x01 : "THGN122/123, THGN132, THGR122/228/238/268",
+  0x02 : "THGR810, THGN800, THGR810",
+  0x03 : "RTGR328",
+  0x04 : "THGR328",
+  0x05 : "WTGR800",
+  0x06 : "THGR918/928, THGRN228, THGN500",
+  0x07 : "TFA TS34C, Cresta",
+  0x08 : "WT260,WT260H,WT440H,WT450,WT450H",
+  0x09 : "Viking 02035,02038 (02035 has no humidity)",
+  0x0A : "Rubicson",
+}
+
+# binary layout of the status packet (the length byte is not included)
+# type, subtype, seqnbr, cmnd, msg1 ... msg9
+STRUCT_STATUS = struct.Struct(">BBBB9B")
+
+# interface commands (with their length byte)
+RESET_MESSAGE = binascii.unhexlify("0D00000000000000000000000000")
+GET_STATUS_MESSAGE = binascii.unhexlify("0D00000102000000000000000000")
+SET_MODE_COMMAND = 0x03
+
+# receiver protocols : name => (byte of the status and set mode messages (msg3, msg4 or msg5), bit)
+RECEIVE_PROTOCOLS = {
+  "undecoded" : (3, 7),
+  "rsl" : (3, 4),
+  "lighting4" : (3, 3),
+  "fineoffset" : (3, 2),
+  "rubicson" : (3, 1),
+  "blyss" : (3, 0),
+  "blindst1" : (4, 7),
+  "blindst0" : (4, 6),
+  "proguard" : (4, 5),
+  "fs20" : (4, 4),
+  "lacrosse" : (4, 3),
+  "hideki" : (4, 2),
+  "lightwaverf" : (4, 1),
+  "mertik" : (4, 0),
+  "visonic" : (5, 7),
+  "ati" : (5, 6),
+  "oregon" : (5, 5),
+  "meiantech" : (5, 4),
+  "homeeasy" : (5, 3),
+  "ac" : (5, 2),
+  "arc" : (5, 1),
+  "x10" : (5, 0),
+}
+
+# receiver protocol of each model (subtype) of the sensors handled by the plugin
+TYPE_50_PROTOCOLS = {
+  0x01 : "oregon",
+  0x02 : "oregon",
+  0x03 : "oregon",
+  0x04 : "oregon",
+  0x05 : "lacrosse",
+  0x06 : "hideki",
+  0x07 : "fineoffset",
+  0x08 : "lacrosse",
+  0x09 : "rubicson",
+  0x0A : "lacrosse",
+}
+
+TYPE_52_PROTOCOLS = {
+  0x01 : "oregon",
+  0x02 : "oregon",
+  0x03 : "oregon",
+  0x04 : "oregon",
+  0x05 : "oregon",
+  0x06 : "oregon",
+  0x07 : "hideki",
+  0x08 : "lacrosse",
+  0x09 : "fineoffset",
+  0x0A : "rubicson",
+}
+
+# the address of a security device doesn't tell its model : all the security protocols are needed
+SECURITY_PROTOCOLS = ("x10", "visonic", "meiantech")
+
+# max time to wait for the status message which confirms a set mode command (seconds)
+SET_MODE_TIMEOUT = 2
+
+# reconnection after a disconnection of the RFXCOM (see Rfxcom.reconnect) : delay before the first try to open
+# the device again, doubled after each failed try up to RECONNECT_DELAY_MAX (seconds)
+RECONNECT_DELAY = 0.5
+RECONNECT_DELAY_MAX = 10
+
+# with several receivers, the copies of a packet received by all of them within MERGE_WINDOW seconds are merged
+# (see ReceiverMerger)
+MERGE_WINDOW = 0.2
+
+# the receive rates and the cpu use are logged every STATS_PERIOD seconds (see Rfxcom.report_rates)
+STATS_PERIOD = 3600
+
+# valid lengths (value of the length byte) for each packet type (RFXtrx SDK)
+# a received packet of one of these types whose length doesn't match is considered as bad data. The packets of
+# the other types from MIN_RF_TYPE to MAX_RF_TYPE (protocols not handled here or newer than this table) are
+# accepted with any length between MIN_PACKET_LENGTH and MAX_PACKET_LENGTH. The other types are bad data
+MIN_RF_TYPE = 0x10
+MAX_RF_TYPE = 0x7F
+PACKET_LENGTHS = {
+  0x01 : (0x0D, 0x14),  # Interface Message (0x14 for the firmwares >= 1000)
+  0x02 : (0x04,),       # Receiver/Transmitter Message
+  0x03 : tuple(range(0x04, MAX_PACKET_LENGTH + 1)),  # Undecoded RF Message
+  0x10 : (0x07,),       # Lighting1
+  0x11 : (0x0B,),       # Lighting2
+  0x12 : (0x08,),       # Lighting3
+  0x13 : (0x09,),       # Lighting4
+  0x14 : (0x0A,),       # Lighting5
+  0x15 : (0x0B,),       # Lighting6
+  0x16 : (0x07,),       # Chime
+  0x18 : (0x07,),       # Curtain1
+  0x19 : (0x09,),       # Blinds1
+  0x1A : (0x0C,),       # RFY
+  0x20 : (0x08,),       # Security1
+  0x28 : (0x06,),       # Camera1
+  0x30 : (0x06,),       # Remote control and IR
+  0x40 : (0x09,),       # Thermostat1
+  0x41 : (0x06,),       # Thermostat2
+  0x42 : (0x08,),       # Thermostat3
+  0x4E : (0x0A,),       # Bbq temperature sensors
+  0x4F : (0x0A,),       # Temperature and rain sensors
+  0x50 : (0x08,),       # Temperature sensors
+  0x51 : (0x08,),       # Humidity sensors
+  0x52 : (0x0A,),       # Temperature and humidity sensors
+  0x53 : (0x09,),       # Barometric sensors
+  0x54 : (0x0D,),       # Temperature, humidity and barometric sensors
+  0x55 : (0x0B,),       # Rain sensors
+  0x56 : (0x10,),       # Wind sensors
+  0x57 : (0x09,),       # UV sensors
+  0x58 : (0x0D,),       # Date/time sensors
+  0x59 : (0x0D,),       # Current sensors
+  0x5A : (0x11,),       # Energy usage sensors
+  0x5B : (0x13,),       # Current + energy sensors
+  0x5C : (0x0F,),       # Power sensors
+  0x5D : (0x08,),       # Weighting scale
+  0x70 : (0x07,),       # RFXsensor
+  0x71 : (0x0A,),       # RFXmeter
+  0x72 : (0x09,),       # FS20
 }
 
+# valid subtypes for the packet types which are handled by the plugin
+# for the other types, all the subtypes are accepted
+PACKET_SUBTYPES = {
+  0x01 : (0x00, 0xFF),
+  0x02 : (0x00, 0x01),
+  0x20 : tuple(TYPE_20_MODELS),
+  0x50 : tuple(TYPE_50_MODELS),
+  0x52 : tuple(TYPE_52_MODELS),
+}
+
+
+# responses of the transmitter (type 0x02, subtype 0x01) : message => (status, retry, description)
+# retry : if False, sending the command again is useless
+TRANSMITTER_RESPONSES = {
+  0x00 : ("ACK", False, "ACK, transmit OK"),
+  0x01 : ("ACK", False, "ACK, but transmit started after 3 seconds delay anyway with RF receive data"),
+  0x02 : ("NACK", True, "NAK, transmitter did not lock on the requested transmit frequency"),
+  0x03 : ("NACK", False, "NAK, AC address zero in id1-id4 not allowed"),
+}
+
+
 class RfxcomException(Exception):
     """
     Rfxcom exception
@@ -118,11 +359,640 @@ class RfxcomException(Exception):
         return repr(self.value)
 
 
+# Packets layouts
+# Each field of a packet is described by : (name, offset, kind, scale, convert)
+# - offset : position of the field in the packet. The type is at offset 0 (the length byte is not included)
+# - kind : u8, u16, u24 : unsigned integer on 1, 2, 3 bytes
+#          sm16 : signed-magnitude integer on 2 bytes (the first bit is the sign)
+#          hi4, lo4 : high or low nibble of a byte
+# - scale : if set, the value is divided by it (and becomes a float)
+# - convert : if set, function applied on the value
+# The layouts are compiled on import in PACKET_DECODERS : for each type, a function which takes the packet and
+# returns a dict of the fields values
+
+def field(name, offset, kind, scale = None, convert = None):
+    """ Describe a field of a packet layout
+    """
+    return (name, offset, kind, scale, convert)
+
+def battery_level(value):
+    """ Battery level nibble (0 = 10%, 9 = 100%) to percent
+    """
+    return (value + 1) * 10
+
+def battery_level_x10(value):
+    """ Battery level nibble of the security packets to percent
+    """
+    return value * 10
+
+def rssi_level(value):
+    """ Rssi nibble (0 to 15) to percent
+    """
+    return value * 100 // 16
+
+PACKET_LAYOUTS = {
+  # Receiver/Transmitter Message
+  0x02 : [field("subtype", 1, "u8"),
+          field("seqnbr", 2, "u8"),
+          field("message", 3, "u8")],
+  # Security1
+  0x20 : [field("subtype", 1, "u8"),
+          field("seqnbr", 2, "u8"),
+          field("id", 3, "u24"),
+          field("status", 6, "u8"),
+          field("battery", 7, "hi4", convert = battery_level_x10),
+          field("rssi", 7, "lo4", convert = rssi_level)],
+  # Temperature sensors
+  0x50 : [field("subtype", 1, "u8"),
+          field("seqnbr", 2, "u8"),
+          field("id", 3, "u16"),
+          field("temperature", 5, "sm16", scale = 10),
+          field("rssi", 7, "hi4", convert = rssi_level),
+          field("battery", 7, "lo4", convert = battery_level)],
+  # Temperature and humidity sensors
+  0x52 : [field("subtype", 1, "u8"),
+          field("seqnbr", 2, "u8"),
+          field("id", 3, "u16"),
+          field("temperature", 5, "sm16", scale = 10),
+          field("humidity", 7, "u8"),
+          field("humidity_status", 8, "u8"),
+          field("rssi", 9, "hi4", convert = rssi_level),
+          field("battery", 9, "lo4", convert = battery_level)],
+}
+
+# struct format of each kind of field and python expression to get its value from the unpacked values <v>
+# {0} is the index of the field first value in <v>
+FIELD_KINDS = {
+  "u8" : ("B", "v[{0}]"),
+  "u16" : ("H", "v[{0}]"),
+  "u24" : ("BH", "(v[{0}] << 16 | v[{0} + 1])"),
+  "sm16" : ("H", "(- (v[{0}] & 0x7FFF) if v[{0}] & 0x8000 else v[{0}])"),
+  "hi4" : ("B", "(v[{0}] >> 4)"),
+  "lo4" : ("B", "(v[{0}] & 0x0F)"),
+}
+
+# for a scaled signed-magnitude field, the sign is applied after the scaling to keep -0.0
+SCALED_SM16 = "((- float(v[{0}] & 0x7FFF) if v[{0}] & 0x8000 else float(v[{0}])) / {1})"
+
+def compile_layout(layout):
+    """ Compile a packet layout in a decode function
+        The layout is turned in a struct format (to unpack all the fields at once) and in the source code of a
+        function which builds the dict of the fields values from the unpacked values.
+        @param layout : list of fields
+        @return : function which takes a packet (bytearray) and returns a dict of the fields values
+    """
+    fmt = ">"
+    pos = 0
+    nb_values = 0
+    slots = {}
+    namespace = {}
+    items = []
+    for (name, offset, kind, scale, convert) in sorted(layout, key = lambda a_field : a_field[1]):
+        (code, expression) = FIELD_KINDS[kind]
+        if (offset, code) not in slots:
+            if offset < pos:
+                raise RfxcomException("Overlapping field '{0}' in packet layout".format(name))
+            if offset > pos:
+                fmt += "{0}x".format(offset - pos)
+            slots[(offset, code)] = nb_values
+            nb_values += len(code)
+            fmt += code
+            pos = offset + struct.calcsize(">" + code)
+        idx = slots[(offset, code)]
+        if scale is not None and kind == "sm16":
+            expression = SCALED_SM16.format(idx, float(scale))
+        elif scale is not None:
+            expression = "(float({0}) / {1})".format(expression.format(idx), float(scale))
+        else:
+            expression = expression.format(idx)
+        if convert is not None:
+            namespace["convert_" + name] = convert
+            expression = "convert_{0}({1})".format(name, expression)
+        items.append("{0!r} : {1}".format(name, expression))
+    namespace["unpack_from"] = struct.Struct(fmt).unpack_from
+    source = "def decode(data):\n    v = unpack_from(data)\n    return {" + ", ".join(items) + "}\n"
+    exec(compile(source, "<packet layout>", "exec"), namespace)
+    return namespace["decode"]
+
+PACKET_DECODERS = dict((type, compile_layout(layout)) for (type, layout) in PACKET_LAYOUTS.items())
+
+def rssi_masks(layouts):
+    """ Find the rssi position in the packets layouts
+        @return : type => (offset, mask of the bits to keep to remove the rssi)
+    """
+    masks = {}
+    for (type, layout) in layouts.items():
+        for (name, offset, kind, scale, convert) in layout:
+            if name == "rssi":
+                masks[type] = (offset, 0x0F if kind == "hi4" else 0xF0)
+    return masks
+
+RSSI_MASKS = rssi_masks(PACKET_LAYOUTS)
+
+# priority class of the commands by packet type. The commands of the other types are PRIORITY_SWITCHING
+# and the commands which change a dim level are PRIORITY_DIMMING (see DIM_COMMANDS)
+PACKET_PRIORITIES = {
+  0x20 : PRIORITY_SECURITY,   # Security1
+}
+
+# offset of the command in the commands packets (the length byte is not included), by packet type. The bytes
+# between the seqnbr and the command are the address of the unit : the commands of a unit are sent in the order
+# they were queued (see TransmitScheduler)
+COMMAND_OFFSETS = {
+  0x10 : 5,   # Lighting1
+  0x11 : 8,   # Lighting2
+  0x12 : 6,   # Lighting3
+  0x14 : 7,   # Lighting5
+  0x18 : 5,   # Curtain1
+  0x20 : 6,   # Security1
+}
+
+# commands which change a dim level, by packet type : (relative commands, absolute commands)
+# The relative commands (dim, bright) are never merged as each of them is a step
+DIM_COMMANDS = {
+  0x10 : ((0x02, 0x03), ()),                          # Lighting1 : dim, bright
+  0x11 : ((), (0x02, 0x05)),                          # Lighting2 : set level, group set level
+  0x12 : ((0x00, 0x08), tuple(range(0x11, 0x1A))),   # Lighting3 : bright, dim, level 1 to 9
+  0x14 : ((), (0x10,)),                               # Lighting5 : set level
+}
+
+# commands which switch a unit on or off, by packet type
+# A queued absolute command (on, off or set level) is replaced by a newer absolute command for the same unit :
+# only the last state matters
+SWITCH_COMMANDS = {
+  0x10 : (0x00, 0x01),               # Lighting1 : off, on
+  0x11 : (0x00, 0x01, 0x03, 0x04),   # Lighting2 : off, on, group off, group on
+  0x12 : (0x10, 0x1A),               # Lighting3 : on, off
+  0x14 : (0x00, 0x01),               # Lighting5 : off, on
+}
+
+# commands sent to all the units of an address, by packet type. The unit is the last byte of the address
+# A group command is sent after the queued commands of the units of its address and before their newer commands
+GROUP_COMMANDS = {
+  0x10 : (0x05, 0x06),         # Lighting1 : all off, all on
+  0x11 : (0x03, 0x04, 0x05),   # Lighting2 : group off, group on, group set level
+}
+
+
+# commands tables : xPL protocol or command => subtype or command code in the packet
+LIGHTING1_PROTOCOLS = {
+  "x10" : 0x00,
+  "arc" : 0x01,
+  "elro" : 0x02,
+  "waveman" : 0x03,
+  "chacon" : 0x04,
+  "impuls" : 0x05,
+}
+
+LIGHTING1_COMMANDS = {
+  "off" : 0x00,
+  "on" : 0x01,
+  "dim" : 0x02,
+  "bright" : 0x03,
+  "all_lights_off" : 0x05,
+  "all_lights_on" : 0x06,
+  "chime" : 0x07,
+}
+
+LIGHTING2_COMMANDS = {
+  "off" : 0x00,
+  "on" : 0x01,
+  "lighting2_ac_off" : 0x00,  # dirty fix to handle domogik 0.2 / 0.3
+  "lighting2_ac_on" : 0x01,   # dirty fix to handle domogik 0.2 / 0.3
+  "preset" : 0x02,
+  "group_off" : 0x03,
+  "group_on" : 0x04,
+  "group_preset" : 0x05,
+}
+
+LIGHTING3_COMMANDS = {
+  "bright" : 0x00,
+  "dim" : 0x08,
+  "on" : 0x10,
+  "off" : 0x1A,
+  "program" : 0x1C,
+}
+
+CURTAIN1_COMMANDS = {
+  "open" : 0x00,
+  "on" : 0x00,              # open (for comp. with rfxcom lan xpl)
+  "close" : 0x01,
+  "off" : 0x01,             # close (for ....)
+  "stop" : 0x02,
+  "dim" : 0x02,             # stop (for ....)
+  "bright" : 0x02,          # stop
+  "program" : 0x03,
+  "all_lights_off" : 0x03,  # program (for ....)
+  "all_lights_on" : 0x03,   # program
+}
+
+SECURITY1_COMMANDS = {
+  "normal" : 0x00,
+  "normal-delayed" : 0x01,
+  "alarm" : 0x02,
+  "alarm-delayed" : 0x03,
+  "motion" : 0x04,
+  "motion-delayed" : 0x05,
+  "panic" : 0x06,
+  "end-panic" : 0x07,
+  "tamper" : 0x08,
+  "arm-away" : 0x09,
+  "arm-away-delayed" : 0x0A,
+  "arm-home" : 0x0B,
+  "arm-home-delayed" : 0x0C,
+  "disarm" : 0x0D,
+  "light1-off" : 0x10,      # not use by official x10.security
+  "light1-on" : 0x11,       # not use by official x10.security
+  # like for the RFXCOM Lan xPL, the lights-on|off command will only command the light1
+  "lights-off" : 0x10,
+  "lights-on" : 0x11,
+  "light2-off" : 0x12,      # not use by official x10.security
+  "light2-on" : 0x13,       # not use by official x10.security
+  "dark-detected" : 0x14,
+  "light-detected" : 0x15,
+  "battery-low" : 0x16,
+  "pair-kd101" : 0x17,
+}
+
+# commands packets (with their length byte)
+# Lighting1 and Curtain1 : length, type, subtype, seqnbr, housecode, unitcode, cmnd, filler
+STRUCT_LIGHTING1 = struct.Struct(">8B")
+# Lighting2 : length, type, subtype, seqnbr, id, unitcode, cmnd, level, filler
+STRUCT_LIGHTING2 = struct.Struct(">4BI4B")
+# Lighting3 : length, type, subtype, seqnbr, system, channel8_1, channel10_9, cmnd, filler
+STRUCT_LIGHTING3 = struct.Struct(">9B")
+# Security1 : length, type, subtype, seqnbr, id (3 bytes), status, filler
+STRUCT_SECURITY1 = struct.Struct(">5BH2B")
+
+
+class TransmitScheduler:
+    """ Queue of the commands waiting to be sent, by priority class
+        Inside a class, the commands are sent in the order they were queued. The commands of a unit are always sent
+        in their order : while a unit has some queued commands, its new commands go in the class of these ones, and
+        its next command is not sent before the acknowledge of the previous one (see pop).
+        When the last queued command of a unit is an absolute one (on, off, set level), it is replaced by a newer
+        absolute command for the same unit (coalescing). A group command (see GROUP_COMMANDS) is an ordering barrier
+        for the units of its address : it is sent after their queued commands, which are not replaced any more, and
+        their newer commands are queued after it, as commands of the group. The queue is bounded : when it is full,
+        the newest command of the lowest class is dropped to make room for a command of a higher class, else the new
+        command is refused.
+        The commands are queued by the xPL threads and taken by the write thread.
+    """
+
+    # reason given for a command replaced by a newer one
+    COALESCED = "replaced by a newer command for the same unit"
+
+    def __init__(self, max_size = TRANSMIT_QUEUE_SIZE):
+        """ @param max_size : max number of queued commands
+        """
+        self.max_size = max_size
+        self._queues = [deque() for priority in PRIORITIES]
+        # units which have some queued commands : unit key => [class of their queue, number of commands, last one, group key]
+        self._units = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def put(self, entry):
+        """ Queue a command
+            @param entry : command. Its keys "priority", "unit_key" (None : unknown unit), "coalesce_key" (None :
+                           never merged) and "group_key" (None : no group commands) are used. Its priority is changed
+                           to the class of the queued commands of its unit, its unit key to its group key while a
+                           group command of its address is queued
+            @return : list of (command, reason) dropped : a command replaced by this one or a command dropped
+                      (this one or an other) because the queue is full
+        """
+        with self._lock:
+            return self._put(entry)
+
+    def _put(self, entry):
+        """ Queue a command (the lock must be held)
+        """
+        dropped = []
+        group = entry["group_key"]
+        if group != None and group in self._units:
+            # a group command of its address is queued : the command goes after it
+            entry["unit_key"] = group
+        unit = self._units.get(entry["unit_key"]) if entry["unit_key"] != None else None
+        if unit is None and group != None and entry["unit_key"] == group:
+            # group command : after the queued commands of the units of its address
+            for other in self._units.values():
+                if other[3] == group:
+                    entry["priority"] = max(entry["priority"], other[0])
+                    other[2] = None
+        if unit != None:
+            last = unit[2]
+            if last != None and entry["coalesce_key"] != None and last["coalesce_key"] == entry["coalesce_key"]:
+                # the new command takes the place of the queued one
+                dropped.append((dict(last), self.COALESCED))
+                last.update(entry)
+                last["priority"] = unit[0]
+                return dropped
+            entry["priority"] = unit[0]
+        if self._size >= self.max_size:
+            lowest = max(priority for priority in PRIORITIES if self._queues[priority])
+            if entry["priority"] >= lowest:
+                dropped.append((entry, "transmit queue full"))
+                return dropped
+            victim = self._queues[lowest].pop()
+            self._forget(victim)
+            self._size -= 1
+            dropped.append((victim, "transmit queue full, dropped for a command of a higher priority"))
+        self._queues[entry["priority"]].append(entry)
+        self._size += 1
+        key = entry["unit_key"]
+        if key != None:
+            unit = self._units.get(key)
+            if unit is None:
+                self._units[key] = [entry["priority"], 1, entry, entry["group_key"]]
+            else:
+                unit[1] += 1
+                unit[2] = entry
+        return dropped
+
+    def put_all(self, entries):
+        """ Queue several commands at once : no other command can be queued between them
+            @param entries : commands
+            @return : list of (command, reason) dropped (see put)
+        """
+        dropped = []
+        with self._lock:
+            for entry in entries:
+                dropped.extend(self._put(entry))
+        return dropped
+
+    def pop(self, busy = {}):
+        """ Take the next command to send. A command whose seqnbr is in use or whose unit waits for the acknowledge
+            of a previous command is left in the queue, with the next commands of its unit : the next command of
+            another unit is taken, in its class or in a lower one
+            @param busy : commands sent and not yet acknowledged, by seqnbr
+            @return : the command or None
+        """
+        units = set()
+        groups = set()
+        for entry in busy.values():
+            self._block(entry, units, groups)
+        with self._lock:
+            for queue in self._queues:
+                for (idx, entry) in enumerate(queue):
+                    if entry["seqnbr"] in busy or entry["unit_key"] in units or entry["group_key"] in groups:
+                        self._block(entry, units, groups)
+                        continue
+                    del queue[idx]
+                    self._forget(entry)
+                    self._size -= 1
+                    return entry
+        return None
+
+    def _block(self, entry, units, groups):
+        """ Hold back the commands which must be sent after a command not sent now
+            @param entry : command sent and not yet acknowledged or left in the queue
+            @param units : unit keys of the commands held back, updated
+            @param groups : group keys of the commands held back as the group command of their address is, updated
+        """
+        key = entry["unit_key"]
+        group = entry["group_key"]
+        if key != None:
+            units.add(key)
+        if group != None:
+            # the group command of the address and the commands queued after it
+            units.add(group)
+            if key == group:
+                # the commands of all the units of the address
+                groups.add(group)
+
+    def putback(self, entry):
+        """ Put back a command taken with pop at the head of its class
+            @param entry : command
+        """
+        with self._lock:
+            key = entry["unit_key"]
+            if key != None:
+                unit = self._units.get(key)
+                if unit is None:
+                    self._units[key] = [entry["priority"], 1, entry, entry["group_key"]]
+                else:
+                    # it was queued before the commands of its unit queued since : it goes before them
+                    entry["priority"] = unit[0]
+                    unit[1] += 1
+            self._queues[entry["priority"]].appendleft(entry)
+            self._size += 1
+
+    def expired(self, now):
+        """ Remove the commands whose deadline is reached
+            @param now : current monotonic time
+            @return : list of the removed commands
+        """
+        removed = []
+        with self._lock:
+            for (priority, queue) in enumerate(self._queues):
+                if any(entry["deadline"] <= now for entry in queue):
+                    removed.extend(entry for entry in queue if entry["deadline"] <= now)
+                    self._queues[priority] = deque(entry for entry in queue if entry["deadline"] > now)
+            for entry in removed:
+                self._forget(entry)
+            self._size -= len(removed)
+        return removed
+
+    def _forget(self, entry):
+        """ Remove a command from the queued commands of its unit
+        """
+        key = entry["unit_key"]
+        unit = self._units.get(key) if key != None else None
+        if unit is None:
+            return
+        unit[1] -= 1
+        if unit[1] <= 0:
+            del self._units[key]
+        elif unit[2] is entry:
+            # the previous command of the unit is not known : the next one won't replace it
+            unit[2] = None
+
+
+class TransmitPacer:
+    """ Pace the commands to send according to their estimated airtime (see PACKET_AIRTIME)
+        Once the RFXCOM has NAKed a command received while it was transmitting (see busy), a command is not sent
+        before the end of the transmission of the previous one. Until then, the commands are sent as soon as the
+        transmit window allows it : the RFXCOM queues them. When the transmitter has a duty cycle limit, the
+        airtime of the commands sent over the last DUTY_CYCLE_PERIOD seconds is kept under it.
+        Only the write thread uses it.
+    """
+
+    def __init__(self, duty_cycle = None, period = DUTY_CYCLE_PERIOD):
+        """ @param duty_cycle : max duty cycle (0 to 1). None : no limit
+            @param period : period over which the duty cycle is measured (seconds)
+        """
+        self.duty_cycle = duty_cycle
+        self.period = period
+        # True once the RFXCOM has NAKed a command because it was transmitting
+        self.airtime_pacing = False
+        self._busy_until = 0
+        self._sent = deque()
+        self._airtime = 0.0
+
+    def airtime(self, packet):
+        """ Estimated airtime of a command
+            @param packet : command with its length byte
+        """
+        return PACKET_AIRTIME.get(bytearray(packet[1:2])[0], AIRTIME_DEFAULT)
+
+    def used(self, now):
+        """ Airtime (seconds) used over the last period
+            @param now : current monotonic time
+        """
+        sent = self._sent
+        while sent and sent[0][0] <= now - self.period:
+            self._airtime -= sent.popleft()[1]
+        return self._airtime
+
+    def delay(self, packet, now):
+        """ Delay before a command can be sent
+            @param packet : command with its length byte
+            @param now : current monotonic time
+            @return : delay (seconds), 0 if the command can be sent now
+        """
+        wait = max(0, self._busy_until - now) if self.airtime_pacing else 0
+        if self.duty_cycle != None:
+            airtime = self.airtime(packet)
+            excess = self.used(now) + airtime - self.duty_cycle * self.period
+            if excess > 0:
+                # wait for the oldest commands to leave the period
+                for (sent_at, sent_airtime) in self._sent:
+                    excess -= sent_airtime
+                    if excess <= 0:
+                        wait = max(wait, sent_at + self.period - now)
+                        break
+        return wait
+
+    def sent(self, packet, now):
+        """ Record a sent command
+            @param packet : command with its length byte
+            @param now : current monotonic time
+        """
+        airtime = self.airtime(packet)
+        self._busy_until = max(now, self._busy_until) + airtime
+        if self.duty_cycle != None:
+            self._sent.append((now, airtime))
+            self._airtime += airtime
+
+    def busy(self, packet):
+        """ The RFXCOM NAKed a command as it was transmitting : from now on, the commands are paced by their airtime
+            @param packet : the NAKed command, which was not transmitted
+        """
+        self.airtime_pacing = True
+        self._busy_until -= self.airtime(packet)
+
+
+class ReceiverMerger:
+    """ Merge the packets received by several RFXCOM receivers
+        The readers of the receivers put their sensors packets in a queue. A single thread (see run) takes them : the
+        first copy of a packet is held during the merge window to collect the copies heard by the other receivers,
+        then the copy with the best rssi is processed by the main Rfxcom instance. The copies are identified by
+        duplicate_key (the packet without its seqnbr and rssi).
+        The coverage of each receiver is counted : copies heard, best copies and packets heard only by it.
+    """
+
+    def __init__(self, rfxcom, window = MERGE_WINDOW, stats_period = STATS_PERIOD):
+        """ @param rfxcom : Rfxcom instance which processes the merged packets (and sends the coverage messages)
+            @param window : merge window (seconds)
+            @param stats_period : the coverage is logged and sent every stats_period seconds. 0 : never
+        """
+        self.rfxcom = rfxcom
+        self.window = window
+        self.stats_period = stats_period
+        self.queue = Queue()
+        # packets held during the merge window : key => [end of the window, best packet, best rssi, best receiver, receivers]
+        self._pending = {}
+        self._pending_order = deque()
+        self.coverage = {}
+
+    def add_receiver(self, receiver):
+        """ Declare a receiver
+            @param receiver : receiver id (its device)
+        """
+        self.coverage[receiver] = {"heard" : 0, "best" : 0, "exclusive" : 0}
+
+    def put(self, receiver, packet):
+        """ Give a received packet. Called by the readers
+            @param receiver : receiver id
+            @param packet : packet (without the length byte) as a bytearray
+        """
+        self.queue.put((receiver, packet))
+
+    def run(self, stop):
+        """ Merge and process the packets until a stop request
+            @param stop : an Event to wait for stop request
+        """
+        self.rfxcom.log.info("Start merging the packets of the receivers : {0}".format(", ".join(sorted(self.coverage))))
+        next_report = monotonic() + self.stats_period
+        while not stop.isSet():
+            now = monotonic()
+            timeout = 1
+            if self._pending_order:
+                timeout = max(0, self._pending_order[0][0] - now)
+            try:
+                (receiver, packet) = self.queue.get(True, timeout)
+                self._merge(receiver, packet, monotonic())
+            except Empty:
+                pass
+            now = monotonic()
+            self._flush(now)
+            if self.stats_period > 0 and now >= next_report:
+                self.report()
+                next_report = now + self.stats_period
+
+    def _merge(self, receiver, packet, now):
+        """ Hold the first copy of a packet or merge a copy with the held one
+        """
+        self.coverage[receiver]["heard"] += 1
+        key = duplicate_key(packet)
+        rssi = packet_rssi(packet)
+        entry = self._pending.get(key)
+        if entry is None:
+            end = now + self.window
+            self._pending[key] = [end, packet, rssi, receiver, set([receiver])]
+            self._pending_order.append((end, key))
+            return
+        entry[4].add(receiver)
+        if rssi > entry[2]:
+            entry[1:4] = [packet, rssi, receiver]
+
+    def _flush(self, now):
+        """ Process the packets whose merge window is over
+        """
+        while self._pending_order and self._pending_order[0][0] <= now:
+            (end, key) = self._pending_order.popleft()
+            (end, packet, rssi, receiver, receivers) = self._pending.pop(key)
+            self.coverage[receiver]["best"] += 1
+            if len(receivers) == 1:
+                self.coverage[receiver]["exclusive"] += 1
+            self.rfxcom.process_packet(packet)
+
+    def report(self):
+        """ Log the coverage of each receiver and send it in a xpl-trig rfxcom.coverage message
+        """
+        for receiver in sorted(self.coverage):
+            coverage = self.coverage[receiver]
+            self.rfxcom.log.info("Coverage of the receiver {0} : {1} packets heard, {2} best copies, {3} heard only by it".format(
+                                 receiver, coverage["heard"], coverage["best"], coverage["exclusive"]))
+            self.rfxcom.cb_send_xpl(schema = "rfxcom.coverage",
+                                    data = {"receiver" : receiver,
+                                            "heard" : coverage["heard"],
+                                            "best" : coverage["best"],
+                                            "exclusive" : coverage["exclusive"]})
+
+
 class Rfxcom:
     """ Rfxcom
     """
 
-    def __init__(self, log, callback, stop, rfxcom_device, cb_device_detected, cb_send_xpl, cb_register_thread, fake_device = None):
+    def __init__(self, log, callback, stop, rfxcom_device, cb_device_detected, cb_send_xpl, cb_register_thread, fake_device = None,
+                 cb_send_xpl_batch = None, merge_readings = False, detection_refresh = 0, deadbands = None, heartbeat = 0,
+                 duplicate_window = 0, packet_trace = False, tx_window = 1, tx_queue_size = TRANSMIT_QUEUE_SIZE,
+                 tx_pacing = True, loop = None, receive_protocols = None, stats_period = STATS_PERIOD, transport = None,
+                 replay_speed = 1, capture = None, receiver_id = 0, receive_only = False):
         """ Init Disk object
             @param log : log instance
             @param callback : callback
@@ -131,29 +1001,164 @@ class Rfxcom:
             @param cb_device_detected : callback to handle detected devices
             @param cb_send_xpl : callback to send a full xpl message
             @param fake_device : fake device. If None, this will not be used. Else, the fake serial device library will be used
+            @param cb_send_xpl_batch : callback to send all the xpl messages of a packet at once. If None, cb_send_xpl is called for each message
+            @param merge_readings : if True, all the sensor.basic values of a packet are sent in a single xpl message
+            @param detection_refresh : a detected device is announced again after this delay (seconds). 0 : never (only if its reference changes)
+            @param deadbands : deadband by kind of sensor (temperature, humidity, battery, rssi). A value is sent only if it has changed
+                               by more than the deadband since the last sent value. A missing or negative deadband : all values are sent
+            @param heartbeat : when a deadband applies, a value is sent anyway if nothing was sent since this delay (seconds). 0 : never
+            @param duplicate_window : a packet identical (except its seqnbr and rssi) to a packet received less than this delay
+                                      before (seconds) is dropped before being decoded. 0 : never
+            @param packet_trace : if True, a compact record of each packet (raw data and decoded fields) is logged (see set_packet_trace)
+            @param tx_window : max number of commands sent to the RFXCOM and not yet acknowledged (1 to 255)
+            @param tx_queue_size : max number of commands waiting to be sent (see TransmitScheduler)
+            @param tx_pacing : if True, the commands are paced according to their airtime (once the RFXCOM has NAKed a
+                               command sent while it was transmitting) and the duty cycle limit of the transceiver
+                               (see TransmitPacer)
+            @param loop : asyncio (or trollius) event loop. If set, no write thread is started : once the device is
+                          opened, reading, decoding and writing run on the loop (see listen_async)
+            @param receive_protocols : names of the protocols the receiver has to decode (see RECEIVE_PROTOCOLS). "auto" stands
+                                       for the protocols of the known devices (see add_known_device). If empty or None, the
+                                       protocols set on the RFXCOM are kept
+            @param stats_period : the receive rates and the cpu use are logged every stats_period seconds. 0 : never
+            @param transport : transport of the device : serial, fake, tcp, loopback or replay (see TRANSPORTS). None : guessed
+                               from the device (tcp for tcp://<host>:<port>, loopback for "loopback", else serial)
+            @param replay_speed : with the replay transport, speed of the replay (1 : original timing, N : N times faster,
+                                  0 : as fast as possible)
+            @param capture : if set, CaptureWriter to which each received packet is appended
+            @param receiver_id : id of the receiver in the capture file (with several receivers)
+            @param receive_only : if True, the RFXCOM is only used to receive (additional receivers) : there is no
+                                  write thread and no command can be sent
         """
         self.log = log
         self.callback = callback
         self.stop = stop
 
+        # debug level : it is checked once for all the packets read at once, so that the debug messages
+        # of the packets are not even formatted when the debug level is not enabled
+        self._debug = False
+        self.packet_trace = packet_trace
+        self.receive_protocols = receive_protocols or []
+        self.stats_period = stats_period
+
         # fake or real device
         self.fake_device = fake_device
+        self.transport = transport
+        self.replay_speed = replay_speed
+        self.capture = capture
+        self.receiver_id = receiver_id
+        self.receive_only = receive_only
         self.rfxcom_device = rfxcom_device
 
         self.cb_send_xpl = cb_send_xpl
+        self.cb_send_xpl_batch = cb_send_xpl_batch
+        self.merge_readings = merge_readings
+
+        # last sent values : (device, sensor.basic type) => (value, time)
+        self.heartbeat = heartbeat
+        self._deadbands = {}
+        for (type, kind) in DEADBAND_KINDS.items():
+            if deadbands != None and deadbands.get(kind) != None and deadbands[kind] >= 0:
+                self._deadbands[type] = deadbands[kind]
+        self._last_values = {}
+
+        # recently received packets (without seqnbr and rssi) : key => time, and the same in the arrival order
+        self.duplicate_window = duplicate_window
+        self._seen = {}
+        self._seen_order = deque()
         self.cb_device_detected = cb_device_detected
         self.cb_register_thread = cb_register_thread
 
+        # detected devices : (device_type, address, feature) => (reference, time of the last announce)
+        # and devices already created in Domogik : (device_type, address). They are never announced
+        self.detection_refresh = detection_refresh
+        self._detected = {}
+        self._known_devices = set()
+
         # serial device
         self.rfxcom = None
 
+        # receive buffer : all the bytes waiting on the serial device are read at once and stored here.
+        # Packets are then framed from this buffer. self._rx_pos is the position of the next unread byte
+        # and self._rx_needed the number of bytes still missing to complete the packet at this position
+        self._rx_buffer = bytearray()
+        self._rx_pos = 0
+        self._rx_needed = 1
+
+        # statistics
+        self.stats = {"packets" : 0,           # valid packets received
+                      "discarded_bytes" : 0,   # bytes skipped as they are not part of a valid packet
+                      "resync" : 0,            # number of times the stream had to be resynchronized
+                      "unknown" : {},          # packets received for types not handled by the plugin, by type
+                      "filtered" : 0,          # values not sent because of the deadbands
+                      "duplicates" : 0,        # packets dropped as duplicates
+                      "transmitted" : 0,       # commands written to the RFXCOM (retransmissions included)
+                      "retransmitted" : 0,     # commands written again after a NAK or a timeout
+                      "acknowledged" : 0,      # commands acknowledged by the RFXCOM
+                      "failed" : 0,            # commands given up
+                      "coalesced" : 0,         # commands replaced by a newer one before being sent
+                      "paced" : 0,             # commands delayed by the pacer
+                      "paced_delay" : 0.0,     # total delay of the commands by the pacer
+                      "scenes" : 0,            # scenes done
+                      "scene_latency_max" : 0.0,  # max time to send all the commands of a scene
+                      "disconnects" : 0,       # disconnections of the RFXCOM (unplug, serial errors)
+                      "reconnects" : 0,        # successful reconnections
+                      "reconnect_first_packet" : 0.0,  # time between the last reconnection and the first packet received
+                      "tx_latency" : 0.0,      # total time between the queuing and the acknowledge of the commands
+                      "tx_latency_max" : 0.0}  # max time between the queuing and the acknowledge of a command
+
+        # counters at the start of the current period of the receive rates (see report_rates)
+        self._rates = None
+
+        # reconnection (see reconnect) : while disconnected, no command is sent. Once reconnected, the commands
+        # which were waiting for their acknowledge are queued again (_tx_requeue) and the time until the first
+        # decoded packet is measured from _reopened_at
+        self._disconnected = False
+        self._tx_requeue = False
+        self._reopened_at = None
+
+        # with several receivers, the sensors packets are given to the merger instead of being processed here
+        # (see ReceiverMerger)
+        self.merger = None
+
+        # packet handlers : one entry per packet type, built once
+        self._handlers = [self._process_unknown] * 256
+        for type in range(256):
+            handler = getattr(self, "_process_%02x" % type, None)
+            if handler is not None:
+                self._handlers[type] = handler
+
         # TODO : how to get proper value ?
         self.seqnbr = 0
+        # the commands are encoded by the xPL threads : each one must get its own seqnbr to match its acknowledge
+        self._seqnbr_lock = threading.Lock()
 
-        # Queues for writing and receiving packets to/from Rfxcom
-        self.write_rfx = Queue()
+        # templates of the commands packets by device (see _command_template)
+        self._command_templates = {}
+
+        # Queues for writing (by priority) and receiving packets to/from Rfxcom
+        self.write_rfx = TransmitScheduler(tx_queue_size)
         self.rfx_response = Queue()
 
+        # transmit window : the commands sent and not yet acknowledged, by seqnbr. The write thread is woken
+        # up by _tx_wakeup when a command is queued or a response is received
+        self.tx_window = max(1, min(tx_window, 255))
+        self._in_flight = {}
+        # the duty cycle is set when the transceiver type is known (see decode_status)
+        self.pacer = TransmitPacer() if tx_pacing else None
+        self._tx_wakeup = threading.Event()
+        # the done commands of the scenes are counted under this lock (see _scene_command_done)
+        self._scene_lock = threading.Lock()
+
+        # event loop mode : file descriptor of the device watched by the loop, bytes waiting to be written on
+        # the device and timer of the next _tx_poll call
+        self.loop = loop
+        self._fd = None
+        self._tx_buffer = bytearray()
+        self._tx_timer = None
+        if loop != None or receive_only:
+            return
+
         # Thread to process queue
         write_process = threading.Thread(None,
                                          self.write_daemon,
@@ -186,45 +1191,151 @@ class Rfxcom:
         try:
             self.log.info("**** Open RFXCOM ****")
             self.log.info("Try to open RFXCOM : %s" % self.rfxcom_device)
-            if self.fake_device != None:
-                self.rfxcom = testserial.Serial(self.fake_device, baudrate = 38400, parity = testserial.PARITY_NONE, stopbits = testserial.STOPBITS_ONE, timeout = 5)
-            else:
-                self.rfxcom = serial.Serial(self.rfxcom_device, baudrate = 38400, parity = serial.PARITY_NONE, stopbits = serial.STOPBITS_ONE, timeout = 5)
+            self.rfxcom = self._open_device()
             self.log.info("RFXCOM opened")
             self.log.info("**** Set up the RFXCOM ****")
-            reset_message = "0D00000000000000000000000000"
-            self.log.info("Send 'reset' message : {0}".format(reset_message))
-            self.rfxcom.write(binascii.unhexlify(reset_message))
-            self.log.info("Wait 2 seconds...")
-            time.sleep(2)
-            self.log.info("Flush the serial port")
-            self.rfxcom.flush()
-            get_status_message = "0D00000102000000000000000000"
-            self.log.info("Send 'get status' message : {0}".format(get_status_message))
-            self.rfxcom.write(binascii.unhexlify(get_status_message))
-
-            # Wait for the status response
-            self.log.info("Wait for the status message...")
-            # Here is a example of a status response :
-            # length : 13
-            # data (including length) : 0d010001025315004f6f00000000
-            status_msg = self.wait_for(self.stop, 13, "01")
-            self.log.info("Status message received : {0}".format(status_msg))
+            status_msg = self.handshake()
+            self.log.info("Status message received : {0}".format(binascii.hexlify(status_msg)))
             # decode and display informations about the status
             self.decode_status(status_msg)
-          
-            # TODO : allow to set some custom setup on startup
-            # this need to add some configuration elements
-            # one option per protocol (handle only the protocols supported by the plugin and set 0 for others)
+
+            # decode only the protocols we use
+            if len(self.receive_protocols) > 0:
+                self.set_protocols(status_msg)
 
             # Init process finished
             self.log.info("RFXCOM is ready to use! Have fun")
         
+        except RfxcomException:
+            raise
         except:
             error = "Error while opening RFXCOM : %s. Check if it is the good device or if you have the good permissions on it. Error : %s" % (self.rfxcom_device, traceback.format_exc())
             raise RfxcomException(error)
 
 
+    def _open_device(self):
+        """ Open the device with its transport (see open_transport)
+            @return : the device
+        """
+        if self.fake_device != None:
+            return open_transport("fake", self.fake_device, timeout = 5)
+        return open_transport(self.transport, self.rfxcom_device, timeout = 5, speed = self.replay_speed)
+
+
+    def handshake(self):
+        """ Start the communication with the RFXCOM (see open) : reset, wait, drain, get status
+
+            State machine :
+            · reset : send the reset message
+            · wait : wait HANDSHAKE_RESET_WAIT seconds (SDK : at least 50 ms)
+            · drain : drop all the data received until now
+            · status : send the get status message and wait for the status message during
+              HANDSHAKE_STATUS_INTERVAL seconds. Repeated until the status message is received
+            The time spent in each state is logged and kept in self.stats["handshake"]
+            @return : the status message (without the length byte) as a bytearray
+        """
+        start = monotonic()
+        deadline = start + HANDSHAKE_DEADLINE
+        phases = {"reset" : 0.0, "wait" : 0.0, "drain" : 0.0, "status" : 0.0, "tries" : 0}
+        self.stats["handshake"] = phases
+        state = "reset"
+        status_msg = None
+        while state != "ready":
+            now = monotonic()
+            if self.stop.isSet():
+                raise RfxcomException("Stop requested while waiting for the RFXCOM")
+            if now >= deadline:
+                raise RfxcomException("No status message received from the RFXCOM after {0} tries in {1} seconds".format(phases["tries"], HANDSHAKE_DEADLINE))
+            if state == "reset":
+                self.log.info("Send 'reset' message : {0}".format(binascii.hexlify(RESET_MESSAGE)))
+                self.rfxcom.write(RESET_MESSAGE)
+                next_state = "wait"
+            elif state == "wait":
+                time.sleep(HANDSHAKE_RESET_WAIT)
+                next_state = "drain"
+            elif state == "drain":
+                self._drain()
+                next_state = "status"
+            else:
+                phases["tries"] += 1
+                self.log.info("Send 'get status' message : {0}".format(binascii.hexlify(GET_STATUS_MESSAGE)))
+                self.rfxcom.write(GET_STATUS_MESSAGE)
+                # Here is a example of a status response :
+                # length : 13
+                # data (including length) : 0d010001025315004f6f00000000
+                status_msg = self.wait_for(self.stop, STRUCT_STATUS.size, 0x01, deadline = min(now + HANDSHAKE_STATUS_INTERVAL, deadline))
+                next_state = "status" if status_msg is None else "ready"
+            phases[state] += monotonic() - now
+            state = next_state
+        self.log.info("Handshake done in {0:.0f} ms : reset {1:.0f} ms, wait {2:.0f} ms, drain {3:.0f} ms, status {4:.0f} ms ({5} get status)".format(
+                      (monotonic() - start) * 1000, phases["reset"] * 1000, phases["wait"] * 1000, phases["drain"] * 1000,
+                      phases["status"] * 1000, phases["tries"]))
+        return status_msg
+
+
+    def _drain(self):
+        """ Drop all the data received from the RFXCOM until now
+        """
+        flush_input = getattr(self.rfxcom, "flushInput", None)
+        if flush_input != None:
+            flush_input()
+        size = self._bytes_waiting()
+        while size > 0:
+            self.rfxcom.read(size)
+            size = self._bytes_waiting()
+        del self._rx_buffer[:]
+        self._rx_pos = 0
+        self._rx_needed = 1
+
+
+    def protocols_mask(self):
+        """ Compute the protocols the receiver has to decode from the receive_protocols option and the known devices
+            @return : (msg3, msg4, msg5) bytes of the set mode message
+        """
+        names = set()
+        for name in self.receive_protocols:
+            if name == "auto":
+                for (device_type, address) in self._known_devices:
+                    names.update(device_protocols(device_type, address))
+            elif name in RECEIVE_PROTOCOLS:
+                names.add(name)
+            else:
+                self.log.warning("Unknown receiver protocol '{0}' : ignored. Known protocols : {1}".format(name, ", ".join(sorted(RECEIVE_PROTOCOLS))))
+        mask = [0, 0, 0]
+        for name in names:
+            (msg, bit) = RECEIVE_PROTOCOLS[name]
+            mask[msg - 3] |= 1 << bit
+        return tuple(mask)
+
+
+    def set_protocols(self, status_msg):
+        """ Send a set mode message to enable only the needed protocols (see protocols_mask)
+            Nothing is sent if they are already the ones enabled
+            @param status_msg : status message (without the length byte) received on startup
+        """
+        status = STRUCT_STATUS.unpack_from(status_msg)
+        current = status[6:9]
+        mask = self.protocols_mask()
+        if mask == current:
+            self.log.info("The receiver protocols are already set : {0:02x} {1:02x} {2:02x}".format(*mask))
+            return
+        if mask == (0, 0, 0):
+            self.log.warning("No receiver protocol to enable (no known device ?) : the protocols set on the RFXCOM are kept")
+            return
+        self.log.info("Set the receiver protocols : {0:02x} {1:02x} {2:02x} (previously {3:02x} {4:02x} {5:02x})".format(*(mask + current)))
+        seqnbr = self._next_seqnbr()
+        packet = bytearray([STRUCT_STATUS.size]) + STRUCT_STATUS.pack(0x00, 0x00, seqnbr, SET_MODE_COMMAND, status[4], 0, mask[0], mask[1], mask[2], 0, 0, 0, 0)
+        self.log.info("Send 'set mode' message : {0}".format(binascii.hexlify(packet)))
+        self.rfxcom.write(bytes(packet))
+        reply = self.wait_for(self.stop, timeout = SET_MODE_TIMEOUT,
+                              match = lambda data : data[0] == 0x01 and len(data) == STRUCT_STATUS.size and data[3] == SET_MODE_COMMAND)
+        if reply is None:
+            self.log.warning("No status message received after the set mode message : the receiver protocols may not be set")
+            return
+        self.log.info("Status message received after the set mode message : {0}".format(binascii.hexlify(reply)))
+        self.decode_status(reply)
+
+
     def close(self):
         """ close RFXCOM
         """
@@ -236,28 +1347,111 @@ class Rfxcom:
             raise RfxcomException(error)
             
 
-    def write_packet(self, data, xpl_trig_message):
+    def write_packet(self, data, xpl_trig_message, deadline = COMMAND_DEADLINE, priority = None):
         """ Write command to rfxcom
-            @param data : command without length
+            @param data : command without length (hexadecimal string)
             @param xpl_trig_message : xpl-trig msg to send if success
+            @param deadline : the command is given up if it is not acknowledged after this delay (seconds)
+            @param priority : priority class (PRIORITY_*). If None, it depends on the command (see command_class)
         """
         # build the packet : <lenght><data>
-        length = len(data)/2
-        packet = "%02X%s" % (length, data.upper())
+        packet = bytearray(binascii.unhexlify(data))
+        packet.insert(0, len(packet))
+        self.queue_packet(packet, xpl_trig_message, deadline, priority)
+
 
+    def queue_packet(self, packet, xpl_trig_message, deadline = COMMAND_DEADLINE, priority = None):
+        """ Queue a command to send to rfxcom
+            @param packet : command with its length byte as a bytearray
+            @param xpl_trig_message : xpl-trig msg to send if success
+            @param deadline : the command is given up if it is not acknowledged after this delay (seconds)
+            @param priority : priority class (PRIORITY_*). If None, it depends on the command (see command_class)
+        """
+        if self.receive_only:
+            raise RfxcomException("The RFXCOM {0} is only used to receive : no command can be sent to it".format(self.rfxcom_device))
         # Put message in write queue
         # we put in queue the sequence number, the built packet and the xpl-trig message to send if the message is successfully write
-        seqnbr = gh(packet, 2)
-        self.write_rfx.put_nowait({"seqnbr" : seqnbr, 
-                                   "packet" : packet,
-                                   "xpl_trig_message" : xpl_trig_message})
+        self._tx_dropped(self.write_rfx.put(self._tx_entry(packet, xpl_trig_message, monotonic(), deadline, priority)))
+        self._tx_notify()
+
+
+    def send_scene(self, name, packets, deadline = COMMAND_DEADLINE, priority = PRIORITY_BULK):
+        """ Send the commands of a scene : they are queued at once, in their order, and the end of the scene
+            (all its commands acknowledged or failed) is reported with a single xPL rfxcom.scene message
+            (scene, status=ok|failed, commands, failed, latency in ms)
+            @param name : name of the scene
+            @param packets : commands (with their length byte) as bytearrays, see the encode_XX functions
+            @param deadline : each command is given up if it is not acknowledged after this delay (seconds)
+            @param priority : priority class (PRIORITY_*) of the commands
+        """
+        if self.receive_only:
+            raise RfxcomException("The RFXCOM {0} is only used to receive : no command can be sent to it".format(self.rfxcom_device))
+        now = monotonic()
+        scene = {"name" : name,
+                 "commands" : len(packets),
+                 "remaining" : len(packets),
+                 "failed" : 0,
+                 "started" : now}
+        entries = []
+        for packet in packets:
+            entry = self._tx_entry(packet, None, now, deadline, priority)
+            entry["scene"] = scene
+            entries.append(entry)
+        self.log.info("Send the scene '{0}' : {1} commands".format(name, len(packets)))
+        if not entries:
+            self._scene_done(scene, now)
+            return
+        self._tx_dropped(self.write_rfx.put_all(entries))
+        self._tx_notify()
+
+
+    def _tx_entry(self, packet, xpl_trig_message, now, deadline, priority):
+        """ Build the write queue entry of a command
+            @param packet : command with its length byte as a bytearray
+            @param xpl_trig_message : xpl-trig msg to send if success
+            @param now : current monotonic time
+            @param deadline : the command is given up if it is not acknowledged after this delay (seconds)
+            @param priority : priority class (PRIORITY_*). If None, it depends on the command (see command_class)
+        """
+        (command_priority, unit_key, coalesce_key, group_key) = command_class(packet[1:])
+        if priority == None:
+            priority = command_priority
+        return {"seqnbr" : packet[3],
+                "packet" : bytes(packet),
+                "xpl_trig_message" : xpl_trig_message,
+                "priority" : priority,
+                "unit_key" : unit_key,
+                "coalesce_key" : coalesce_key,
+                "group_key" : group_key,
+                "queued" : now,
+                "deadline" : now + deadline,
+                "tries" : 0,
+                "waiting" : False,
+                "retry_at" : None,
+                "paced" : False,
+                "scene" : None}
+
+
+    def _tx_dropped(self, dropped):
+        """ Handle the commands dropped when queuing a command
+            @param dropped : list of (command, reason) (see TransmitScheduler.put)
+        """
+        for (entry, reason) in dropped:
+            if reason == TransmitScheduler.COALESCED:
+                self.stats["coalesced"] += 1
+                self.log.info("Command %s not sent : %s" % (binascii.hexlify(entry["packet"]), reason))
+                if entry["scene"] != None:
+                    self._scene_command_done(entry, True)
+            else:
+                self._tx_failed(entry, reason)
 
 
     def write_daemon(self):
         """ Write packets in queue to RFXCOM and manager errors to resend them
             This function must be launched as a thread in backgroun
  
-            How it works (actually solution 2) :
+            How it works (actually solution 1, with up to tx_window messages in flight : with a window of 1,
+            this is solution 2) :
 
             Solution 1 : 
         
@@ -287,99 +1481,591 @@ class Rfxcom:
             Receive ACK 2
             Transmit message 3
             Receive ACK 3
+
+            The work is done by _tx_poll. This thread only waits between two calls until a command is queued,
+            a response is received or a command must be sent again.
         """
         self.log.info("Start the write_rfx thread")
         # To test, see RFXCOM email from 17/10/2011 at 20:22 
         
         # infinite
         while not self.stop.isSet():
+            try:
+                delay = self._tx_poll(monotonic())
+            except serial.SerialException:
+                error = "Error while writing rfxcom device (disconnected ?) : %s" % traceback.format_exc()
+                self.log.error(error)
+                delay = WAIT_BETWEEN_TRIES
+            if delay is None:
+                delay = 5
+            self._tx_wakeup.wait(delay)
+            self._tx_wakeup.clear()
+
+
+    def _tx_notify(self):
+        """ Wake up the transmit window processing : a command has been queued or a response received
+            This may be called from any thread
+        """
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self._tx_async)
+        else:
+            self._tx_wakeup.set()
 
-            # Wait for a packet in the queue
-            # TODO : avoid to use a blocking call
+
+    def _tx_poll(self, now):
+        """ Process the transmit window once : handle the received responses, send again the NAKed and timed out
+            commands and send the queued commands while there is some place in the window
+            Each command ends either acknowledged or failed (see _tx_failed), at the latest on its deadline
+            @param now : current monotonic time
+            @return : delay (seconds) before a command has to be sent again or reaches its deadline,
+                      None if no command is waiting for a response
+        """
+        while True:
             try:
-                data = self.write_rfx.get(block = True, timeout = 5)
+                self._tx_response(self.rfx_response.get_nowait(), now)
             except Empty:
-                continue
-            seqnbr = data["seqnbr"]
-            packet = data["packet"]
-            xpl_trig_message = data["xpl_trig_message"]
-            self.log.debug("Get from Queue : %s > %s" % (seqnbr, packet))
-            self.rfxcom.write(binascii.unhexlify(packet))
-
-            # TODO : read in queue in which has been stored data readen from rfx
-            loop = True
-            while loop == True:
-                res = self.rfx_response.get(block = True)
-                if res["status"] == "NACK":
-                    self.debug.warning("Failed to write. Retry in %s : %s > %s" % (WAIT_BETWEEN_TRIES, seqnbr, packet))
-                    time.sleep(WAIT_BETWEEN_TRIES)
-                    self.rfxcom.write(binascii.unhexlify(packet))
+                break
+        if self.rfxcom is None or self._disconnected:
+            # not yet opened or disconnected : reconnect will wake us up
+            return None
+        if self._tx_requeue:
+            # reconnected : the RFXCOM has been reset, the commands waiting for their acknowledge are sent again
+            self._tx_requeue = False
+            for entry in sorted(self._in_flight.values(), key = lambda entry : entry["queued"], reverse = True):
+                entry["waiting"] = False
+                self.write_rfx.putback(entry)
+            self._in_flight.clear()
+
+        # commands out of time, not acknowledged in time or to send again
+        for entry in list(self._in_flight.values()):
+            if entry["deadline"] <= now:
+                self._tx_failed(entry, "not acknowledged before its deadline")
+            elif entry["retry_at"] <= now:
+                if entry["waiting"]:
+                    self._tx_retry(entry, now, "no acknowledge")
                 else:
-                    self.log.debug("Command succesfully sent")
-                    self.cb_send_xpl(xpl_trig_message)
-                    loop = False
-            
+                    wait = self._tx_paced(entry, now)
+                    if wait > 0:
+                        entry["retry_at"] = now + wait
+                        continue
+                    self.log.warning("Send again the command : %s > %s" % (entry["seqnbr"], binascii.hexlify(entry["packet"])))
+                    self.stats["retransmitted"] += 1
+                    self._tx_send(entry, now)
+
+        # new commands, by priority
+        in_flight = self._in_flight
+        wakeup = None
+        for entry in self.write_rfx.expired(now):
+            self._tx_failed(entry, "not sent before its deadline")
+        while len(in_flight) < self.tx_window:
+            entry = self.write_rfx.pop(in_flight)
+            if entry is None:
+                break
+            wait = self._tx_paced(entry, now)
+            if wait > 0:
+                self.write_rfx.putback(entry)
+                wakeup = now + min(wait, entry["deadline"] - now)
+                break
+            try:
+                self._tx_send(entry, now)
+            except:
+                # not written : keep it for later
+                self.write_rfx.putback(entry)
+                raise
+
+        for entry in in_flight.values():
+            deadline = min(entry["retry_at"], entry["deadline"])
+            if wakeup is None or deadline < wakeup:
+                wakeup = deadline
+        if wakeup is None:
+            return None
+        return max(0, wakeup - now)
+
+
+    def _tx_paced(self, entry, now):
+        """ Check if the pacer delays a command
+            @param entry : command to send
+            @param now : current monotonic time
+            @return : delay (seconds) before the command can be sent, 0 if it can be sent now
+        """
+        if self.pacer is None:
+            return 0
+        wait = self.pacer.delay(entry["packet"], now)
+        if wait > 0 and not entry["paced"]:
+            entry["paced"] = True
+            entry["paced_at"] = now
+            self.stats["paced"] += 1
+        return wait
+
+
+    def _tx_send(self, entry, now):
+        """ Write a command to the RFXCOM and wait for its response in the transmit window
+            @param entry : command from the write queue
+            @param now : current monotonic time
+        """
+        if self._debug:
+            self.log.debug("Get from Queue : %s > %s" % (entry["seqnbr"], binascii.hexlify(entry["packet"])))
+        self._write(entry["packet"])
+        if self.pacer != None:
+            self.pacer.sent(entry["packet"], now)
+            if entry["paced"]:
+                entry["paced"] = False
+                self.stats["paced_delay"] += now - entry["paced_at"]
+        entry["tries"] += 1
+        entry["waiting"] = True
+        entry["retry_at"] = now + ACK_TIMEOUT
+        self._in_flight[entry["seqnbr"]] = entry
+        self.stats["transmitted"] += 1
+
+
+    def _tx_response(self, response, now):
+        """ Handle a response of the RFXCOM to a command
+            @param response : response from the rfx_response queue (see _process_02)
+            @param now : current monotonic time
+        """
+        entry = self._in_flight.get(response["seqnbr"])
+        if entry is None:
+            self.log.warning("Response received for an unknown command (seqnbr {0}) : {1}".format(response["seqnbr"], response["message"]))
+            return
+        if response["status"] == "ACK":
+            # a late acknowledge of a command waiting to be sent again is accepted too
+            del self._in_flight[entry["seqnbr"]]
+            latency = now - entry["queued"]
+            self.stats["acknowledged"] += 1
+            self.stats["tx_latency"] += latency
+            self.stats["tx_latency_max"] = max(self.stats["tx_latency_max"], latency)
+            if self._debug:
+                self.log.debug("Command succesfully sent in {0:.3f}s : {1}".format(latency, binascii.hexlify(entry["packet"])))
+            if entry["xpl_trig_message"] != None:
+                self.cb_send_xpl(entry["xpl_trig_message"])
+            if entry["scene"] != None:
+                self._scene_command_done(entry, True)
+        elif not entry["waiting"]:
+            # late NAK : the command is already waiting to be sent again
+            return
+        elif response["retry"]:
+            if self.pacer != None:
+                if not self.pacer.airtime_pacing:
+                    self.log.info("The RFXCOM NAKs the commands sent while it is transmitting : the commands are paced by their airtime")
+                self.pacer.busy(entry["packet"])
+                # sent again as soon as the transmitter is free (see _tx_paced)
+                self._tx_retry(entry, now, response["message"], 0)
+            else:
+                self._tx_retry(entry, now, response["message"])
+        else:
+            self._tx_failed(entry, response["message"])
+
+
+    def _tx_retry(self, entry, now, reason, delay = None):
+        """ Schedule a command to be sent again, or give it up if it has been sent too many times or if it
+            would be sent again after its deadline
+            @param entry : command of the transmit window
+            @param now : current monotonic time
+            @param reason : why the command has to be sent again
+            @param delay : delay before sending it again (seconds). None : backoff delay (see retry_delay)
+        """
+        if delay is None:
+            delay = retry_delay(entry["tries"])
+        if entry["tries"] >= TRANSMIT_TRIES:
+            self._tx_failed(entry, "{0} after {1} tries".format(reason, entry["tries"]))
+        elif now + delay >= entry["deadline"]:
+            self._tx_failed(entry, "{0}, no time left to try again".format(reason))
+        else:
+            self.log.warning("Failed to write (%s). Retry in %.2fs : %s > %s" % (reason, delay, entry["seqnbr"], binascii.hexlify(entry["packet"])))
+            entry["waiting"] = False
+            entry["retry_at"] = now + delay
+
+
+    def _tx_failed(self, entry, reason):
+        """ Give up a command : the failure is logged and sent as a xPL log.basic error message
+            @param entry : command of the transmit window or of the pending commands
+            @param reason : why the command is given up
+        """
+        if self._in_flight.get(entry["seqnbr"]) is entry:
+            del self._in_flight[entry["seqnbr"]]
+        self.stats["failed"] += 1
+        command = binascii.hexlify(entry["packet"])
+        error = "Failed to write the command %s : %s" % (command, reason)
+        self.log.error(error)
+        self.cb_send_xpl(schema = "log.basic", data = {"type" : "err",
+                                                      "text" : error,
+                                                      "code" : command})
+        if entry["scene"] != None:
+            self._scene_command_done(entry, False)
+
+
+    def _scene_command_done(self, entry, success):
+        """ A command of a scene is acknowledged or failed
+            @param entry : command of the scene
+            @param success : False if the command failed
+        """
+        # the commands replaced by a newer one are done on the xPL threads, the other ones on the write thread
+        with self._scene_lock:
+            scene = entry["scene"]
+            entry["scene"] = None
+            if scene is None:
+                return
+            scene["remaining"] -= 1
+            if not success:
+                scene["failed"] += 1
+            done = scene["remaining"] == 0
+        if done:
+            self._scene_done(scene, monotonic())
+
+
+    def _scene_done(self, scene, now):
+        """ Report the end of a scene
+            @param scene : the scene
+            @param now : current monotonic time
+        """
+        latency = now - scene["started"]
+        self.stats["scenes"] += 1
+        self.stats["scene_latency_max"] = max(self.stats["scene_latency_max"], latency)
+        status = "failed" if scene["failed"] > 0 else "ok"
+        self.log.info("Scene '{0}' done in {1:.0f} ms : {2} commands, {3} failed".format(scene["name"], latency * 1000, scene["commands"], scene["failed"]))
+        self.cb_send_xpl(schema = "rfxcom.scene", data = {"scene" : scene["name"],
+                                                         "status" : status,
+                                                         "commands" : scene["commands"],
+                                                         "failed" : scene["failed"],
+                                                         "latency" : int(latency * 1000)})
+
 
     def get_seqnbr(self):
+        """ Return seqnbr (hexadecimal string) and then increase it
+        """
+        return "%02x" % self._next_seqnbr()
+
+
+    def _next_seqnbr(self):
         """ Return seqnbr and then increase it
         """
-        ret = self.seqnbr
-        if ret == 255:
-            ret = 0
+        with self._seqnbr_lock:
+            ret = self.seqnbr
+            self.seqnbr = (self.seqnbr + 1) % 256
+        return ret
+
+
+    def _command_template(self, key, build, *args):
+        """ Return the template of the commands for a device : the packet with its type, subtype and address,
+            built once and then cached. The seqnbr and the command are set in a copy of it for each command
+            @param key : key of the device
+            @param build : function which builds the template (the protocol and address are checked there)
+            @param args : arguments of build
+        """
+        template = self._command_templates.get(key)
+        if template == None:
+            template = build(*args)
+            self._command_templates[key] = template
+        return template
+
+
+    def encode_10(self, address, command, protocol):
+        """ Type 0x10, Lighting1
+
+            Type : command
+            SDK version : 4.8
+            @param address : housecode and unitcode (ex : a1)
+            @param command : command (see LIGHTING1_COMMANDS)
+            @param protocol : protocol (see LIGHTING1_PROTOCOLS)
+            @return : the command packet (with its length byte) as a bytearray
+        """
+        packet = bytearray(self._command_template((0x10, protocol, address), lighting1_template, protocol, address))
+        packet[3] = self._next_seqnbr()
+        packet[6] = command_code(LIGHTING1_COMMANDS, command)
+        return packet
+
+
+    def command_10(self, address, command, protocol, trig_msg):
+        """ Send a type 0x10 command (see encode_10)
+            @param trig_msg : xpl-trig msg to send if success
+        """
+        self.queue_packet(self.encode_10(address, command, protocol), trig_msg)
+
+
+    def encode_11(self, address, unit, command, level, eu, group):
+        """ Type 0x11, Lighting2
+
+            Type : command
+            SDK version : 4.8
+            Tested : yes
+
+            Remarks :
+            - eu != true : Chacon, KlikAanKlikUit, HomeEasy UK, NEXA 
+            - eu = true : HomeEasy EU
+            - ANSLUT is the same as Chacon. But the address must have a special
+              address, not all addresses are accepted in fact. The user has to 
+              try addresses and change the lowest address digit until the ANSLUT              responds.
+
+            @param address : id (hexadecimal string, ex : 0x0123456)
+            @param unit : unit code
+            @param command : command (see LIGHTING2_COMMANDS)
+            @param level : level in percent for the preset commands
+            @param eu : True for HomeEasy EU
+            @param group : True for a group command
+            @return : the command packet (with its length byte) as a bytearray
+        """
+        packet = bytearray(self._command_template((0x11, eu == True, address, unit), lighting2_template, eu == True, address, unit))
+        packet[3] = self._next_seqnbr()
+        if group == True:
+            command = "group_" + command
+        packet[9] = command_code(LIGHTING2_COMMANDS, command)
+        packet[10] = lighting2_level(int(level))
+        return packet
+
+
+    def command_11(self, address, unit, command, level, eu, group, trig_msg):
+        """ Send a type 0x11 command (see encode_11)
+            @param trig_msg : xpl-trig msg to send if success
+        """
+        self.queue_packet(self.encode_11(address, unit, command, level, eu, group), trig_msg)
+
+
+    def encode_12(self, address, command, level):
+        """ Type 0x12, Lighting3 (Ikea Koppla)
+
+            Type : command
+            SDK version : 4.8
+            @param address : system (a to p) and channel (1 to 10) (ex : a3)
+            @param command : command (see LIGHTING3_COMMANDS) or level
+            @param level : level in percent for the level command
+            @return : the command packet (with its length byte) as a bytearray
+        """
+        packet = bytearray(self._command_template((0x12, address), lighting3_template, address))
+        packet[3] = self._next_seqnbr()
+        if command.lower() == "level":
+            packet[7] = lighting3_level(int(level))
         else:
-            self.seqnbr += 1
-        return "%02x" % ret
+            packet[7] = command_code(LIGHTING3_COMMANDS, command)
+        return packet
+
+
+    def command_12(self, address, command, level, trig_msg):
+        """ Send a type 0x12 command (see encode_12)
+            @param trig_msg : xpl-trig msg to send if success
+        """
+        self.queue_packet(self.encode_12(address, command, level), trig_msg)
+
+
+    def encode_18(self, address, command):
+        """ Type 0x18, Curtain1 (Harrison)
+
+            Type : command
+            SDK version : 4.8
+            @param address : housecode and unitcode (ex : a1)
+            @param command : command (see CURTAIN1_COMMANDS)
+            @return : the command packet (with its length byte) as a bytearray
+        """
+        packet = bytearray(self._command_template((0x18, address), curtain1_template, address))
+        packet[3] = self._next_seqnbr()
+        packet[6] = command_code(CURTAIN1_COMMANDS, command)
+        return packet
+
+
+    def command_18(self, address, command, trig_msg):
+        """ Send a type 0x18 command (see encode_18)
+            @param trig_msg : xpl-trig msg to send if success
+        """
+        self.queue_packet(self.encode_18(address, command), trig_msg)
+
+
+    def encode_20(self, address, command, delay):
+        """ Type 0x20, Security1
+
+            Type : command
+            SDK version : 4.12
+            @param address : id (hexadecimal string, ex : 0x123456)
+            @param command : command (see SECURITY1_COMMANDS)
+            @param delay : "max" for the delayed commands
+            @return : the command packet (with its length byte) as a bytearray
+        """
+        packet = bytearray(self._command_template((0x20, address), security1_template, address))
+        packet[3] = self._next_seqnbr()
+        if delay == "max":
+            command += "-delayed"
+        packet[7] = command_code(SECURITY1_COMMANDS, command)
+        return packet
+
+
+    def command_20(self, address, command, delay, trig_msg):
+        """ Send a type 0x20 command (see encode_20)
+            @param trig_msg : xpl-trig msg to send if success
+        """
+        self.queue_packet(self.encode_20(address, command, delay), trig_msg)
             
 
-    def wait_for(self, stop, length, msg_type, timeout = None):
+    def wait_for(self, stop, length = None, msg_type = None, timeout = None, match = None, deadline = None):
         """ Wait for some dedicated message from the Rfxcom. All other received messages will be ignored
+            The messages are read on the normal framing path (see _next_packet) : the ignored messages are
+            skipped as a whole and the stream stays aligned. They are not processed.
         @param stop : an Event to wait for stop request
-        @param length : length of the waited message
-        @param msg_type : type of the waited message
-        @param timeout : timeout : if reached, we raise an error
+        @param length : length of the waited message (None : any length)
+        @param msg_type : type of the waited message (integer, None : any type)
+        @param timeout : if no waited message is received after timeout seconds, None is returned
+        @param match : function called with each message (without the length byte) which returns True for the
+                       waited message. Used instead of length and msg_type
+        @param deadline : monotonic time (see monotonic()) after which None is returned. The earliest of
+                          timeout and deadline is used
+        @return : the waited message (without the length byte) as a bytearray or None (timeout, deadline or stop request)
         """
-        self.log.info("Start listening to the rfxcom device for lenght={0}, type={1}".format(length, msg_type))
+        if match == None:
+            match = lambda packet : (length == None or len(packet) == length) and (msg_type == None or packet[0] == msg_type)
+        if timeout != None:
+            deadline = min(deadline or float("inf"), monotonic() + timeout)
+        self._debug = self.log.isEnabledFor(logging.DEBUG)
+        read_timeout = self.rfxcom.timeout
+        self.rfxcom.timeout = WAIT_FOR_READ_TIMEOUT
         try:
-            # TODO : handle timeout
-            while not stop.isSet():
-
-                self.log.debug("Waiting for a packet from the rfxcom with a length of {0} and hoping type will be {1}...".format(length, msg_type))
-                data_len = self.rfxcom.read()
-                # handle empty data (why the hell does this happen ?)
-                if data_len == '':
-                    #self.log.debug("Timeout reached (this is not an issue!!)")
-                    continue
+            while not stop.isSet() and (deadline == None or monotonic() < deadline):
+                packet = self._next_packet()
+                while packet is not None:
+                    if match(packet):
+                        return packet
+                    if self._debug:
+                        self.log.debug("Packet skipped while waiting for a dedicated message : {0}".format(binascii.hexlify(packet)))
+                    packet = self._next_packet()
+                self._fill_rx_buffer()
+            return None
+        except serial.SerialException:
+            raise RfxcomException("Error while reading rfxcom device (disconnected ?) : %s" % traceback.format_exc())
+        finally:
+            self.rfxcom.timeout = read_timeout
 
-                hex_data_len = binascii.hexlify(data_len)
-                int_data_len = int(hex_data_len, 16)
-                    
-                self.log.debug("Packet of length {0} (0x{1}) received, start processing...".format(int_data_len, hex_data_len))
-                if int_data_len == length:
-                    # We read data
-                    data = self.rfxcom.read(int_data_len)
-                    hex_data = binascii.hexlify(data)
-                    self.log.debug("Packet : %s" % hex_data)
-                    the_type = hex_data[0] + hex_data[1]
-                    if msg_type == the_type:
-                        self.log.debug("Packet type is the one we wait for. End waiting for a dedicated packet")
-                        return hex_data
-                    else:
-                        self.log.debug("Packet type (0x{0})is the one we are waiting for (0x{1}) : skipping this one.".format(the_type, msg_type))
-                    
-                else:
-                    # bad length : skip message
-                    # warning : it can besome wrong data so it may be not real data and so we shouldn't wait for 
-                    # some data of the given length
 
-                    # TODO : how to handle this ?????
-                    self.log.debug("This is not the message we are waiting for")
+    def listen_async(self):
+        """ Start using the RFXCOM on the event loop given at creation, instead of the reader and write threads
+            The serial device is read when it is readable and written when it is writable (without blocking) and
+            the transmit window is processed on the timers of the loop. Framing, decoding and acknowledges matching
+            are the same as in the threaded mode. The device must be opened before, with a transport which has a
+            file descriptor (serial, tcp : see transport.py)
+        """
+        if self.loop == None:
+            raise RfxcomException("No event loop given to use the RFXCOM on it")
+        fd = device_fileno(self.rfxcom)
+        if fd is None:
+            raise RfxcomException("The RFXCOM device {0} has no file descriptor (transport {1}) : it can't be used on an event loop, use the reader and write threads".format(self.rfxcom_device, self.transport))
+        self.log.info("**** Start really using RFXCOM (event loop) ****")
+        self._fd = fd
+        # don't block when reading : only the available bytes are read
+        self.rfxcom.timeout = 0
+        self.loop.add_reader(fd, self._read_async)
+        self._tx_async()
+
+
+    def stop_async(self):
+        """ Stop using the RFXCOM on the event loop
+        """
+        if self._fd != None:
+            self.loop.remove_reader(self._fd)
+            self.loop.remove_writer(self._fd)
+            self._fd = None
+        if self._tx_timer != None:
+            self._tx_timer.cancel()
+            self._tx_timer = None
 
-        except serial.SerialException:
+
+    def _read_async(self):
+        """ Called by the event loop when the serial device is readable
+        """
+        try:
+            self.read()
+        except (serial.SerialException, OSError, IOError):
             error = "Error while reading rfxcom device (disconnected ?) : %s" % traceback.format_exc()
             self.log.error(error)
-            # TODO : raise for using self.force_leave() in bin ?
+            self.stop_async()
+            disconnected_at = self._disconnect()
+            # open the device again in a thread (open is blocking), then go on on the loop
+            reconnect_process = threading.Thread(None,
+                                                 self._reconnect_async,
+                                                 "rfxcom-reconnect",
+                                                 (disconnected_at,),
+                                                 {})
+            self.cb_register_thread(reconnect_process)
+            reconnect_process.start()
+
+
+    def _reconnect_async(self, disconnected_at):
+        """ Open the RFXCOM again (see reconnect), then use it again on the event loop
+            This runs in a thread : meanwhile the device is neither read nor written by the loop (the reader and
+            the writer are removed and the transmit window is not processed while disconnected). The state shared
+            with the loop is only changed on the loop, by _reconnected_async
+            @param disconnected_at : monotonic time of the disconnection
+        """
+        reopened = self._reopen(self.stop)
+        if reopened != None:
+            self.loop.call_soon_threadsafe(self._reconnected_async, disconnected_at, reopened)
+
+
+    def _reconnected_async(self, disconnected_at, reopened):
+        """ Called on the event loop once the RFXCOM is opened again : use it again on the loop
+            @param disconnected_at : monotonic time of the disconnection
+            @param reopened : start time of the successful try and number of tries (see _reopen)
+        """
+        if self.stop.isSet():
             return
+        self._reconnected(disconnected_at, *reopened)
+        self.listen_async()
+
 
+    def _tx_async(self):
+        """ Process the transmit window on the event loop and schedule the next processing
+        """
+        if self._tx_timer != None:
+            self._tx_timer.cancel()
+            self._tx_timer = None
+        if self.stop.isSet() or self._fd is None or self.receive_only:
+            # stopped, not listening yet (listen_async processes the window) or nothing to send
+            return
+        try:
+            delay = self._tx_poll(monotonic())
+        except (serial.SerialException, OSError):
+            error = "Error while writing rfxcom device (disconnected ?) : %s" % traceback.format_exc()
+            self.log.error(error)
+            delay = WAIT_BETWEEN_TRIES
+        if delay != None:
+            self._tx_timer = self.loop.call_later(delay, self._tx_async)
+
+
+    def _write(self, data):
+        """ Write data on the serial device
+            With an event loop, the data is written without blocking : what can't be written now is buffered and
+            written when the device is writable
+            @param data : bytes to write
+        """
+        if self.loop == None:
+            self.rfxcom.write(data)
+            return
+        if not self._tx_buffer:
+            self._tx_buffer.extend(data)
+            self._flush_tx_buffer()
+            if self._tx_buffer:
+                self.loop.add_writer(self._fd, self._write_async)
+        else:
+            self._tx_buffer.extend(data)
+
+
+    def _flush_tx_buffer(self):
+        """ Write as much buffered data as possible without blocking
+        """
+        try:
+            written = os.write(self._fd, bytes(self._tx_buffer))
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            written = 0
+        del self._tx_buffer[:written]
+
+
+    def _write_async(self):
+        """ Called by the event loop when the serial device is writable and some data is buffered
+        """
+        try:
+            self._flush_tx_buffer()
+        except OSError:
+            error = "Error while writing rfxcom device (disconnected ?) : %s" % traceback.format_exc()
+            self.log.error(error)
+            del self._tx_buffer[:]
+        if not self._tx_buffer and self._fd != None:
+            self.loop.remove_writer(self._fd)
 
 
     def listen(self, stop):
@@ -389,120 +2075,475 @@ class Rfxcom:
         self.log.info("**** Start really using RFXCOM ****")
         self.log.info("Start listening to the rfxcom device")
         # infinite
+        while not stop.isSet():
+            try:
+                while not stop.isSet():
+                    self.read()
+            except (serial.SerialException, OSError, IOError):
+                error = "Error while reading rfxcom device (disconnected ?) : %s" % traceback.format_exc()
+                self.log.error(error)
+                self.reconnect(stop)
+        if self.capture != None:
+            self.capture.flush()
+
+
+    def reconnect(self, stop):
+        """ Open the RFXCOM again after a disconnection (USB unplug, serial error)
+            The device is opened with the startup handshake (see open), with a capped exponential backoff between
+            the tries (RECONNECT_DELAY to RECONNECT_DELAY_MAX). Meanwhile, no command is sent : the queued commands
+            and the ones waiting for their acknowledge are kept and sent once reconnected (if their deadline is not
+            reached). The time until the first received packet is reported (see _first_packet)
+            @param stop : an Event to wait for stop request
+            @return : True if reconnected, False if stopped before
+        """
+        disconnected_at = self._disconnect()
+        reopened = self._reopen(stop)
+        if reopened is None:
+            return False
+        self._reconnected(disconnected_at, *reopened)
+        return True
+
+
+    def _disconnect(self):
+        """ Stop sending the commands and close the device after a disconnection (see reconnect)
+            @return : monotonic time of the disconnection
+        """
+        self._disconnected = True
+        self.stats["disconnects"] += 1
+        self._close_quietly()
+        return monotonic()
+
+
+    def _reopen(self, stop):
+        """ Try to open the device until it works, with a growing delay between the tries (see reconnect)
+            Only the device and its handshake are handled here : the transmit state is updated by _reconnected
+            @param stop : an Event to wait for stop request
+            @return : (start time of the successful try, number of tries), None if stopped before
+        """
+        delay = RECONNECT_DELAY
+        tries = 0
+        while not stop.isSet():
+            stop.wait(delay)
+            if stop.isSet():
+                break
+            tries += 1
+            start = monotonic()
+            try:
+                self.open()
+            except RfxcomException as e:
+                self._close_quietly()
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+                self.log.warning("Reconnection try {0} to the RFXCOM failed, next try in {1} s".format(tries, delay))
+                self.log.debug("Reconnection error : {0}".format(e.value))
+                continue
+            return (start, tries)
+        return None
+
+
+    def _reconnected(self, disconnected_at, start, tries):
+        """ Send the commands again once the device is opened again (see reconnect)
+            With an event loop, this is called on the loop (see _reconnected_async)
+            @param disconnected_at : monotonic time of the disconnection
+            @param start : start time of the successful try
+            @param tries : number of tries
+        """
+        del self._tx_buffer[:]
+        self._reopened_at = start
+        self._tx_requeue = True
+        self._disconnected = False
+        self.stats["reconnects"] += 1
+        self.log.info("RFXCOM reconnected after {0:.1f} s ({1} tries, open and handshake in {2:.0f} ms)".format(
+                      monotonic() - disconnected_at, tries, (monotonic() - start) * 1000))
+        self._tx_notify()
+
+
+    def _close_quietly(self):
+        """ Close the serial device, ignoring the errors (the device may be already gone)
+        """
         try:
-            while not stop.isSet():
-                self.read()
-        except serial.SerialException:
-            error = "Error while reading rfxcom device (disconnected ?) : %s" % traceback.format_exc()
-            self.log.error(error)
-            # TODO : raise for using self.force_leave() in bin ?
-            return
+            self.rfxcom.close()
+        except:
+            pass
+
+
+    def _first_packet(self):
+        """ Report the time between the last reconnection and the first received packet
+        """
+        elapsed = monotonic() - self._reopened_at
+        self._reopened_at = None
+        self.stats["reconnect_first_packet"] = elapsed
+        self.log.info("First packet received {0:.0f} ms after the reconnection".format(elapsed * 1000))
 
     def read(self):
         """ Read Rfxcom device once
-            Wait for a byte. It will give message's length
-            Then, read message
+            Read all the available bytes (or wait for at least one of them)
+            Then, process all the complete packets available in the receive buffer
         """
-        # We wait for a message (and its size)
-        #self.log.debug("**** Waiting for a packet from the RFXCOM ****")
-        data_len = self.rfxcom.read()
+        if self.stats_period > 0:
+            now = monotonic()
+            if self._rates is None or now - self._rates["time"] >= self.stats_period:
+                self.report_rates(now)
 
         # if timeout is reached for reading, don't process the rest of the function
         # there is a timeout set in order to allow the plugin to shutdown correctly
-        if data_len == "":
+        if self._fill_rx_buffer() == 0:
             return
 
-        self.log.debug("**** New packet received ****")
-        hex_data_len = binascii.hexlify(data_len)
-        int_data_len = int(hex_data_len, 16)
-        self.log.debug("Packet length = %s" % int_data_len)
-        # the max length of a valid message is for :
-        # 0x03: Undecoded RF Message
-        # it is 36
-        if int_data_len > 37:
-            self.log.error("It seems that bad data has been received! Length = {0}".format(int_data_len))
-            # we skip the next steps in order no to block the plugin
-            # but as we skip and don't know what is behind, the next byte will be read as a length and so, some
-            # bad data may be processed as valid data and some errors may occurs
+        self._debug = self.log.isEnabledFor(logging.DEBUG)
+        packet = self._next_packet()
+        while packet is not None:
+            if self._debug:
+                self.log.debug("Packet data = %s" % binascii.hexlify(packet))
+            if self.capture != None:
+                self.capture.write(self.receiver_id, packet)
+
+            # Process data
+            if self.merger != None and packet[0] >= 0x10:
+                self.merger.put(self.rfxcom_device, packet)
+            else:
+                self.process_packet(packet)
+            if self._reopened_at is not None:
+                self._first_packet()
+            packet = self._next_packet()
+
+
+    def process_packet(self, packet):
+        """ Process a received packet, unless it is a duplicate
+            @param packet : packet (without the length byte) as a bytearray
+        """
+        if not self._is_duplicate(packet):
+            self._process_received_data(packet)
+        elif self.packet_trace:
+            self.trace_packet(packet, {"duplicate" : True})
+
+
+    def report_rates(self, now):
+        """ Log the receive rates and the cpu use of the process since the previous call, then start a new period
+            The rates of the last period are kept in self.stats["rates"]
+            @param now : monotonic time
+        """
+        counters = {"time" : now,
+                    "cpu" : cpu_time(),
+                    "packets" : self.stats["packets"],
+                    "unknown" : sum(self.stats["unknown"].values()),
+                    "duplicates" : self.stats["duplicates"]}
+        previous = self._rates
+        self._rates = counters
+        if previous is None or now <= previous["time"]:
             return
+        elapsed = now - previous["time"]
+        rates = {}
+        for key in ("packets", "unknown", "duplicates"):
+            rates[key] = (counters[key] - previous[key]) / elapsed
+        rates["cpu"] = (counters["cpu"] - previous["cpu"]) / elapsed * 100
+        self.stats["rates"] = rates
+        self.log.info("Received over the last {0:.0f} s : {1:.3f} packets/s ({2:.3f} not handled, {3:.3f} duplicates), cpu {4:.2f}%".format(
+                      elapsed, rates["packets"], rates["unknown"], rates["duplicates"], rates["cpu"]))
+
+
+    def _bytes_waiting(self):
+        """ Return the number of bytes waiting in the serial device input buffer
+            The fake device may not be able to tell it : in this case, 0 is returned
+        """
+        try:
+            return self.rfxcom.inWaiting()
+        except AttributeError:
+            return 0
 
-        if int_data_len != 0:
-            # We read data
-            data = self.rfxcom.read(int_data_len)
-            hex_data = binascii.hexlify(data)
-            self.log.debug("Packet data = %s" % hex_data)
 
-            # Process data
-            self._process_received_data(hex_data)
+    def _fill_rx_buffer(self):
+        """ Read the serial device and append the read bytes to the receive buffer
+            All the bytes already waiting are read in one call. If there is none, we block (until the serial
+            timeout) for the bytes missing to complete the current packet, which is usually the length byte
+            when the line is idle.
+            @return : number of bytes read
+        """
+        size = self._bytes_waiting()
+        if size == 0:
+            size = self._rx_needed
+        data = self.rfxcom.read(size)
+        self._rx_buffer.extend(data)
+        return len(data)
+
+
+    def _next_packet(self):
+        """ Extract the next complete packet from the receive buffer
+
+            Each candidate packet is checked against the valid lengths and subtypes of its type. If it doesn't
+            match, the length byte is considered as bad data (noise on startup, lost byte, ...) : it is skipped
+            and the next byte is tried as a length until a plausible packet is found.
+            When the bytes following a complete candidate packet can't be the start of a packet, the candidate
+            may be a truncated packet which has swallowed the beginning of the next one : the stream is
+            resynchronized on a packet starting inside it only if this one is fully valid (see strong_header).
+            A noise byte after a good packet doesn't make it lost for a packet of an unknown type found inside it.
+
+            @return : the packet data (without the length byte) as a bytearray or None if no complete packet is available
+        """
+        buf = self._rx_buffer
+        pos = self._rx_pos
+        end = len(buf)
+        discarded = 0
+        packet = None
+        while pos < end:
+            if not valid_header(buf, pos, end):
+                pos += 1
+                discarded += 1
+                continue
+            length = buf[pos]
+            if end - pos <= length:
+                # incomplete packet : wait for the missing bytes
+                break
+            next_pos = pos + 1 + length
+            if next_pos < end and not valid_header(buf, next_pos, end):
+                inner_pos = pos + 1
+                while inner_pos < next_pos and not strong_header(buf, inner_pos, end):
+                    inner_pos += 1
+                if inner_pos < next_pos:
+                    discarded += inner_pos - pos
+                    pos = inner_pos
+                    continue
+            packet = buf[pos + 1:next_pos]
+            pos = next_pos
+            self.stats["packets"] += 1
+            if self._debug:
+                self.log.debug("**** New packet received ****")
+                self.log.debug("Packet length = %s" % length)
+            break
+
+        if discarded > 0:
+            self.stats["discarded_bytes"] += discarded
+            self.stats["resync"] += 1
+            self.log.warning("It seems that bad data has been received! {0} byte(s) skipped to find a valid packet (total : {1})".format(discarded, self.stats["discarded_bytes"]))
+
+        # compact the buffer to keep it (and its memory) reusable
+        if pos == end:
+            del buf[:]
+            pos = 0
+            self._rx_needed = 1
+        else:
+            if pos >= RX_BUFFER_COMPACT_SIZE:
+                del buf[:pos]
+                pos = 0
+            if packet is None:
+                self._rx_needed = buf[pos] + 1 - (len(buf) - pos)
+        self._rx_pos = pos
+        return packet
+
+
+    def _is_duplicate(self, packet):
+        """ Check if a packet is a copy of a packet received less than duplicate_window seconds before
+            Most of the RF sensors send each reading several times in a burst. The seqnbr and the rssi
+            are not taken into account. The interface messages (types < 0x10) are never duplicates.
+            @param packet : packet read (without the length byte) as a bytearray
+        """
+        if self.duplicate_window <= 0 or packet[0] < 0x10:
+            return False
+        now = monotonic()
+        seen = self._seen
+        seen_order = self._seen_order
+        while seen_order and now - seen_order[0][0] > self.duplicate_window:
+            (seen_time, key) = seen_order.popleft()
+            if seen.get(key) == seen_time:
+                del seen[key]
+        key = duplicate_key(packet)
+        if key in seen:
+            self.stats["duplicates"] += 1
+            return True
+        seen[key] = now
+        seen_order.append((now, key))
+        return False
 
 
     def _process_received_data(self, data):
         """ Process RFXCOM data
-            @param data : data read
+            @param data : packet read (without the length byte) as a bytearray
         """
-        type = data[0] + data[1]
-        self.log.debug("Packet type = %s" % type)
+        type = data[0]
+        if self._debug:
+            self.log.debug("Packet type = %02x" % type)
         try:
-            eval("self._process_%s('%s')" % (type, data))
-        except AttributeError:
-            warning = "No function for type '%s' with data : '%s'. It may be not yet implemented in the plugin. Full trace : %s" % (type, data, traceback.format_exc())
-            self.log.warning(warning)
+            self._handlers[type](data)
         except:
-            error = "Error while processing type %s : %s" % (type, traceback.format_exc())
+            error = "Error while processing type %02x with data '%s' : %s" % (type, binascii.hexlify(data), traceback.format_exc())
             self.log.error(error)
 
 
+    def _process_02(self, data):
+        """ Receiver/Transmitter Message : response of the RFXCOM to a command
+            The response is given to the write thread
+
+            Type : rfxcom responses
+            SDK version : 4.8
+        """
+        fields = PACKET_DECODERS[0x02](data)
+        if self.packet_trace:
+            self.trace_packet(data, fields)
+        if fields["subtype"] == 0x00:
+            self.log.error("Error message from the RFXCOM : the receiver did not lock")
+            return
+        response = TRANSMITTER_RESPONSES.get(fields["message"])
+        if response is None:
+            self.log.warning("Bad response from RFXCOM : %s" % binascii.hexlify(data))
+            return
+        (status, retry, message) = response
+        if self._debug:
+            self.log.debug("Response for the command {0} : {1}".format(fields["seqnbr"], message))
+        self.rfx_response.put_nowait({"seqnbr" : fields["seqnbr"],
+                                      "status" : status,
+                                      "retry" : retry,
+                                      "message" : message})
+        self._tx_notify()
+
+
+    def _process_unknown(self, data):
+        """ Process the packets whose type is not handled by the plugin : they are only counted
+            @param data : packet read (without the length byte) as a bytearray
+        """
+        type = data[0]
+        count = self.stats["unknown"].get(type, 0) + 1
+        self.stats["unknown"][type] = count
+        if count == 1:
+            warning = "No function for type '%02x' with data : '%s'. It may be not yet implemented in the plugin. The next packets of this type will only be counted" % (type, binascii.hexlify(data))
+            self.log.warning(warning)
+        if self.packet_trace:
+            self.trace_packet(data, {"unknown" : True})
+
+
+    def set_packet_trace(self, enabled):
+        """ Enable or disable the packet trace : a compact record of each packet (raw data and decoded fields) logged
+            at the info level. It can be switched at any time, the debug level doesn't need to be enabled.
+            @param enabled : True to enable the trace
+        """
+        self.log.info("Packet trace {0}".format("enabled" if enabled else "disabled"))
+        self.packet_trace = enabled
+
+
+    def trace_packet(self, packet, fields, **extra):
+        """ Log the trace record of a packet : one line with the raw packet and the decoded fields
+            @param packet : packet (without the length byte) as a bytearray
+            @param fields : decoded fields
+            @param extra : other decoded informations (address, ...)
+        """
+        values = dict(fields)
+        values.update(extra)
+        self.log.info("TRACE %s %s" % (binascii.hexlify(packet), " ".join("%s=%s" % (key, values[key]) for key in sorted(values))))
+
+
+    def send_xpl_batch(self, messages):
+        """ Send all the xpl messages built from a packet
+            @param messages : list of (schema, data)
+        """
+        if self._deadbands:
+            messages = self._filter_readings(messages)
+            if not messages:
+                return
+        if self.merge_readings:
+            messages = merge_readings(messages)
+        if self.cb_send_xpl_batch != None:
+            self.cb_send_xpl_batch(messages)
+        else:
+            for (schema, data) in messages:
+                self.cb_send_xpl(schema = schema, data = data)
+
+
+    def _filter_readings(self, messages):
+        """ Remove the sensor.basic values which haven't changed by more than their deadband since the last sent
+            value, unless nothing has been sent for more than the heartbeat delay
+            @param messages : list of (schema, data)
+            @return : list of (schema, data) to send
+        """
+        now = monotonic()
+        published = []
+        for (schema, data) in messages:
+            if schema == "sensor.basic" and data["type"] in self._deadbands:
+                key = (data["device"], data["type"])
+                value = data["current"]
+                last = self._last_values.get(key)
+                if last != None and (self.heartbeat <= 0 or now - last[1] < self.heartbeat) \
+                   and not value_changed(last[0], value, self._deadbands[data["type"]]):
+                    self.stats["filtered"] += 1
+                    continue
+                self._last_values[key] = (value, now)
+            published.append((schema, data))
+        return published
+
+
+    def add_known_device(self, device_type, address):
+        """ Declare a device already created in Domogik : it will never be announced as detected
+            @param device_type : device type (ex : rfxcom.temperature_humidity)
+            @param address : device address (ex : th1 0x2504)
+        """
+        self._known_devices.add((device_type, address))
+
+
+    def device_detected(self, device_type, features, address, reference):
+        """ Announce the features of a detected device
+            A feature is announced only the first time it is seen, when the device reference changes or
+            after detection_refresh seconds. The devices already created in Domogik are not announced.
+            @param device_type : device type (ex : rfxcom.temperature_humidity)
+            @param features : list of the device features
+            @param address : device address
+            @param reference : device model
+        """
+        if (device_type, address) in self._known_devices:
+            return
+        now = monotonic()
+        for feature in features:
+            key = (device_type, address, feature)
+            last = self._detected.get(key)
+            if last != None and last[0] == reference and (self.detection_refresh <= 0 or now - last[1] < self.detection_refresh):
+                continue
+            self._detected[key] = (reference, now)
+            self.cb_device_detected(device_type = device_type,
+                                    type = "xpl_stats",
+                                    feature = feature,
+                                    data = {"device" : address,
+                                            "reference" : reference})
+
+
     def decode_status(self, data):
         """ Decode the status message and disply informations about it in the logs
-            @param data : status message
-        """
-        subtype = gh(data, 1)
-        seqnbr = gh(data, 2)
-        cmnd = gh(data, 3)
-        msg1 = ghexa(data, 4)
-        msg2 = gh(data, 5)
-        msg3 = gb(data, 6)
-        msg4 = gb(data, 7)
-        msg5 = gb(data, 8)
-        msg6 = gh(data, 9)
-        msg7 = gh(data, 10)
-        msg8 = gh(data, 11)
-        msg9 = gh(data, 12)
+            @param data : status message (without the length byte) as a bytearray
+        """
+        (type, subtype, seqnbr, cmnd, msg1, msg2, msg3, msg4, msg5, msg6, msg7, msg8, msg9) = STRUCT_STATUS.unpack_from(data)
 
         # receiver/transceiver type
-        self.log.info("- Receiver/transceiver type : {0} - {1}".format(msg1, RECEIVER_TRANSCEIVER[msg1]))
+        self.log.info("- Receiver/transceiver type : 0x{0:02x} - {1}".format(msg1, RECEIVER_TRANSCEIVER[msg1]))
+        if self.pacer != None and DUTY_CYCLES.get(msg1) != None:
+            self.pacer.duty_cycle = DUTY_CYCLES[msg1]
+            self.log.info("- Transmit duty cycle limit : {0}%".format(DUTY_CYCLES[msg1] * 100))
         # firmware version
-        self.log.info("- Firmware version : 0x{0} - {1}".format(msg2, int(msg2, 16)))
+        self.log.info("- Firmware version : 0x{0:02x} - {0}".format(msg2))
         # enabled protocoles
-        self.log.debug("- Protocol (raw) > msg3 : {0}".format(msg3))
-        self.log.info("- Protocol > Enable display of undecoded : {0}".format(get_bit(msg3, 7)))
-        self.log.info("- Protocol > RFU6                        : {0}".format(get_bit(msg3, 6)))
-        self.log.info("- Protocol > RFU5                        : {0}".format(get_bit(msg3, 5)))
-        self.log.info("- Protocol > RSL                         : {0}".format(get_bit(msg3, 4)))
-        self.log.info("- Protocol > Lighting4                   : {0}".format(get_bit(msg3, 3)))
-        self.log.info("- Protocol > FineOffset/Viking           : {0}".format(get_bit(msg3, 2)))
-        self.log.info("- Protocol > Rubicson                    : {0}".format(get_bit(msg3, 1)))
-        self.log.info("- Protocol > AE Blyss                    : {0}".format(get_bit(msg3, 0)))
-
-        self.log.debug("- Protocol (raw) > msg4 : {0}".format(msg4))
-        self.log.info("- Protocol > BlindsT1                    : {0}".format(get_bit(msg4, 7)))
-        self.log.info("- Protocol > BlindsT0                    : {0}".format(get_bit(msg4, 6)))
-        self.log.info("- Protocol > ProGuard                    : {0}".format(get_bit(msg4, 5)))
-        self.log.info("- Protocol > FS20                        : {0}".format(get_bit(msg4, 4)))
-        self.log.info("- Protocol > La Crosse                   : {0}".format(get_bit(msg4, 3)))
-        self.log.info("- Protocol > Hideki/UPM                  : {0}".format(get_bit(msg4, 2)))
-        self.log.info("- Protocol > AD LightwaveRF              : {0}".format(get_bit(msg4, 1)))
-        self.log.info("- Protocol > Mertik                      : {0}".format(get_bit(msg4, 0)))
-
-        self.log.debug("- Protocol (raw) > msg5 : {0}".format(msg5))
-        self.log.info("- Protocol > Visonic                     : {0}".format(get_bit(msg5, 7)))
-        self.log.info("- Protocol > ATI                         : {0}".format(get_bit(msg5, 6)))
-        self.log.info("- Protocol > Oregon Scientific           : {0}".format(get_bit(msg5, 5)))
-        self.log.info("- Protocol > Meiantech                   : {0}".format(get_bit(msg5, 4)))
-        self.log.info("- Protocol > HomeEasy EU                 : {0}".format(get_bit(msg5, 3)))
-        self.log.info("- Protocol > AC                          : {0}".format(get_bit(msg5, 2)))
-        self.log.info("- Protocol > ARC                         : {0}".format(get_bit(msg5, 1)))
-        self.log.info("- Protocol > X10                         : {0}".format(get_bit(msg5, 0)))
+        self.log.debug("- Protocol (raw) > msg3 : {0:08b}".format(msg3))
+        self.log.info("- Protocol > Enable display of undecoded : {0}".format(msg3 >> 7 & 1))
+        self.log.info("- Protocol > RFU6                        : {0}".format(msg3 >> 6 & 1))
+        self.log.info("- Protocol > RFU5                        : {0}".format(msg3 >> 5 & 1))
+        self.log.info("- Protocol > RSL                         : {0}".format(msg3 >> 4 & 1))
+        self.log.info("- Protocol > Lighting4                   : {0}".format(msg3 >> 3 & 1))
+        self.log.info("- Protocol > FineOffset/Viking           : {0}".format(msg3 >> 2 & 1))
+        self.log.info("- Protocol > Rubicson                    : {0}".format(msg3 >> 1 & 1))
+        self.log.info("- Protocol > AE Blyss                    : {0}".format(msg3 & 1))
+
+        self.log.debug("- Protocol (raw) > msg4 : {0:08b}".format(msg4))
+        self.log.info("- Protocol > BlindsT1                    : {0}".format(msg4 >> 7 & 1))
+        self.log.info("- Protocol > BlindsT0                    : {0}".format(msg4 >> 6 & 1))
+        self.log.info("- Protocol > ProGuard                    : {0}".format(msg4 >> 5 & 1))
+        self.log.info("- Protocol > FS20                        : {0}".format(msg4 >> 4 & 1))
+        self.log.info("- Protocol > La Crosse                   : {0}".format(msg4 >> 3 & 1))
+        self.log.info("- Protocol > Hideki/UPM                  : {0}".format(msg4 >> 2 & 1))
+        self.log.info("- Protocol > AD LightwaveRF              : {0}".format(msg4 >> 1 & 1))
+        self.log.info("- Protocol > Mertik                      : {0}".format(msg4 & 1))
+
+        self.log.debug("- Protocol (raw) > msg5 : {0:08b}".format(msg5))
+        self.log.info("- Protocol > Visonic                     : {0}".format(msg5 >> 7 & 1))
+        self.log.info("- Protocol > ATI                         : {0}".format(msg5 >> 6 & 1))
+        self.log.info("- Protocol > Oregon Scientific           : {0}".format(msg5 >> 5 & 1))
+        self.log.info("- Protocol > Meiantech                   : {0}".format(msg5 >> 4 & 1))
+        self.log.info("- Protocol > HomeEasy EU                 : {0}".format(msg5 >> 3 & 1))
+        self.log.info("- Protocol > AC                          : {0}".format(msg5 >> 2 & 1))
+        self.log.info("- Protocol > ARC                         : {0}".format(msg5 >> 1 & 1))
+        self.log.info("- Protocol > X10                         : {0}".format(msg5 & 1))
 
 
     def _process_20(self, data):
@@ -512,43 +2553,41 @@ class Rfxcom:
             SDK version : 4.12
             Tested : No
         """
-        COMMAND = {"00" : "normal",
-                   "01" : "normal-delayed",
-                   "02" : "alert",
-                   "03" : "alert-delayed",
-                   "04" : "motion",
-                   "05" : "motion-delayed",
-                   "06" : "panic",
-                   "07" : "end-panic",
-                   "08" : "tamper",
-                   "09" : "arm-away",
-                   "0a" : "arm-away-delayed",
-                   "0b" : "arm-home",
-                   "0c" : "arm-home-delayed",
-                   "0d" : "disarm",
+        COMMAND = {0x00 : "normal",
+                   0x01 : "normal-delayed",
+                   0x02 : "alert",
+                   0x03 : "alert-delayed",
+                   0x04 : "motion",
+                   0x05 : "motion-delayed",
+                   0x06 : "panic",
+                   0x07 : "end-panic",
+                   0x08 : "tamper",
+                   0x09 : "arm-away",
+                   0x0A : "arm-away-delayed",
+                   0x0B : "arm-home",
+                   0x0C : "arm-home-delayed",
+                   0x0D : "disarm",
                    # like for the RFXCOM Lan xPL, the lights-on|off command will only command the light1
-                   "10" : "lights-off",   # light 1
-                   "11" : "lights-on",
-                   "12" : "lights-off",   # light 2
-                   "13" : "lights-on",
-                   "14" : "dark-detected",
-                   "15" : "light-detected",
-                   "16" : "battery-low",
-                   "17" : "pair-kd101",
-                   "80" : "normal-tamper",
-                   "81" : "normal-delayed-tamper",
-                   "82" : "alert-tamper",
-                   "83" : "alert-delayed-tamper",
-                   "84" : "motion-tamper",
-                   "85" : "motion-delayed-tamper",                  }
+                   0x10 : "lights-off",   # light 1
+                   0x11 : "lights-on",
+                   0x12 : "lights-off",   # light 2
+                   0x13 : "lights-on",
+                   0x14 : "dark-detected",
+                   0x15 : "light-detected",
+                   0x16 : "battery-low",
+                   0x17 : "pair-kd101",
+                   0x80 : "normal-tamper",
+                   0x81 : "normal-delayed-tamper",
+                   0x82 : "alert-tamper",
+                   0x83 : "alert-delayed-tamper",
+                   0x84 : "motion-tamper",
+                   0x85 : "motion-delayed-tamper",                  }
 
         options = {}
-        subtype = gh(data, 1)
-        seqnbr = gh(data, 2)
-        id = gh(data, 3,3)
-        address = "0x%s" %(id)
+        fields = PACKET_DECODERS[0x20](data)
+        address = "0x%06x" % fields["id"]
 
-        status = COMMAND[gh(data, 6)]
+        status = COMMAND[fields["status"]]
         
         if status[-7:] == "-tamper":
             cmnd = "alert"
@@ -567,206 +2606,384 @@ class Rfxcom:
             cmnd = "alert"
             options["tamper"] = "true"
   
-        battery = int(gh(data, 7)[0], 16) * 10  # percent
-        rssi = int(gh(data, 7)[1], 16) * 100/16 # percent
+        battery = fields["battery"]  # percent
+        rssi = fields["rssi"]  # percent
         
-        model = "{0}".format(TYPE_20_MODELS["0x{0}".format(subtype)])
+        model = TYPE_20_MODELS[fields["subtype"]]
         
-        self.log.debug("Packet informations :")
-        self.log.debug("- type 20 : Security1")
-        self.log.debug("- address = {0}".format(address))
-        self.log.debug("- command = {0}".format(cmnd))
-        self.log.debug("- options = {0}".format(','.join(['%s:%s' % (key, value) for (key, value) in options.items()])))
-        self.log.debug("- battery = {0}".format(battery))
-        self.log.debug("- rssi = {0}".format(rssi))
+        if self._debug:
+            self.log.debug("Packet informations :")
+            self.log.debug("- type 20 : Security1")
+            self.log.debug("- address = {0}".format(address))
+            self.log.debug("- command = {0}".format(cmnd))
+            self.log.debug("- options = {0}".format(','.join(['%s:%s' % (key, value) for (key, value) in options.items()])))
+            self.log.debug("- battery = {0}".format(battery))
+            self.log.debug("- rssi = {0}".format(rssi))
+        if self.packet_trace:
+            self.trace_packet(data, fields, address = address, command = cmnd)
         msg = {"device"  : address,
                "command" : cmnd}
         msg.update(options)
-        self.cb_send_xpl(schema = "x10.security",
-                         data = msg)
-
-        self.cb_send_xpl(schema = "sensor.basic",
-                         data = {"device"  : address,
-                                 "type"    : "battery",
-                                 "current" : battery})
-
-        self.cb_send_xpl(schema = "sensor.basic",
-                         data = {"device"  : address,
-                                 "type"    : "rssi",
-                                 "current" : rssi})
-
-        for feature in ['Security1']:
-            self.cb_device_detected(device_type = "rfxcom.security",
-                                    type = "xpl_stats",
-                                    feature = feature,
-                                    data = {"device" : address,
-                                            "reference" : model})
+        self.send_xpl_batch([("x10.security", msg),
+                             ("sensor.basic", {"device"  : address,
+                                               "type"    : "battery",
+                                               "current" : battery}),
+                             ("sensor.basic", {"device"  : address,
+                                               "type"    : "rssi",
+                                               "current" : rssi})])
+
+        self.device_detected("rfxcom.security", ['Security1'], address, model)
         return
 
     def _process_50(self, data):
         """ Temperature sensors
             Last update : 1.68
         """
-        subtype = gh(data, 1)
-        seqnbr = gh(data, 2)
-        id = gh(data, 3,2)
-        address = "temp%s 0x%s" %(subtype[1], id)
-
-        temp_high = gh(data, 5)
-        temp_high_bin = gb(data, 5)
-        temp_low = gh(data, 6)
-
-        sign = get_bit(temp_high_bin, 7)
-        # first bit = 1 => sign = "-"
-        if sign == "1":
-            # we remove the left bit of temp_high
-            temp_high_dec = int(get_bit(temp_high_bin, 6, 7), 2)
-            temp = - float((int(temp_low, 16) + 256*temp_high_dec))/10
-        # first bit = 0 => sign = "+"
-        else:
-            temp = float((int(temp_high, 16) * 256 + int(temp_low, 16)))/10
+        fields = PACKET_DECODERS[0x50](data)
+        subtype = fields["subtype"]
+        address = "temp%x 0x%04x" % (subtype & 0x0F, fields["id"])
+        temp = fields["temperature"]
+        rssi = fields["rssi"]  # percent
+        battery = fields["battery"]  # percent
 
-        rssi = int(gh(data, 7)[0], 16) * 100/16 # percent
-        battery = (1+int(gh(data, 7)[1], 16)) * 10  # percent
-
-        model = "{0}".format(TYPE_50_MODELS["0x{0}".format(subtype)])
+        model = TYPE_50_MODELS[subtype]
+        if self.packet_trace:
+            self.trace_packet(data, fields, address = address)
 
         # debug informations
-        self.log.debug("Packet informations :")
-        self.log.debug("- type 50 : temperature sensor")
-        self.log.debug("- address = {0}".format(address))
-        self.log.debug("- model = {0}".format(model))
-        self.log.debug("- temperature = {0}".format(temp))
-        self.log.debug("- battery = {0}".format(battery))
-        self.log.debug("- rssi = {0}".format(rssi))
+        if self._debug:
+            self.log.debug("Packet informations :")
+            self.log.debug("- type 50 : temperature sensor")
+            self.log.debug("- address = {0}".format(address))
+            self.log.debug("- model = {0}".format(model))
+            self.log.debug("- temperature = {0}".format(temp))
+            self.log.debug("- battery = {0}".format(battery))
+            self.log.debug("- rssi = {0}".format(rssi))
  
         # send xPL
-        self.cb_send_xpl(schema = "sensor.basic",
-                         data = {"device" : address,
-                                 "type" : "temp",
-                                 "current" : temp,
-                                 "units" : "c"})
-        self.cb_send_xpl(schema = "sensor.basic",
-                         data = {"device" : address,
-                                 "type" : "battery",
-                                 "current" : battery})
-        self.cb_send_xpl(schema = "sensor.basic",
-                         data = {"device" : address,
-                                 "type" : "rssi",
-                                 "current" : rssi})
+        self.send_xpl_batch([("sensor.basic", {"device" : address,
+                                               "type" : "temp",
+                                               "current" : temp,
+                                               "units" : "c"}),
+                             ("sensor.basic", {"device" : address,
+                                               "type" : "battery",
+                                               "current" : battery}),
+                             ("sensor.basic", {"device" : address,
+                                               "type" : "rssi",
+                                               "current" : rssi})])
 
         # handle device features detection
-        for feature in ['temperature']:
-            self.cb_device_detected(device_type = "rfxcom.temperature", 
-                                    type = "xpl_stats",
-                                    feature = feature,
-                                    data = {"device" : address,
-                                            "reference" : model})
+        self.device_detected("rfxcom.temperature", ['temperature'], address, model)
 
     def _process_52(self, data):
         """ Temperature and humidity sensors
             Last update : 1.68
         """
-        subtype = gh(data, 1)
-        seqnbr = gh(data, 2)
-        id = gh(data, 3,2)
-        address = "th%s 0x%s" %(subtype[1], id)
-        temp_high = gh(data, 5)
-        temp_high_bin = gb(data, 5)
-        temp_low = gh(data, 6)
-        
-        sign = get_bit(temp_high_bin, 7)
-        # first bit = 1 => sign = "-"
-        if sign == "1":
-            # we remove the left bit of temp_high
-            temp_high_dec = int(get_bit(temp_high_bin, 6, 7), 2)
-            temp = - float((int(temp_low, 16) + 256*temp_high_dec))/10
-        # first bit = 0 => sign = "+"
-        else:
-            temp = float((int(temp_high, 16) * 256 + int(temp_low, 16)))/10
-            
-        humidity = int(gh(data, 7), 16) 
-        humidity_status_code = ghexa(data, 8)
-        humidity_status = TYPE_52_HUMIDITY_STATUS[humidity_status_code]
-        rssi = int(gh(data, 9)[0], 16) * 100/16 # percent
-        battery = (1+int(gh(data, 9)[1], 16)) * 10  # percent
+        fields = PACKET_DECODERS[0x52](data)
+        subtype = fields["subtype"]
+        address = "th%x 0x%04x" % (subtype & 0x0F, fields["id"])
+        temp = fields["temperature"]
+        humidity = fields["humidity"]
+        humidity_status = TYPE_52_HUMIDITY_STATUS[fields["humidity_status"]]
+        rssi = fields["rssi"]  # percent
+        battery = fields["battery"]  # percent
  
-        model = "{0}".format(TYPE_52_MODELS["0x{0}".format(subtype)])
+        model = TYPE_52_MODELS[subtype]
+        if self.packet_trace:
+            self.trace_packet(data, fields, address = address)
 
         # debug informations
-        self.log.debug("Packet informations :")
-        self.log.debug("- type 52 : temperature and humidity sensor")
-        self.log.debug("- address = {0}".format(address))
-        self.log.debug("- model = {0}".format(TYPE_52_MODELS["0x{0}".format(subtype)]))
-        self.log.debug("- temperature = {0}".format(temp))
-        self.log.debug("- humidity = {0}".format(humidity))
-        self.log.debug("- humidity status = {0}".format(humidity_status))
-        self.log.debug("- battery = {0}".format(battery))
-        self.log.debug("- rssi = {0}".format(rssi))
+        if self._debug:
+            self.log.debug("Packet informations :")
+            self.log.debug("- type 52 : temperature and humidity sensor")
+            self.log.debug("- address = {0}".format(address))
+            self.log.debug("- model = {0}".format(model))
+            self.log.debug("- temperature = {0}".format(temp))
+            self.log.debug("- humidity = {0}".format(humidity))
+            self.log.debug("- humidity status = {0}".format(humidity_status))
+            self.log.debug("- battery = {0}".format(battery))
+            self.log.debug("- rssi = {0}".format(rssi))
 
         # send xPL
-        self.cb_send_xpl(schema = "sensor.basic",
-                         data = {"device" : address, 
-                                 "type" : "temp", 
-                                 "current" : temp, 
-                                 "units" : "c"})
-        self.cb_send_xpl(schema = "sensor.basic",
-                         data = {"device" : address, 
-                                 "type" : "humidity", 
-                                 "current" : humidity, 
-                                 "description" : humidity_status})
-        self.cb_send_xpl(schema = "sensor.basic",
-                         data = {"device" : address, 
-                                 "type" : "status", 
-                                 "current" : humidity_status})
-        self.cb_send_xpl(schema = "sensor.basic",
-                         data = {"device" : address, 
-                                 "type" : "battery", 
-                                 "current" : battery})
-        self.cb_send_xpl(schema = "sensor.basic",
-                         data = {"device" : address, 
-                                 "type" : "rssi", 
-                                 "current" : rssi})
+        self.send_xpl_batch([("sensor.basic", {"device" : address, 
+                                               "type" : "temp", 
+                                               "current" : temp, 
+                                               "units" : "c"}),
+                             ("sensor.basic", {"device" : address, 
+                                               "type" : "humidity", 
+                                               "current" : humidity, 
+                                               "description" : humidity_status}),
+                             ("sensor.basic", {"device" : address, 
+                                               "type" : "status", 
+                                               "current" : humidity_status}),
+                             ("sensor.basic", {"device" : address, 
+                                               "type" : "battery", 
+                                               "current" : battery}),
+                             ("sensor.basic", {"device" : address, 
+                                               "type" : "rssi", 
+                                               "current" : rssi})])
 
         # handle device features detection
-        for feature in ['temperature', 'humidity']:
-            self.cb_device_detected(device_type = "rfxcom.temperature_humidity", 
-                                    type = "xpl_stats",
-                                    feature = feature,
-                                    data = {"device" : address,
-                                            "reference" : model})
+        self.device_detected("rfxcom.temperature_humidity", ['temperature', 'humidity'], address, model)
 
 
 
 
     
-def gh(data, num, len = 1):
-    """ Get byte n° <num> from data to byte n° <num + len> in hexadecimal without 0x....
+def command_code(table, command):
+    """ Return the code of a command
+        @param table : commands table
+        @param command : xPL command
     """
-    return data[num*2:(num+(len-1))*2+2]
+    try:
+        return table[command.lower()]
+    except KeyError:
+        raise RfxcomException("Unknown command : '{0}'".format(command))
 
-def ghexa(data, num, len = 1):
-    """ Get byte n° <num> from data to byte n° <num + len> in hexadecimal with 0x...
+def x10_address(address):
+    """ Split a x10 like address (ex : a1) in its housecode (ascii code of the letter) and unitcode
+    """
+    try:
+        housecode = ord(address[0].upper())
+        unitcode = int(address[1:])
+    except (IndexError, ValueError):
+        raise RfxcomException("Bad address : '{0}'".format(address))
+    if not ord("A") <= housecode <= ord("P") or not 1 <= unitcode <= 16:
+        raise RfxcomException("Bad address : '{0}'".format(address))
+    return (housecode, unitcode)
+
+def hexa_id(address, max_id):
+    """ Return the value of an hexadecimal id (ex : 0x123456)
+    """
+    try:
+        id = int(address, 16)
+    except ValueError:
+        raise RfxcomException("Bad address : '{0}'".format(address))
+    if not 0 <= id <= max_id:
+        raise RfxcomException("Bad address : '{0}'".format(address))
+    return id
+
+def lighting1_template(protocol, address):
+    """ Template of the Lighting1 commands for a device
+    """
+    try:
+        subtype = LIGHTING1_PROTOCOLS[protocol.lower()]
+    except KeyError:
+        raise RfxcomException("Unknown protocol : '{0}'".format(protocol))
+    (housecode, unitcode) = x10_address(address)
+    return STRUCT_LIGHTING1.pack(0x07, 0x10, subtype, 0, housecode, unitcode, 0, 0)
+
+def lighting2_template(eu, address, unit):
+    """ Template of the Lighting2 commands for a device
     """
-    return "0x" + data[num*2:(num+(len-1))*2+2]
+    return STRUCT_LIGHTING2.pack(0x0B, 0x11, 0x01 if eu else 0x00, 0, hexa_id(address, 0x03FFFFFF), int(unit), 0, 0, 0)
 
-def gb(data, num):
-    """ Get byte n° <num> from data to byte n° <num + len> in binary
+def lighting3_template(address):
+    """ Template of the Lighting3 commands for a device
     """
-    x = int(data[num*2:(num)*2+2], 16)
-    return ''.join(x & (1 << i) and '1' or '0' for i in range(7,-1,-1)) 
+    (system, channel) = x10_address(address)
+    if channel > 10:
+        raise RfxcomException("Bad address : '{0}'".format(address))
+    channel = 1 << (channel - 1)
+    return STRUCT_LIGHTING3.pack(0x08, 0x12, 0x00, 0, system - ord("A"), channel & 0xFF, channel >> 8, 0, 0)
+
+def lighting2_level(level):
+    """ Lighting2 level (0 to 15) for a level in percent
+    """
+    return max(0, min(int(level * 15 / 100.0 + 0.5), 15))
 
-def get_bit(bin_data, num, len = 1):
-    """ Get bit n° <num> from bin data to bin n° <num + len>
-        Return result in binary : 01010101
+def lighting3_level(level):
+    """ Lighting3 command code for a level in percent : off, level 1 to 9 or on
+    """
+    if level <= 0:
+        return LIGHTING3_COMMANDS["off"]
+    if level >= 100:
+        return LIGHTING3_COMMANDS["on"]
+    return LIGHTING3_COMMANDS["on"] + max(1, level // 10)
+
+def curtain1_template(address):
+    """ Template of the Curtain1 commands for a device
+    """
+    (housecode, unitcode) = x10_address(address)
+    return STRUCT_LIGHTING1.pack(0x07, 0x18, 0x00, 0, housecode, unitcode, 0, 0)
+
+def security1_template(address):
+    """ Template of the Security1 commands for a device
+        Notice from Bert : It does in fact make no difference which subtype is used for transmit. So it is possible
+        to use subtype = 0x00 (door/window sensor) and transmit a keyfob panic command. The RFXtrx will transmit a
+        correct keyfob panic. So to make it simple you can always use subtype=0x00 for an X10 sec command.
+    """
+    id = hexa_id(address, 0xFFFFFF)
+    return STRUCT_SECURITY1.pack(0x08, 0x20, 0x00, 0, id >> 16, id & 0xFFFF, 0, 0)
+
+def command_class(packet):
+    """ Return the priority class of a command, the unit it is sent to and its coalescing key
+        @param packet : command (without the length byte) as a bytearray
+        @return : (priority, unit key, coalescing key, group key). The unit key is None if the unit is not known (see
+                  COMMAND_OFFSETS). The coalescing key is None if the command must not be replaced by a newer one.
+                  The group key is the address of the units the group commands are sent to (see GROUP_COMMANDS),
+                  None if the type has no group commands. A group command has its group key as unit key
+    """
+    type = packet[0]
+    priority = PACKET_PRIORITIES.get(type, PRIORITY_SWITCHING)
+    offset = COMMAND_OFFSETS.get(type)
+    if offset is None or len(packet) <= offset:
+        return (priority, None, None, None)
+    unit = bytes(packet[0:2] + packet[3:offset])
+    command = packet[offset]
+    (relative, absolute) = DIM_COMMANDS.get(type, ((), ()))
+    group = None
+    if type in GROUP_COMMANDS:
+        group = bytes(packet[0:2] + packet[3:offset - 1])
+        if command in GROUP_COMMANDS[type]:
+            # never replaced : the commands of the units queued since would be sent before it
+            return (PRIORITY_DIMMING if command in absolute else priority, group, None, group)
+    if command in absolute:
+        return (PRIORITY_DIMMING, unit, unit, group)
+    if command in relative:
+        return (PRIORITY_DIMMING, unit, None, group)
+    if command in SWITCH_COMMANDS.get(type, ()):
+        return (priority, unit, unit, group)
+    return (priority, unit, None, group)
+
+def cpu_time():
+    """ Return the user + system cpu time of the process (seconds)
     """
-    # the 0 is on the right, the 7 is on the left
-    num = 7-num
-    return bin_data[num:(num+(len-1))+1]
+    times = os.times()
+    return times[0] + times[1]
 
-def hexa(bin_data):
-    """ Return hexadecimal value for bin data
-        This is a shorcut function
+def device_fileno(device):
+    """ Return the file descriptor of a device to watch it on an event loop
+        @param device : opened device (see transport.py)
+        @return : the file descriptor, None if the device has none (loopback and replay transports...)
     """
-    return hex(int(bin_data, 2))
-    
+    fileno = getattr(device, "fileno", None)
+    if fileno is None:
+        return None
+    try:
+        fd = fileno()
+    except (NotImplementedError, ValueError, IOError, OSError):
+        return None
+    if not isinstance(fd, int) or fd < 0:
+        return None
+    return fd
+
+def device_protocols(device_type, address):
+    """ Return the receiver protocols needed to receive a device
+        @param device_type : device type (ex : rfxcom.temperature_humidity)
+        @param address : device address (ex : th1 0x2504)
+        @return : list of protocol names (see RECEIVE_PROTOCOLS)
+    """
+    if device_type == "rfxcom.security":
+        return list(SECURITY_PROTOCOLS)
+    prefix = address.split(" ", 1)[0]
+    try:
+        if prefix[0:4] == "temp":
+            return [TYPE_50_PROTOCOLS[int(prefix[4:], 16)]]
+        if prefix[0:2] == "th":
+            return [TYPE_52_PROTOCOLS[int(prefix[2:], 16)]]
+    except (KeyError, ValueError):
+        pass
+    return []
+
+def packet_rssi(packet):
+    """ Return the raw rssi bits of a packet (the higher, the better), 0 if it has no rssi
+        @param packet : packet (without the length byte) as a bytearray
+    """
+    mask = RSSI_MASKS.get(packet[0])
+    if mask is None:
+        return 0
+    return packet[mask[0]] & ~mask[1] & 0xFF
+
+def retry_delay(tries):
+    """ Delay before sending a command again : capped exponential backoff with jitter
+        The jitter spreads the retries of several commands NAKed at once
+        @param tries : number of times the command has already been sent
+    """
+    delay = min(WAIT_BETWEEN_TRIES * 2 ** (tries - 1), WAIT_BETWEEN_TRIES_MAX)
+    return random.uniform(delay / 2.0, delay)
+
+def duplicate_key(packet):
+    """ Return the packet without its seqnbr and its rssi
+        @param packet : packet (without the length byte) as a bytearray
+    """
+    key = bytearray(packet)
+    key[2] = 0
+    mask = RSSI_MASKS.get(key[0])
+    if mask != None:
+        key[mask[0]] &= mask[1]
+    return bytes(key)
+
+def value_changed(old_value, new_value, deadband):
+    """ Check if a value has changed by more than the deadband. Values which are not numbers are just compared
+    """
+    try:
+        return abs(float(new_value) - float(old_value)) > deadband
+    except (TypeError, ValueError):
+        return new_value != old_value
+
+def merge_readings(messages):
+    """ Merge the sensor.basic messages of a same device in a single message : the value of each reading is
+        stored in a key named like its type (temp=21.2, humidity=71, ...). The other keys (units, ...) are kept
+        if they don't conflict. The messages of the other schemas are kept as they are.
+        @param messages : list of (schema, data)
+        @return : list of (schema, data)
+    """
+    merged = []
+    devices = {}
+    for (schema, data) in messages:
+        if schema != "sensor.basic":
+            merged.append((schema, data))
+            continue
+        device_data = devices.get(data["device"])
+        if device_data is None:
+            device_data = {"device" : data["device"]}
+            devices[data["device"]] = device_data
+            merged.append((schema, device_data))
+        device_data[data["type"]] = data["current"]
+        for key in data:
+            if key not in ("device", "type", "current") and key not in device_data:
+                device_data[key] = data[key]
+    return merged
+
+def strong_header(buf, pos, end):
+    """ Check if a fully valid packet starts at position <pos> of the buffer : a type of PACKET_LENGTHS (but the
+        undecoded messages, which have any length) with one of its lengths and, if known, one of its subtypes
+        @param buf : receive buffer
+        @param pos : position of the length byte
+        @param end : end of the received data in the buffer
+        @return : True if the length, the type and the subtype are received and valid
+    """
+    if end - pos <= 2:
+        return False
+    type = buf[pos + 1]
+    lengths = PACKET_LENGTHS.get(type)
+    if lengths is None or type == 0x03 or buf[pos] not in lengths:
+        return False
+    subtypes = PACKET_SUBTYPES.get(type)
+    return subtypes is None or buf[pos + 2] in subtypes
+
+def valid_header(buf, pos, end):
+    """ Check if a packet may start at position <pos> of the buffer : its length, type and subtype must be valid
+        The length of the RF types which are not in PACKET_LENGTHS is only checked against the min and max lengths
+        @param buf : receive buffer
+        @param pos : position of the length byte
+        @param end : end of the received data in the buffer
+        @return : False if it can't be a packet. True if it can be one or if there are not enough bytes yet to tell
+    """
+    length = buf[pos]
+    if length < MIN_PACKET_LENGTH or length > MAX_PACKET_LENGTH:
+        return False
+    if end - pos > 1:
+        type = buf[pos + 1]
+        lengths = PACKET_LENGTHS.get(type)
+        if lengths is None:
+            if type < MIN_RF_TYPE or type > MAX_RF_TYPE:
+                return False
+        elif length not in lengths:
+            return False
+        if end - pos > 2:
+            subtypes = PACKET_SUBTYPES.get(buf[pos + 1])
+            if subtypes is not None and buf[pos + 2] not in subtypes:
+                return False
+    return True
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Plugin purpose
+==============
+
+Transports to reach the RFXCOM : serial device, fake device, TCP and in memory loopback
+
+A transport has the interface of the serial device (pyserial) which is used by Rfxcom :
+
+- timeout : read timeout (seconds). None : block until some data is received, 0 : never block
+- inWaiting() : number of bytes which can be read without blocking
+- read(size) : read up to size bytes, waiting for them until the timeout (empty on timeout)
+- write(data) : write all the data
+- flushInput() : drop the data received until now
+- flush(), close()
+- fileno() : file descriptor to watch in the event loop mode (see Rfxcom.listen_async). Only the transports
+  which have a file descriptor (serial, TCP) define it
+
+A transport error (device unplugged, connection lost...) is raised as serial.SerialException
+
+Implements
+==========
+
+- TcpTransport
+- LoopbackTransport
+- ReplayTransport
+- open_transport
+
+@author: Fritz <fritz.smh@gmail.com>
+@copyright: (C) 2007-2013 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import binascii
+import errno
+import select
+import socket
+import threading
+from collections import deque
+import serial as serial
+import domogik.tests.common.testserial as testserial
+from domogik_packages.plugin_rfxcom.lib.capture import read_capture, monotonic
+
+# prefix of the RFXCOM devices reached over TCP (RFXtrx LAN model, ser2net, ...) : tcp://<host>:<port>
+TCP_PREFIX = "tcp://"
+
+# size of the socket receive buffer, so that a burst of packets is never lost while the reader is busy (bytes)
+TCP_RECEIVE_BUFFER = 262144
+
+# max number of bytes read from the socket at once
+TCP_READ_SIZE = 65536
+
+# timeout to connect to the RFXCOM (seconds)
+TCP_CONNECT_TIMEOUT = 5
+
+# the loopback transport gives the fed packets by blocks of about this size (bytes)
+LOOPBACK_BLOCK_SIZE = 65536
+
+# status message (with its length byte) sent by the loopback transport : 433.92MHz transceiver, all the protocols
+LOOPBACK_STATUS = binascii.unhexlify("0d01000102530000ffffff000000")
+
+
+def tcp_address(device):
+    """ Return the host and the port of a tcp://<host>:<port> device
+        @param device : device (ex : tcp://192.168.1.20:10001)
+        @return : (host, port) or None if the device is not a TCP one
+    """
+    if not device.startswith(TCP_PREFIX):
+        return None
+    (host, port) = device[len(TCP_PREFIX):].rstrip("/").rsplit(":", 1)
+    return (host.strip("[]"), int(port))
+
+
+class TcpTransport(object):
+    """ RFXCOM reached over TCP, with the same interface as the serial device (read, write, inWaiting, timeout,
+        fileno, flushInput, close)
+        The socket is read by chunks of TCP_READ_SIZE bytes in a buffer : inWaiting tells the bytes already
+        received (without blocking) and read takes them from the buffer. The commands are written at once
+        (TCP_NODELAY). The socket errors are raised as serial.SerialException : a lost connection is handled
+        like an unplugged device (see Rfxcom.reconnect).
+    """
+
+    def __init__(self, host, port, timeout = None):
+        """ Connect to the RFXCOM
+            @param host : host name or address
+            @param port : TCP port
+            @param timeout : read timeout (seconds). None : block until some data is received, 0 : never block
+        """
+        self.host = host
+        self.port = port
+        self._buffer = bytearray()
+        try:
+            self._socket = socket.create_connection((host, port), TCP_CONNECT_TIMEOUT)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TCP_RECEIVE_BUFFER)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except socket.error as e:
+            raise serial.SerialException("Could not connect to {0}:{1} : {2}".format(host, port, e))
+        self.timeout = timeout
+
+    def _get_timeout(self):
+        return self._timeout
+
+    def _set_timeout(self, timeout):
+        self._timeout = timeout
+        self._socket.settimeout(timeout)
+
+    timeout = property(_get_timeout, _set_timeout)
+
+    def _recv(self):
+        """ Read the socket once and append the data to the buffer
+            @return : number of bytes read (0 on timeout)
+        """
+        try:
+            data = self._socket.recv(TCP_READ_SIZE)
+        except socket.timeout:
+            return 0
+        except socket.error as e:
+            if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # not blocking (timeout 0) : nothing to read
+                return 0
+            raise serial.SerialException("Error while reading {0}:{1} : {2}".format(self.host, self.port, e))
+        if not data:
+            raise serial.SerialException("Connection closed by {0}:{1}".format(self.host, self.port))
+        self._buffer.extend(data)
+        return len(data)
+
+    def inWaiting(self):
+        """ Return the number of bytes which can be read without blocking
+        """
+        if not self._buffer:
+            (readable, writable, errors) = select.select([self._socket], [], [], 0)
+            if readable:
+                # some data (or the end of the connection) is waiting : recv won't block
+                self._recv()
+        return len(self._buffer)
+
+    def read(self, size = 1):
+        """ Read up to size bytes
+            The bytes already received are returned at once. If there is none, we wait for some (until the timeout)
+            @param size : max number of bytes to read
+            @return : the bytes read (empty on timeout)
+        """
+        if not self._buffer:
+            self._recv()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def write(self, data):
+        """ Write all the data
+            @param data : bytes to write
+        """
+        try:
+            self._socket.sendall(data)
+        except socket.error as e:
+            raise serial.SerialException("Error while writing {0}:{1} : {2}".format(self.host, self.port, e))
+        return len(data)
+
+    def flushInput(self):
+        """ Drop the data received until now
+        """
+        del self._buffer[:]
+        while self.inWaiting() > 0:
+            del self._buffer[:]
+
+    def flush(self):
+        pass
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def close(self):
+        self._socket.close()
+
+
+class LoopbackTransport(object):
+    """ In memory RFXCOM, to feed the receive path as fast as it can go (benchmarks, tests without hardware)
+        The packets given to feed are read back, repeated as many times as asked without building all the
+        copies in memory. Like the RFXCOM, it answers to the get status and set mode messages with a status
+        message and acknowledges the commands : the handshake and the transmit path work as with a real device.
+        There is no file descriptor (no fileno) : it can't be used in the event loop mode.
+    """
+
+    def __init__(self, timeout = None, status = LOOPBACK_STATUS):
+        """ @param timeout : read timeout (seconds). None : block until some data is fed, 0 : never block
+            @param status : status message (with its length byte) sent after a get status message
+        """
+        self.timeout = timeout
+        self.status = bytearray(status)
+        self._condition = threading.Condition()
+        # responses to the written messages : they are read before the fed packets
+        self._responses = bytearray()
+        # fed packets : list of [block, number of blocks still to read], and the block being read
+        self._feeds = deque()
+        self._block = b""
+        self._pos = 0
+        self.written = 0
+
+    def feed(self, data, count = 1):
+        """ Give some packets to read
+            @param data : packets (with their length byte)
+            @param count : number of times the packets are read
+        """
+        data = bytes(data)
+        copies = max(1, LOOPBACK_BLOCK_SIZE // max(1, len(data)))
+        (blocks, rest) = divmod(count, copies)
+        with self._condition:
+            if blocks > 0:
+                self._feeds.append([data * copies, blocks])
+            if rest > 0:
+                self._feeds.append([data * rest, 1])
+            self._condition.notify_all()
+
+    def _available(self):
+        """ Number of bytes available in the responses or the current block (the lock must be held)
+        """
+        if self._responses:
+            return len(self._responses)
+        if self._pos >= len(self._block) and self._feeds:
+            feed = self._feeds[0]
+            self._block = feed[0]
+            self._pos = 0
+            feed[1] -= 1
+            if feed[1] <= 0:
+                self._feeds.popleft()
+        return len(self._block) - self._pos
+
+    def inWaiting(self):
+        with self._condition:
+            return self._available()
+
+    def _wait_time(self):
+        """ Max time to wait for some data to read (the lock must be held)
+        """
+        return self.timeout
+
+    def read(self, size = 1):
+        with self._condition:
+            if self._available() == 0 and self.timeout != 0:
+                self._condition.wait(self._wait_time())
+                if self._available() == 0:
+                    return b""
+            if self._responses:
+                data = bytes(self._responses[:size])
+                del self._responses[:size]
+                return data
+            data = self._block[self._pos:self._pos + size]
+            self._pos += len(data)
+            return data
+
+    def write(self, data):
+        """ Answer to the written messages (the messages are written whole)
+        """
+        packet = bytearray(data)
+        self.written += 1
+        with self._condition:
+            if packet[1] == 0x00:
+                if packet[4] in (0x02, 0x03):
+                    # get status, set mode : the status with the seqnbr, the command and the protocols of the message
+                    status = bytearray(self.status)
+                    status[3:5] = packet[3:5]
+                    if packet[4] == 0x03:
+                        status[7:10] = packet[7:10]
+                        self.status[7:10] = packet[7:10]
+                    self._responses.extend(status)
+            else:
+                self._responses.extend(bytearray([0x04, 0x02, 0x01, packet[3], 0x00]))
+            self._condition.notify_all()
+        return len(data)
+
+    def flushInput(self):
+        with self._condition:
+            del self._responses[:]
+            self._feeds.clear()
+            self._block = b""
+            self._pos = 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayTransport(LoopbackTransport):
+    """ RFXCOM which sends again the packets of a capture file (see CaptureWriter), with their original timing
+        (speed 1), N times faster (speed N) or as fast as they are read (speed 0)
+        The replay starts when the status message is sent (at the end of the handshake). The interface messages of
+        the capture (types 0x00 to 0x02) are not replayed : like the loopback transport, it answers itself to the
+        written messages.
+    """
+
+    def __init__(self, path, speed = 1, timeout = None, receiver = None):
+        """ @param path : capture file
+            @param speed : replay speed (1 : original timing, N : N times faster, 0 : as fast as possible)
+            @param timeout : read timeout (seconds)
+            @param receiver : if set, only the packets of this receiver id are replayed
+        """
+        LoopbackTransport.__init__(self, timeout = timeout)
+        self.speed = speed
+        self.receiver = receiver
+        self.replayed = 0
+        self._records = read_capture(path)
+        self._next = next(self._records, None)
+        self._first = self._next[0] if self._next != None else 0
+        self._start = None
+
+    def finished(self):
+        """ True once all the packets have been read
+        """
+        with self._condition:
+            return self._next is None and self._available() == 0
+
+    def _due(self, timestamp):
+        """ Monotonic time when a captured packet has to be replayed
+        """
+        return self._start + (timestamp - self._first) / self.speed
+
+    def _available(self):
+        if self._responses:
+            return len(self._responses)
+        if self._pos >= len(self._block) and self._start != None:
+            now = monotonic()
+            block = bytearray()
+            while self._next != None and len(block) < LOOPBACK_BLOCK_SIZE:
+                (timestamp, receiver, packet) = self._next
+                if self.speed > 0 and self._due(timestamp) > now:
+                    break
+                if bytearray(packet[1:2])[0] > 0x02 and (self.receiver is None or receiver == self.receiver):
+                    block.extend(packet)
+                    self.replayed += 1
+                self._next = next(self._records, None)
+            self._block = bytes(block)
+            self._pos = 0
+        return len(self._block) - self._pos
+
+    def _wait_time(self):
+        if self._start is None or self._next is None or self.speed <= 0:
+            return self.timeout
+        wait = max(0, self._due(self._next[0]) - monotonic())
+        if self.timeout is None:
+            return wait
+        return min(wait, self.timeout)
+
+    def write(self, data):
+        LoopbackTransport.write(self, data)
+        packet = bytearray(data)
+        if packet[1] == 0x00 and packet[4] == 0x02 and self._start is None:
+            with self._condition:
+                self._start = monotonic()
+
+
+def open_serial(device, timeout, **options):
+    return serial.Serial(device, baudrate = 38400, parity = serial.PARITY_NONE, stopbits = serial.STOPBITS_ONE, timeout = timeout)
+
+def open_fake(device, timeout, **options):
+    return testserial.Serial(device, baudrate = 38400, parity = testserial.PARITY_NONE, stopbits = testserial.STOPBITS_ONE, timeout = timeout)
+
+def open_tcp(device, timeout, **options):
+    (host, port) = tcp_address(device)
+    return TcpTransport(host, port, timeout = timeout)
+
+def open_loopback(device, timeout, **options):
+    return LoopbackTransport(timeout = timeout)
+
+def open_replay(device, timeout, speed = 1, **options):
+    return ReplayTransport(device, speed = speed, timeout = timeout)
+
+# transports by name : function which opens the device
+TRANSPORTS = {
+  "serial" : open_serial,
+  "fake" : open_fake,
+  "tcp" : open_tcp,
+  "loopback" : open_loopback,
+  "replay" : open_replay,
+}
+
+def transport_kind(device):
+    """ Guess the transport of a device : tcp for tcp://<host>:<port>, loopback for "loopback", else serial
+    """
+    if tcp_address(device) != None:
+        return "tcp"
+    if device == "loopback":
+        return "loopback"
+    return "serial"
+
+def open_transport(kind, device, timeout = None, **options):
+    """ Open a device with a transport
+        @param kind : transport name (see TRANSPORTS). None : guessed from the device (see transport_kind)
+        @param device : device (serial device path, fake device script, tcp://<host>:<port>, capture file...)
+        @param timeout : read timeout (seconds)
+        @param options : options of the transport (replay : speed)
+        @return : the opened device
+    """
+    if kind == None:
+        kind = transport_kind(device)
+    if kind not in TRANSPORTS:
+        raise serial.SerialException("Unknown transport '{0}' (known transports : {1})".format(kind, ", ".join(sorted(TRANSPORTS))))
+    return TRANSPORTS[kind](device, timeout, **options)
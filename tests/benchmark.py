@@ -0,0 +1,774 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Benchmarks of the rfxcom library
+
+    These benchmarks don't need any hardware nor a running Domogik : the RFXCOM is replaced by an in memory
+    device which holds the data to read.
+
+    Usage : python tests/benchmark.py [<benchmark name> ...]
+"""
+
+import binascii
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import serial
+
+from domogik_packages.plugin_rfxcom.lib.rfxcom import Rfxcom, ReceiverMerger, monotonic, cpu_time, PRIORITY_SWITCHING, PACKET_AIRTIME
+from domogik_packages.plugin_rfxcom.lib.capture import CaptureWriter, read_capture, STRUCT_CAPTURE_HEADER, STRUCT_CAPTURE_RECORD, CAPTURE_MAGIC
+
+
+# type 52 packet (with its length byte) : device th1 0x2504, 21.2°C, 71%
+PACKET_52 = "0a520100250400d4470350"
+
+# packets (without their length byte) used for the decoding benchmark
+DECODE_PACKETS = {
+    "20" : "20000012345604a5",      # security1 : motion
+    "50" : "500100250480d450",      # temperature : -21.2°C
+    "52" : "520100250400d4470350",  # temperature and humidity
+}
+
+# status message (with its length byte) sent by the RFXCOM after a get status message
+STATUS_MESSAGE = "0d010001025315004f6f00000000"
+
+# traffic received with all the protocols enabled : for each packet of our type 52 sensor, neighbours lighting2
+# remotes and undecoded packets (packets with their length byte)
+NEIGHBOURS_TRAFFIC = ["0b1100010123456701010f50", "0b11000289abcdef02000060", "0803000412345678ff"]
+
+# command (without its length byte, with the seqnbr and the unit to fill) used for the transmit benchmark : lighting2
+# AC on. The commands of a burst are sent to different units : the queued commands of a unit would be coalesced
+COMMAND_11 = "1100{0}01234567{1:02x}010f00"
+
+# commands (without their length byte, with the seqnbr and the unit or level to fill) used for the priority benchmark
+COMMAND_11_DIM = "1100{0}01234567{1:02x}02{2:02x}00"   # lighting2 AC set level
+COMMAND_20 = "2000{0}12345604a5"                    # security1 : motion
+
+
+class MemorySerial:
+    """ In memory serial device : the data to read is given at creation
+    """
+
+    def __init__(self, data, in_waiting = True):
+        """ @param data : data to read
+            @param in_waiting : if False, the device can't tell how many bytes are waiting (like the fake device)
+        """
+        self.data = data
+        self.pos = 0
+        self.reads = 0
+        self.in_waiting = in_waiting
+        self.timeout = 5
+
+    def inWaiting(self):
+        if not self.in_waiting:
+            raise AttributeError("inWaiting")
+        return len(self.data) - self.pos
+
+    def read(self, size = 1):
+        self.reads += 1
+        data = self.data[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SimulatedTransceiver(MemorySerial):
+    """ Simulated RFXCOM for the transmit path : each command written is transmitted over the air after the
+        previous one (tx_time seconds) and then acknowledged. The link between the computer and the RFXCOM
+        adds link_delay seconds in each direction.
+        If nak_when_busy is True, a command received during the transmission of the previous one is NAKed
+    """
+
+    def __init__(self, link_delay, tx_time, nak_when_busy = False):
+        MemorySerial.__init__(self, b"")
+        self.link_delay = link_delay
+        self.tx_time = tx_time
+        self.nak_when_busy = nak_when_busy
+        self.lock = threading.Lock()
+        self.busy_until = 0
+        self.responses = []
+
+    def _deliver(self):
+        now = monotonic()
+        while self.responses and self.responses[0][0] <= now:
+            self.data += self.responses.pop(0)[1]
+
+    def inWaiting(self):
+        with self.lock:
+            self._deliver()
+            return len(self.data) - self.pos
+
+    def read(self, size = 1):
+        with self.lock:
+            self._deliver()
+            data = MemorySerial.read(self, size)
+        if not data:
+            # like the serial device, wait a little for the data
+            time.sleep(0.0005)
+        return data
+
+    def write(self, data):
+        packet = bytearray(data)
+        with self.lock:
+            arrival = monotonic() + self.link_delay
+            if self.nak_when_busy and arrival < self.busy_until:
+                nak = bytes(bytearray([0x04, 0x02, 0x01, packet[3], 0x02]))
+                self.responses.append((arrival + self.link_delay, nak))
+                self.responses.sort()
+                return
+            start = max(arrival, self.busy_until)
+            self.busy_until = start + self.tx_time
+            ack = bytes(bytearray([0x04, 0x02, 0x01, packet[3], 0x00]))
+            self.responses.append((self.busy_until + self.link_delay, ack))
+
+
+class BootingTransceiver(SimulatedTransceiver):
+    """ Simulated RFXCOM for the startup : after a reset, the RFXCOM sends some garbage and ignores the
+        commands during boot_time seconds. Then it answers to the get status message
+    """
+
+    def __init__(self, link_delay, boot_time):
+        SimulatedTransceiver.__init__(self, link_delay, 0)
+        self.boot_time = boot_time
+        self.ready_at = None
+
+    def write(self, data):
+        packet = bytearray(data)
+        with self.lock:
+            arrival = monotonic() + self.link_delay
+            if packet[4] == 0x00:
+                self.ready_at = arrival + self.boot_time
+                self.responses.append((arrival, b"\x00\xff\x13"))
+            elif packet[4] == 0x02 and self.ready_at != None and arrival >= self.ready_at:
+                self.responses.append((arrival + self.link_delay, binascii.unhexlify(STATUS_MESSAGE)))
+            elif packet[4] == 0x03:
+                # set mode : the status message with the new protocols
+                status = bytearray(binascii.unhexlify(STATUS_MESSAGE))
+                status[3:5] = packet[3:5]
+                status[7:10] = packet[7:10]
+                self.responses.append((arrival + self.link_delay, bytes(status)))
+
+
+class UnpluggableTransceiver(BootingTransceiver):
+    """ Simulated RFXCOM which sends a sensor packet every sensor_period seconds once it has answered to the
+        get status message. Once unplugged, all the operations fail like a serial device which is gone
+    """
+
+    def __init__(self, link_delay, boot_time, sensor_period):
+        BootingTransceiver.__init__(self, link_delay, boot_time)
+        self.sensor_period = sensor_period
+        self.next_sensor = None
+        self.unplugged = False
+
+    def _deliver(self):
+        if self.unplugged:
+            raise serial.SerialException("device reports readiness to read but returned no data (device disconnected?)")
+        now = monotonic()
+        if self.next_sensor is None and self.ready_at != None and now >= self.ready_at:
+            self.next_sensor = self.ready_at + self.sensor_period
+        while self.next_sensor != None and self.next_sensor <= now:
+            self.responses.append((self.next_sensor, binascii.unhexlify(PACKET_52)))
+            self.responses.sort()
+            self.next_sensor += self.sensor_period
+        SimulatedTransceiver._deliver(self)
+
+    def write(self, data):
+        if self.unplugged:
+            raise serial.SerialException("write failed : device disconnected")
+        packet = bytearray(data)
+        if packet[1] != 0x00:
+            # command : acknowledged at once
+            with self.lock:
+                ack = bytes(bytearray([0x04, 0x02, 0x01, packet[3], 0x00]))
+                self.responses.append((monotonic() + 2 * self.link_delay, ack))
+            return
+        BootingTransceiver.write(self, data)
+
+
+class TcpRfxcom:
+    """ RFXCOM reached over TCP (like ser2net or the LAN model) : answers to the get status message, acknowledges
+        the commands at once and sends the sensor packets given to stream. After disconnect, the next connection
+        is accepted
+    """
+
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.connection = None
+        self.connections = 0
+        thread = threading.Thread(None, self.serve, "benchmark-tcp-rfxcom", (), {})
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                (connection, address) = self.server.accept()
+            except socket.error:
+                # closed
+                return
+            self.connection = connection
+            self.connections += 1
+            self.serve_connection(connection)
+
+    def serve_connection(self, connection):
+        data = bytearray()
+        while True:
+            try:
+                received = connection.recv(4096)
+            except socket.error:
+                return
+            if not received:
+                return
+            data.extend(received)
+            while len(data) > 0 and len(data) > data[0]:
+                packet = data[:data[0] + 1]
+                del data[:data[0] + 1]
+                if packet[1] != 0x00:
+                    connection.sendall(bytes(bytearray([0x04, 0x02, 0x01, packet[3], 0x00])))
+                elif packet[4] == 0x02:
+                    connection.sendall(binascii.unhexlify(STATUS_MESSAGE))
+
+    def stream(self, data):
+        self.connection.sendall(data)
+
+    def disconnect(self):
+        """ Close the current connection, like a lost link
+        """
+        self.connection.shutdown(socket.SHUT_RDWR)
+        self.connection.close()
+
+    def close(self):
+        if self.connection != None:
+            self.connection.close()
+        self.server.close()
+
+
+def acknowledge_to(acknowledged):
+    """ Return a cb_send_xpl callback which appends the xpl-trig messages of the acknowledged commands to a list
+        (the sensor messages are ignored)
+    """
+    def send_xpl(message = None, schema = None, data = None):
+        if message != None:
+            acknowledged.append(message)
+    return send_xpl
+
+
+def create_rfxcom(stop, device, **kwargs):
+    """ Create a Rfxcom instance using the given device
+    """
+    log = logging.getLogger("rfxcom-benchmark")
+    rfx = Rfxcom(log, None, stop, "memory", lambda **kwargs : None, lambda **kwargs : None, lambda thread : None, **kwargs)
+    rfx.rfxcom = device
+    return rfx
+
+
+def bench_read(stop, nb_packets = 100000):
+    """ Throughput of the receive path : framing and decoding of type 52 packets
+    """
+    data = binascii.unhexlify(PACKET_52) * nb_packets
+    for in_waiting in (False, True):
+        # without inWaiting, the device behaves like the fake device and the old byte-at-a-time reader
+        device = MemorySerial(data, in_waiting)
+        rfx = create_rfxcom(stop, device)
+        start = time.time()
+        start_cpu = cpu_time()
+        while device.pos < len(data):
+            rfx.read()
+        elapsed = time.time() - start
+        cpu = cpu_time() - start_cpu
+        print("read (inWaiting {0:5}) : {1:8.0f} packets/s, {2:6.1f} us cpu/packet, {3:.2f} reads/packet".format(
+              str(in_waiting), nb_packets / elapsed, cpu * 1000000 / nb_packets, float(device.reads) / nb_packets))
+
+
+def run_loopback(rfx, stop, nb_packets, timeout = 120):
+    """ Listen to an opened Rfxcom until nb_packets packets are received (or the timeout)
+        @return : (elapsed time, cpu time)
+    """
+    reader = threading.Thread(None, rfx.listen, "benchmark-reader", (stop,), {})
+    start = monotonic()
+    start_cpu = cpu_time()
+    reader.start()
+    try:
+        while rfx.stats["packets"] < nb_packets and monotonic() - start < timeout:
+            time.sleep(0.001)
+        return (monotonic() - start, cpu_time() - start_cpu)
+    finally:
+        stop.set()
+        rfx._tx_wakeup.set()
+        rfx.rfxcom.feed(b"")
+        reader.join()
+
+
+def bench_capture(stop, nb_packets = 200000, nb_timed = 100, period = 0.01):
+    """ Capture of the received packets (cost and rotation), then replay of the capture at max speed, and of a
+        capture of nb_timed packets received every <period> seconds at 1x and 10x
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "rfxcom.cap")
+        for capture in (None, CaptureWriter(path, 1024 * 1024)):
+            rfx_stop = threading.Event()
+            rfx = create_rfxcom(rfx_stop, None, transport = "loopback", capture = capture)
+            rfx.rfxcom_device = "loopback"
+            rfx.open()
+            rfx.rfxcom.feed(binascii.unhexlify(PACKET_52), nb_packets)
+            (elapsed, cpu) = run_loopback(rfx, rfx_stop, nb_packets + 1)
+            if capture is None:
+                print("capture (off) : {0:8.0f} packets/s, {1:4.1f} us cpu/packet".format(nb_packets / elapsed, cpu * 1000000 / nb_packets))
+            else:
+                capture.close()
+                files = sorted(os.listdir(directory))
+                print("capture (on ) : {0:8.0f} packets/s, {1:4.1f} us cpu/packet, {2} records, files {3}, {4} bytes/record".format(
+                      nb_packets / elapsed, cpu * 1000000 / nb_packets, capture.records, " ".join(files),
+                      STRUCT_CAPTURE_RECORD.size + len(binascii.unhexlify(PACKET_52))))
+
+        rfx_stop = threading.Event()
+        rfx = create_rfxcom(rfx_stop, None, transport = "replay", replay_speed = 0)
+        rfx.rfxcom_device = path
+        rfx.open()
+        replayed = rfx.rfxcom.replayed
+        records = sum(1 for record in read_capture(path))
+        (elapsed, cpu) = run_loopback(rfx, rfx_stop, rfx.stats["packets"] + records)
+        print("replay (max speed) : {0} packets, {1:8.0f} packets/s".format(rfx.rfxcom.replayed - replayed, (rfx.rfxcom.replayed - replayed) / elapsed))
+
+        timed = os.path.join(directory, "timed.cap")
+        with open(timed, "wb") as capture_file:
+            capture_file.write(STRUCT_CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time(), 1000.0))
+            for idx in range(nb_timed):
+                capture_file.write(STRUCT_CAPTURE_RECORD.pack(1000.0 + idx * period, 0) + binascii.unhexlify(PACKET_52))
+        for speed in (1, 10):
+            rfx_stop = threading.Event()
+            rfx = create_rfxcom(rfx_stop, None, transport = "replay", replay_speed = speed)
+            rfx.rfxcom_device = timed
+            rfx.open()
+            (elapsed, cpu) = run_loopback(rfx, rfx_stop, rfx.stats["packets"] + nb_timed)
+            print("replay ({0:2}x) : {1} packets captured over {2:.2f} s replayed in {3:.3f} s".format(
+                  speed, nb_timed, (nb_timed - 1) * period, elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_decode(stop, nb_packets = 100000):
+    """ Throughput of the decoders (without framing)
+    """
+    rfx = create_rfxcom(stop, MemorySerial(""))
+    for name in sorted(DECODE_PACKETS):
+        packet = bytearray(binascii.unhexlify(DECODE_PACKETS[name]))
+        start = time.time()
+        for idx in range(nb_packets):
+            rfx._process_received_data(packet)
+        elapsed = time.time() - start
+        print("decode type {0} : {1:8.0f} packets/s".format(name, nb_packets / elapsed))
+
+
+def bench_transmit(stop, nb_commands = 20, link_delay = 0.004, tx_time = 0.02):
+    """ Latency and throughput of the transmit path : a burst of commands (like a scene) sent to a simulated RFXCOM
+        with several transmit windows. A window of 1 is the old behaviour (one command at a time)
+    """
+    print("transmit : {0} commands, link delay {1} ms, transmit time {2} ms".format(nb_commands, link_delay * 1000, tx_time * 1000))
+    for window in (1, 4, nb_commands):
+        device = SimulatedTransceiver(link_delay, tx_time)
+        rfx_stop = threading.Event()
+        rfx = create_rfxcom(rfx_stop, device, tx_window = window, tx_pacing = False)
+        acknowledged = []
+        done = threading.Event()
+        def command_sent(message):
+            acknowledged.append(monotonic())
+            if len(acknowledged) == nb_commands:
+                done.set()
+        rfx.cb_send_xpl = command_sent
+        reader = threading.Thread(None, rfx.listen, "benchmark-reader", (rfx_stop,), {})
+        reader.start()
+        try:
+            start = monotonic()
+            for idx in range(nb_commands):
+                rfx.write_packet(COMMAND_11.format(rfx.get_seqnbr(), idx), idx)
+            done.wait(60)
+        finally:
+            rfx_stop.set()
+            rfx._tx_wakeup.set()
+            reader.join()
+        elapsed = acknowledged[-1] - start
+        print("transmit (window {0:2}) : last acknowledge after {1:6.1f} ms, mean latency {2:6.1f} ms, {3:6.1f} commands/s".format(
+              window, elapsed * 1000, rfx.stats["tx_latency"] * 1000 / nb_commands, nb_commands / elapsed))
+
+
+def bench_tcp(stop, nb_packets = 100000, nb_commands = 20):
+    """ RFXCOM reached over TCP : startup, receive throughput and commands latency through the TCP transport
+    """
+    server = TcpRfxcom()
+    rfx_stop = threading.Event()
+    rfx = create_rfxcom(rfx_stop, None, tx_window = 4, tx_pacing = False)
+    rfx.rfxcom_device = "tcp://127.0.0.1:{0}".format(server.port)
+    acknowledged = []
+    rfx.cb_send_xpl = acknowledge_to(acknowledged)
+    start = monotonic()
+    rfx.open()
+    opened = monotonic() - start
+    reader = threading.Thread(None, rfx.listen, "benchmark-reader", (rfx_stop,), {})
+    reader.start()
+    try:
+        start = monotonic()
+        start_cpu = cpu_time()
+        server.stream(binascii.unhexlify(PACKET_52) * nb_packets)
+        while rfx.stats["packets"] < nb_packets + 1 and monotonic() - start < 60:
+            time.sleep(0.001)
+        elapsed = monotonic() - start
+        cpu = cpu_time() - start_cpu
+        start = monotonic()
+        for idx in range(nb_commands):
+            rfx.write_packet(COMMAND_11.format(rfx.get_seqnbr(), idx), idx)
+        while len(acknowledged) < nb_commands and monotonic() - start < 60:
+            time.sleep(0.001)
+    finally:
+        rfx_stop.set()
+        rfx._tx_wakeup.set()
+        server.close()
+        reader.join()
+    print("tcp : opened in {0:.0f} ms, {1:8.0f} packets/s ({2:4.1f} us cpu/packet), commands latency {3:.2f} ms".format(
+          opened * 1000, nb_packets / elapsed, cpu * 1000000 / nb_packets, rfx.stats["tx_latency"] * 1000 / nb_commands))
+
+
+def bench_loopback(stop, nb_packets = 1000000):
+    """ Ceiling of the receive path (framing, decoding and emission of the xPL messages) : the loopback transport
+        gives prebuilt packets as fast as they are read
+    """
+    for packets in ([PACKET_52], [PACKET_52, "0b1100010123456701010f50"]):
+        rfx_stop = threading.Event()
+        rfx = create_rfxcom(rfx_stop, None, transport = "loopback")
+        rfx.rfxcom_device = "loopback"
+        emitted = [0]
+        def send_xpl_batch(messages):
+            emitted[0] += len(messages)
+        rfx.cb_send_xpl_batch = send_xpl_batch
+        rfx.open()
+        data = binascii.unhexlify("".join(packets))
+        count = nb_packets // len(packets)
+        reader = threading.Thread(None, rfx.listen, "benchmark-reader", (rfx_stop,), {})
+        start = monotonic()
+        start_cpu = cpu_time()
+        rfx.rfxcom.feed(data, count)
+        reader.start()
+        try:
+            while rfx.stats["packets"] < count * len(packets) + 1 and monotonic() - start < 120:
+                time.sleep(0.01)
+            elapsed = monotonic() - start
+            cpu = cpu_time() - start_cpu
+        finally:
+            rfx_stop.set()
+            rfx._tx_wakeup.set()
+            rfx.rfxcom.feed(b"")
+            reader.join()
+        print("loopback ({0} types) : {1} packets in {2:.2f} s, {3:8.0f} packets/s, {4:4.1f} us cpu/packet, {5} xPL messages".format(
+              len(packets), count * len(packets), elapsed, count * len(packets) / elapsed, cpu * 1000000 / (count * len(packets)), emitted[0]))
+
+
+def bench_priority(stop, nb_commands = 40, link_delay = 0.004, tx_time = 0.02):
+    """ Latency of a security command queued after a burst of dim commands (one per unit)
+        Without priorities (all the commands in the same class), it waits for the whole burst
+    """
+    for scheduled in (False, True):
+        device = SimulatedTransceiver(link_delay, tx_time)
+        rfx_stop = threading.Event()
+        rfx = create_rfxcom(rfx_stop, device, tx_window = 1, tx_pacing = False)
+        acknowledged = {}
+        done = threading.Event()
+        def command_sent(message = None, **kwargs):
+            acknowledged[message] = monotonic()
+            if message == "security":
+                done.set()
+        rfx.cb_send_xpl = command_sent
+        reader = threading.Thread(None, rfx.listen, "benchmark-reader", (rfx_stop,), {})
+        reader.start()
+        try:
+            priority = None if scheduled else PRIORITY_SWITCHING
+            start = monotonic()
+            for idx in range(nb_commands):
+                rfx.write_packet(COMMAND_11_DIM.format(rfx.get_seqnbr(), idx, idx % 16), idx, priority = priority)
+            rfx.write_packet(COMMAND_20.format(rfx.get_seqnbr()), "security", priority = priority)
+            done.wait(60)
+        finally:
+            rfx_stop.set()
+            rfx._tx_wakeup.set()
+            reader.join()
+        print("priority (scheduler {0:5}) : security command acknowledged after {1:6.1f} ms, {2} dim commands sent before".format(
+              str(scheduled), (acknowledged["security"] - start) * 1000,
+              len([ack for ack in acknowledged.values() if ack < acknowledged["security"]])))
+
+
+def bench_pacing(stop, nb_commands = 10, link_delay = 0.004, window = 4):
+    """ Burst of commands sent to a simulated RFXCOM which NAKs the commands received while it is transmitting,
+        then to one which queues them. Without pacing, the NAKed commands are sent again after a backoff delay.
+        With pacing, the commands are paced by their airtime once a command has been NAKed
+    """
+    tx_time = PACKET_AIRTIME[0x11]
+    print("pacing : {0} commands, window {1}, transmit time {2} ms".format(nb_commands, window, tx_time * 1000))
+    for (nak_when_busy, pacing) in ((True, False), (True, True), (False, False), (False, True)):
+        device = SimulatedTransceiver(link_delay, tx_time, nak_when_busy = nak_when_busy)
+        rfx_stop = threading.Event()
+        rfx = create_rfxcom(rfx_stop, device, tx_window = window, tx_pacing = pacing)
+        acknowledged = []
+        done = threading.Event()
+        def command_sent(message = None, **kwargs):
+            acknowledged.append(monotonic())
+            if len(acknowledged) == nb_commands:
+                done.set()
+        rfx.cb_send_xpl = command_sent
+        reader = threading.Thread(None, rfx.listen, "benchmark-reader", (rfx_stop,), {})
+        reader.start()
+        try:
+            start = monotonic()
+            for idx in range(nb_commands):
+                rfx.write_packet(COMMAND_11.format(rfx.get_seqnbr(), idx), idx)
+            done.wait(60)
+        finally:
+            rfx_stop.set()
+            rfx._tx_wakeup.set()
+            reader.join()
+        print("pacing ({0:5}, {1:14}) : last command ended after {2:7.1f} ms, {3} retransmitted, {4} failed, {5} paced ({6:.1f} ms)".format(
+              str(pacing), "NAK when busy" if nak_when_busy else "queued", (acknowledged[-1] - start) * 1000,
+              rfx.stats["retransmitted"], rfx.stats["failed"], rfx.stats["paced"], rfx.stats["paced_delay"] * 1000))
+
+
+def old_command_11(rfx, address, unit, command, level):
+    """ Lighting2 command built like in the old library : by hexadecimal strings concatenation
+    """
+    cmd = "11"
+    cmd += "00"
+    cmd += rfx.get_seqnbr()
+    cmd += "%08x" % int(bin(int(address, 16)), 2)
+    cmd += "%02x" % unit
+    cmd += {"off" : "00", "on" : "01", "preset" : "02"}[command.lower()]
+    cmd += "%02x" % level
+    cmd += "00"
+    return bytearray(binascii.unhexlify("%02x%s" % (len(cmd) // 2, cmd)))
+
+
+def bench_encode(stop, nb_commands = 100000):
+    """ Throughput of the commands encoders (the commands are not queued)
+    """
+    rfx = create_rfxcom(stop, MemorySerial(""))
+    packets = []
+    rfx.queue_packet = lambda packet, *args, **kwargs : packets.append(packet)
+    commands = [("lighting1", rfx.command_10, ("a1", "on", "x10", None)),
+                ("lighting2", rfx.command_11, ("0x0123456", 1, "preset", 10, False, False, None)),
+                ("lighting3", rfx.command_12, ("a3", "level", 40, None)),
+                ("curtain1", rfx.command_18, ("b2", "close", None)),
+                ("security1", rfx.command_20, ("0x123456", "disarm", None, None))]
+    for (name, command, args) in commands:
+        start = time.time()
+        for idx in range(nb_commands):
+            command(*args)
+        elapsed = time.time() - start
+        print("encode {0:9} : {1:8.0f} commands/s ({2})".format(name, nb_commands / elapsed, binascii.hexlify(packets[-1])))
+        del packets[:]
+    start = time.time()
+    for idx in range(nb_commands):
+        old_command_11(rfx, "0x0123456", 1, "preset", 10)
+    elapsed = time.time() - start
+    print("encode lighting2 (old hexadecimal strings) : {0:8.0f} commands/s".format(nb_commands / elapsed))
+
+
+def bench_startup(stop, link_delay = 0.004):
+    """ Time to get the status message after the reset, for several boot times of the RFXCOM
+        (the previous startup waited 2 seconds before sending the get status message)
+    """
+    for boot_time in (0.01, 0.3, 1.2):
+        device = BootingTransceiver(link_delay, boot_time)
+        rfx = create_rfxcom(stop, device)
+        start = monotonic()
+        rfx.handshake()
+        elapsed = monotonic() - start
+        print("startup (boot {0:4.0f} ms) : status after {1:5.0f} ms, {2} get status (previously 2000 ms + status)".format(
+              boot_time * 1000, elapsed * 1000, rfx.stats["handshake"]["tries"]))
+
+
+def bench_protocols(stop, nb_packets = 20000, link_delay = 0.004):
+    """ Receiver protocols : set mode on startup for the known devices, then receive cost of the traffic
+        with all the protocols enabled and with only the protocol of our sensor
+    """
+    device = BootingTransceiver(link_delay, 0.01)
+    rfx = create_rfxcom(stop, device, receive_protocols = ["auto"])
+    rfx.add_known_device("rfxcom.temperature_humidity", "th1 0x2504")
+    start = monotonic()
+    status = rfx.handshake()
+    rfx.set_protocols(status)
+    print("protocols : mask {0} set in {1:.0f} ms".format(" ".join("{0:02x}".format(msg) for msg in rfx.protocols_mask()), (monotonic() - start) * 1000))
+    for (name, traffic) in (("all protocols", [PACKET_52] + NEIGHBOURS_TRAFFIC), ("oregon only", [PACKET_52])):
+        data = binascii.unhexlify("".join(traffic)) * (nb_packets // len(traffic))
+        device = MemorySerial(data)
+        rfx = create_rfxcom(stop, device)
+        start_cpu = cpu_time()
+        while device.pos < len(data):
+            rfx.read()
+        cpu = cpu_time() - start_cpu
+        print("protocols ({0:13}) : {1} packets received, {2:6.1f} us cpu per sensor packet".format(
+              name, rfx.stats["packets"], cpu * 1000000 / (nb_packets // len(traffic))))
+
+
+def bench_reconnect(stop, unplugged = 1.0, link_delay = 0.004, boot_time = 0.05, sensor_period = 0.1):
+    """ Unplug the RFXCOM while commands are queued, plug it again after <unplugged> seconds : time from the
+        replug to the first decoded packet and commands kept across the reconnection
+    """
+    plugged = {"device" : UnpluggableTransceiver(link_delay, boot_time, sensor_period), "at" : None}
+    def open_device():
+        if plugged["at"] is None:
+            raise serial.SerialException("could not open port /dev/rfxcom: No such file or directory")
+        return plugged["device"]
+    rfx_stop = threading.Event()
+    rfx = create_rfxcom(rfx_stop, plugged["device"], tx_pacing = False)
+    rfx._open_device = open_device
+    acknowledged = []
+    rfx.cb_send_xpl = acknowledge_to(acknowledged)
+    reader = threading.Thread(None, rfx.listen, "benchmark-reader", (rfx_stop,), {})
+    reader.start()
+    try:
+        time.sleep(0.2)
+        plugged["device"].unplugged = True
+        plugged["device"] = UnpluggableTransceiver(link_delay, boot_time, sensor_period)
+        for idx in range(3):
+            rfx.write_packet(COMMAND_11.format(rfx.get_seqnbr(), idx), idx)
+        time.sleep(unplugged)
+        plugged["at"] = monotonic()
+        while rfx.stats["reconnects"] == 0 or rfx._reopened_at is not None:
+            time.sleep(0.001)
+        first_packet = monotonic() - plugged["at"]
+        deadline = monotonic() + 5
+        while len(acknowledged) < 3 and monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        rfx_stop.set()
+        rfx._tx_wakeup.set()
+        reader.join()
+    print("reconnect : unplugged {0:.1f} s, first packet {1:.0f} ms after the replug ({2:.0f} ms after the reopen), {3}/3 commands acknowledged".format(
+          unplugged, first_packet * 1000, rfx.stats["reconnect_first_packet"] * 1000, len(acknowledged)))
+
+
+def bench_receivers(stop, nb_sensors = 200, nb_readings = 50, nb_receivers = 3, window = 0.2):
+    """ Several receivers : each reading of a sensor is heard by some of the receivers with different rssi. The copies
+        are merged by a single thread : number of readings processed, best rssi kept and coverage of each receiver
+    """
+    random.seed(1)
+    streams = [bytearray() for idx in range(nb_receivers)]
+    best = {}
+    for reading in range(nb_readings):
+        for sensor in range(nb_sensors):
+            packet = bytearray(binascii.unhexlify(PACKET_52))
+            packet[4:6] = bytearray([sensor >> 8, sensor & 0xFF])
+            packet[9] = reading % 100
+            for idx in random.sample(range(nb_receivers), random.randint(1, nb_receivers)):
+                packet[10] = (random.randint(1, 15) << 4) | 0x09
+                streams[idx].extend(packet)
+                best[(sensor, reading % 100)] = max(best.get((sensor, reading % 100), 0), packet[10] >> 4)
+    rfx_stop = threading.Event()
+    processed = []
+    # like the plugin, the additional receivers have no write thread
+    rfxs = [create_rfxcom(rfx_stop, MemorySerial(bytes(stream)), receive_only = idx > 0) for (idx, stream) in enumerate(streams)]
+    rfxs[0].process_packet = lambda packet : processed.append(packet)
+    rfxs[0].cb_send_xpl = lambda **kwargs : None
+    merger = ReceiverMerger(rfxs[0], window, 0)
+    for (idx, rfx) in enumerate(rfxs):
+        rfx.rfxcom_device = "rfxcom{0}".format(idx)
+        rfx.merger = merger
+        merger.add_receiver(rfx.rfxcom_device)
+    merger_process = threading.Thread(None, merger.run, "benchmark-merger", (rfx_stop,), {})
+    merger_process.start()
+    def read(rfx):
+        while rfx.rfxcom.pos < len(rfx.rfxcom.data):
+            rfx.read()
+    readers = [threading.Thread(None, read, "benchmark-reader", (rfx,), {}) for rfx in rfxs]
+    start = monotonic()
+    start_cpu = cpu_time()
+    try:
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        while len(processed) < len(best) and monotonic() - start < 60:
+            time.sleep(0.001)
+        elapsed = monotonic() - start - window
+        cpu = cpu_time() - start_cpu
+    finally:
+        rfx_stop.set()
+        merger_process.join()
+    copies = sum(coverage["heard"] for coverage in merger.coverage.values())
+    best_kept = sum(1 for packet in processed if packet[9] >> 4 == best[((packet[3] << 8) | packet[4], packet[8])])
+    print("receivers ({0}) : {1} copies merged in {2} readings ({3} with the best rssi), {4:8.0f} copies/s, {5:5.1f} us cpu/copy".format(
+          nb_receivers, copies, len(processed), best_kept, copies / elapsed, cpu * 1000000 / copies))
+    for receiver in sorted(merger.coverage):
+        coverage = merger.coverage[receiver]
+        print("receivers ({0}) : {1} heard {2}, best {3}, exclusive {4}".format(nb_receivers, receiver, coverage["heard"], coverage["best"], coverage["exclusive"]))
+
+
+def bench_scene(stop, nb_commands = 20, link_delay = 0.004, tx_time = 0.02):
+    """ End to end latency of a scene : lighting2 commands for different units sent in one batch
+    """
+    for window in (1, 4):
+        device = SimulatedTransceiver(link_delay, tx_time)
+        rfx_stop = threading.Event()
+        rfx = create_rfxcom(rfx_stop, device, tx_window = window, tx_pacing = False)
+        scenes = []
+        done = threading.Event()
+        def scene_done(message = None, schema = None, data = None):
+            if schema == "rfxcom.scene":
+                scenes.append(data)
+                done.set()
+        rfx.cb_send_xpl = scene_done
+        reader = threading.Thread(None, rfx.listen, "benchmark-reader", (rfx_stop,), {})
+        reader.start()
+        try:
+            packets = [rfx.encode_11("0x0123456", unit, "on", 0, False, False) for unit in range(nb_commands)]
+            rfx.send_scene("benchmark", packets)
+            done.wait(60)
+        finally:
+            rfx_stop.set()
+            rfx._tx_wakeup.set()
+            reader.join()
+        print("scene (window {0}) : {1} commands, status {2}, {3} ms".format(window, scenes[0]["commands"], scenes[0]["status"], scenes[0]["latency"]))
+
+
+BENCHMARKS = {
+    "capture" : bench_capture,
+    "decode" : bench_decode,
+    "encode" : bench_encode,
+    "loopback" : bench_loopback,
+    "pacing" : bench_pacing,
+    "priority" : bench_priority,
+    "protocols" : bench_protocols,
+    "read" : bench_read,
+    "receivers" : bench_receivers,
+    "reconnect" : bench_reconnect,
+    "scene" : bench_scene,
+    "tcp" : bench_tcp,
+    "startup" : bench_startup,
+    "transmit" : bench_transmit,
+}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO)
+    stop = threading.Event()
+    try:
+        for name in (sys.argv[1:] or sorted(BENCHMARKS)):
+            BENCHMARKS[name](stop)
+    finally:
+        stop.set()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Tests of the event loop mode (Rfxcom loop parameter and listen_async) : reading, writing and reconnection on
+    an event loop, with a RFXCOM reached over a TCP socket (see TcpRfxcom)
+
+    Usage : python -m unittest discover -s tests (or pytest tests)
+"""
+
+import binascii
+import threading
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+from benchmark import MemorySerial, TcpRfxcom, create_rfxcom, acknowledge_to, COMMAND_11, PACKET_52
+from domogik_packages.plugin_rfxcom.lib.rfxcom import monotonic, RfxcomException
+from domogik_packages.plugin_rfxcom.lib.transport import LoopbackTransport
+
+
+@unittest.skipIf(asyncio is None, "no asyncio or trollius event loop")
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stop = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.rfx = None
+
+    def tearDown(self):
+        self.stop.set()
+        if self.rfx != None:
+            self.rfx.stop_async()
+        if self.server != None:
+            self.server.close()
+        self.loop.close()
+
+    def listen(self):
+        """ Open a RFXCOM reached over TCP and use it on the loop
+        """
+        self.server = TcpRfxcom()
+        self.rfx = create_rfxcom(self.stop, None, loop = self.loop, tx_pacing = False, stats_period = 0)
+        self.rfx.rfxcom_device = "tcp://127.0.0.1:{0}".format(self.server.port)
+        self.acknowledged = []
+        self.rfx.cb_send_xpl = acknowledge_to(self.acknowledged)
+        self.rfx.open()
+        self.rfx.listen_async()
+
+    def run_until(self, done, timeout = 10):
+        """ Run the loop until done() is True (or the timeout)
+        """
+        deadline = monotonic() + timeout
+        def check():
+            if done() or monotonic() > deadline:
+                self.loop.stop()
+            else:
+                self.loop.call_later(0.01, check)
+        self.loop.call_soon(check)
+        self.loop.run_forever()
+
+    def commands(self, first, count):
+        """ Queue some commands from another thread (like the xPL listeners)
+        """
+        def queue():
+            for idx in range(first, first + count):
+                self.rfx.write_packet(COMMAND_11.format(self.rfx.get_seqnbr(), idx), idx)
+        thread = threading.Thread(None, queue, "test-commands", (), {})
+        thread.start()
+        thread.join()
+
+    def test_no_file_descriptor(self):
+        # the loopback transport and the in memory device have no file descriptor to watch
+        for device in (LoopbackTransport(timeout = 0), MemorySerial(b"")):
+            rfx = create_rfxcom(self.stop, device, loop = self.loop, stats_period = 0)
+            self.assertRaises(RfxcomException, rfx.listen_async)
+
+    def test_read_write(self):
+        self.listen()
+        packets = self.rfx.stats["packets"]
+        self.commands(0, 5)
+        self.server.stream(binascii.unhexlify(PACKET_52) * 10)
+        # the acknowledges are counted with the sensor packets
+        self.run_until(lambda : len(self.acknowledged) == 5 and self.rfx.stats["packets"] == packets + 15)
+        self.assertEqual(sorted(self.acknowledged), list(range(5)))
+        self.assertEqual(self.rfx.stats["packets"], packets + 15)
+        self.assertEqual(self.rfx._in_flight, {})
+
+    def test_reconnect(self):
+        self.listen()
+        # the state of the reconnection is changed on the loop thread
+        threads = []
+        reconnected = self.rfx._reconnected
+        def on_reconnected(*args):
+            threads.append(threading.current_thread())
+            reconnected(*args)
+        self.rfx._reconnected = on_reconnected
+        self.server.disconnect()
+        self.run_until(lambda : self.rfx._disconnected)
+        # queued while disconnected : sent once reconnected
+        self.commands(0, 3)
+        self.run_until(lambda : self.rfx.stats["reconnects"] == 1)
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertEqual(self.server.connections, 2)
+        self.run_until(lambda : len(self.acknowledged) == 3)
+        self.assertEqual(sorted(self.acknowledged), [0, 1, 2])
+        packets = self.rfx.stats["packets"]
+        self.commands(3, 2)
+        self.server.stream(binascii.unhexlify(PACKET_52) * 10)
+        self.run_until(lambda : len(self.acknowledged) == 5 and self.rfx.stats["packets"] == packets + 12)
+        self.assertEqual(sorted(self.acknowledged), list(range(5)))
+        self.assertEqual(self.rfx.stats["packets"], packets + 12)
+        self.assertEqual(self.rfx.stats["disconnects"], 1)
+        self.assertFalse(self.rfx._disconnected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Tests of the capture file : capture sessions appended to a file, flush of the buffered records, truncated file,
+    and replay of a capture (capture then replay round trip)
+
+    Usage : python -m unittest discover -s tests (or pytest tests)
+"""
+
+import binascii
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from benchmark import MemorySerial, create_rfxcom, PACKET_52
+from domogik_packages.plugin_rfxcom.lib.capture import CaptureWriter, read_capture, monotonic, CAPTURE_MAGIC, CAPTURE_FLUSH_PERIOD, STRUCT_CAPTURE_HEADER, STRUCT_CAPTURE_RECORD
+from domogik_packages.plugin_rfxcom.lib.transport import ReplayTransport
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "rfxcom.cap")
+        self.packet = bytearray(binascii.unhexlify(PACKET_52))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_capture(self, sessions):
+        """ Write a capture file
+            @param sessions : list of (monotonic time of the start of the session, times of its records)
+        """
+        with open(self.path, "wb") as capture_file:
+            for (start, times) in sessions:
+                capture_file.write(STRUCT_CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time(), start))
+                for timestamp in times:
+                    capture_file.write(STRUCT_CAPTURE_RECORD.pack(timestamp, 0) + bytes(self.packet))
+
+    def test_records(self):
+        capture = CaptureWriter(self.path)
+        start = monotonic()
+        for receiver in (0, 1, 2):
+            capture.write(receiver, self.packet[1:])
+        capture.close()
+        records = list(read_capture(self.path))
+        self.assertEqual([(receiver, packet) for (timestamp, receiver, packet) in records], [(0, bytes(self.packet)), (1, bytes(self.packet)), (2, bytes(self.packet))])
+        self.assertTrue(all(start <= timestamp <= monotonic() for (timestamp, receiver, packet) in records))
+        self.assertEqual(capture.records, 3)
+
+    def test_sessions(self):
+        # the monotonic clock of the second session (after a reboot) is behind the one of the first session : the
+        # second session is replayed right after the first one, with its own timing
+        self.write_capture([(1000.0, [1000.0, 1000.5]), (50.0, [51.0, 52.0])])
+        self.assertEqual([timestamp for (timestamp, receiver, packet) in read_capture(self.path)], [1000.0, 1000.5, 1001.5, 1002.5])
+
+    def test_appended_session(self):
+        for session in range(2):
+            capture = CaptureWriter(self.path)
+            capture.write(session, self.packet[1:])
+            capture.write(session, self.packet[1:])
+            capture.close()
+        records = list(read_capture(self.path))
+        self.assertEqual([receiver for (timestamp, receiver, packet) in records], [0, 0, 1, 1])
+        times = [timestamp for (timestamp, receiver, packet) in records]
+        self.assertEqual(times, sorted(times))
+
+    def test_idle_flush(self):
+        # the last packets are written even if no other packet is received
+        capture = CaptureWriter(self.path)
+        try:
+            capture.write(0, self.packet[1:])
+            deadline = monotonic() + CAPTURE_FLUSH_PERIOD + 2
+            while len(list(read_capture(self.path))) == 0 and monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(len(list(read_capture(self.path))), 1)
+        finally:
+            capture.close()
+
+    def test_truncated(self):
+        self.write_capture([(1000.0, [1000.0, 1000.5])])
+        with open(self.path, "ab") as capture_file:
+            capture_file.write(STRUCT_CAPTURE_RECORD.pack(1001.0, 0) + bytes(self.packet[:5]))
+        self.assertEqual(len(list(read_capture(self.path))), 2)
+
+    def test_not_a_capture(self):
+        with open(self.path, "wb") as capture_file:
+            capture_file.write(b"\x00" * 100)
+        self.assertRaises(IOError, list, read_capture(self.path))
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "rfxcom.cap")
+        # sensor packets (with their length byte) : th1 0x2504, temp1 0x2504 (-21.2°C), then th1 0x2504 again
+        self.data = binascii.unhexlify(PACKET_52 + "08500100250480d450" + PACKET_52)
+        # not set : the handshake of the replay would be given up. The instances are receive only : no write thread
+        self.stop = threading.Event()
+
+    def tearDown(self):
+        self.stop.set()
+        shutil.rmtree(self.directory)
+
+    def receive(self, rfx):
+        """ Record the xPL messages sent by a Rfxcom instance
+        """
+        messages = []
+        rfx.cb_send_xpl = lambda message = None, schema = None, data = None : messages.append((schema, data))
+        return messages
+
+    def capture(self, receiver_id = 0):
+        """ Receive the packets with a capture
+            @return : the xPL messages sent
+        """
+        capture = CaptureWriter(self.path)
+        rfx = create_rfxcom(self.stop, MemorySerial(self.data), capture = capture, receiver_id = receiver_id, stats_period = 0, receive_only = True)
+        messages = self.receive(rfx)
+        while rfx.rfxcom.pos < len(self.data):
+            rfx.read()
+        capture.close()
+        return messages
+
+    def replay(self, speed = 0):
+        """ Replay the capture file
+            @return : the xPL messages sent, the replay time
+        """
+        rfx = create_rfxcom(self.stop, None, transport = "replay", replay_speed = speed, stats_period = 0, receive_only = True)
+        rfx.rfxcom_device = self.path
+        rfx.open()
+        messages = self.receive(rfx)
+        start = monotonic()
+        while not rfx.rfxcom.finished():
+            rfx.read()
+        return (messages, monotonic() - start)
+
+    def test_round_trip(self):
+        captured = self.capture()
+        (replayed, elapsed) = self.replay()
+        self.assertEqual(len(captured), 13)
+        self.assertEqual(replayed, captured)
+
+    def test_sessions(self):
+        # a second session appended to the capture file : both sessions are replayed
+        captured = self.capture(0) + self.capture(1)
+        (replayed, elapsed) = self.replay()
+        self.assertEqual(replayed, captured)
+
+    def test_receiver(self):
+        # only the packets of the given receiver are replayed, once the get status message is written
+        self.capture(0)
+        self.capture(1)
+        transport = ReplayTransport(self.path, speed = 0, timeout = 0, receiver = 1)
+        self.assertEqual(transport.inWaiting(), 0)
+        transport.write(bytes(bytearray([0x0D, 0x00, 0x00, 0x01, 0x02] + [0] * 9)))
+        while not transport.finished():
+            transport.read(transport.inWaiting())
+        self.assertEqual(transport.replayed, 3)
+
+    def test_timing(self):
+        # packets captured 0.2 seconds apart : replayed with the same timing (speed 1), 4 times faster (speed 4)
+        with open(self.path, "wb") as capture_file:
+            capture_file.write(STRUCT_CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time(), 1000.0))
+            for idx in range(3):
+                capture_file.write(STRUCT_CAPTURE_RECORD.pack(1000.0 + idx * 0.2, 0) + binascii.unhexlify(PACKET_52))
+        for (speed, duration) in ((1, 0.4), (4, 0.1)):
+            (replayed, elapsed) = self.replay(speed)
+            self.assertEqual(len(replayed), 15)
+            self.assertTrue(duration <= elapsed < duration + 0.15, (speed, elapsed))
+
+
+if __name__ == "__main__":
+    unittest.main()
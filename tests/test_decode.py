@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Tests of the decoding of the sensors packets (types 20, 50 and 52)
+
+    The expected xPL messages and detected devices are the ones sent by the plugin before the packets were
+    decoded from bytes (hexadecimal string decoders of release 1.68.0), except for the subtypes 0x0A which
+    could not be decoded then.
+
+    Usage : python -m unittest discover -s tests (or pytest tests)
+"""
+
+import binascii
+import math
+import threading
+import unittest
+
+from benchmark import create_rfxcom
+
+
+def readings(address, *values):
+    """ sensor.basic messages of a device : values are (type, current) or (type, current, extra keys)
+    """
+    messages = []
+    for value in values:
+        data = {"device" : address, "type" : value[0], "current" : value[1]}
+        if len(value) > 2:
+            data.update(value[2])
+        messages.append(("sensor.basic", data))
+    return messages
+
+# packet (without its length byte) => (xPL messages, (device type, features, address, reference))
+VECTORS_20 = {
+  "20000012345604a5" : ([("x10.security", {"device" : "0x123456", "command" : "motion"})] +
+                        readings("0x123456", ("battery", 100), ("rssi", 31)),
+                        ("rfxcom.security", ["Security1"], "0x123456", "X10 security door/window sensor")),
+  "20050112345603f0" : ([("x10.security", {"device" : "0x123456", "command" : "alert", "delay" : "max"})] +
+                        readings("0x123456", ("battery", 150), ("rssi", 0)),
+                        ("rfxcom.security", ["Security1"], "0x123456", "Visonic PowerCode motion sensor (with alive packets)")),
+  "20000245678980c1" : ([("x10.security", {"device" : "0x456789", "command" : "normal", "tamper" : "true"})] +
+                        readings("0x456789", ("battery", 120), ("rssi", 6)),
+                        ("rfxcom.security", ["Security1"], "0x456789", "X10 security door/window sensor")),
+  "20010345678916a3" : ([("x10.security", {"device" : "0x456789", "command" : "alert", "low-battery" : "true"})] +
+                        readings("0x456789", ("battery", 100), ("rssi", 18)),
+                        ("rfxcom.security", ["Security1"], "0x456789", "X10 security motion sensor")),
+  "20040445678908ff" : ([("x10.security", {"device" : "0x456789", "command" : "alert", "tamper" : "true"})] +
+                        readings("0x456789", ("battery", 150), ("rssi", 93)),
+                        ("rfxcom.security", ["Security1"], "0x456789", "Visonic PowerCode door/window sensor – primary contact (with alive packets)")),
+  "20000512345611a5" : ([("x10.security", {"device" : "0x123456", "command" : "lights-on"})] +
+                        readings("0x123456", ("battery", 100), ("rssi", 31)),
+                        ("rfxcom.security", ["Security1"], "0x123456", "X10 security door/window sensor")),
+}
+
+VECTORS_50 = {
+  "500100250400d450" : (readings("temp1 0x2504", ("temp", 21.2, {"units" : "c"}), ("battery", 10), ("rssi", 31)),
+                        ("rfxcom.temperature", ["temperature"], "temp1 0x2504", "THR128/138, THC138")),
+  "500100250480d450" : (readings("temp1 0x2504", ("temp", -21.2, {"units" : "c"}), ("battery", 10), ("rssi", 31)),
+                        ("rfxcom.temperature", ["temperature"], "temp1 0x2504", "THR128/138, THC138")),
+  "50020125048000a9" : (readings("temp2 0x2504", ("temp", -0.0, {"units" : "c"}), ("battery", 100), ("rssi", 62)),
+                        ("rfxcom.temperature", ["temperature"], "temp2 0x2504", "THC238/268,THN132,THWR288,THRN122,THN122,AW129/131")),
+  "5008020123008070" : (readings("temp8 0x0123", ("temp", 12.8, {"units" : "c"}), ("battery", 10), ("rssi", 43)),
+                        ("rfxcom.temperature", ["temperature"], "temp8 0x0123", "La Crosse WS2300")),
+  # subtype 0x0A : not decoded by 1.68.0
+  "500a03aaaa00fa61" : (readings("tempa 0xaaaa", ("temp", 25.0, {"units" : "c"}), ("battery", 20), ("rssi", 37)),
+                        ("rfxcom.temperature", ["temperature"], "tempa 0xaaaa", "TFA 30.3133")),
+}
+
+VECTORS_52 = {
+  "520100250400d4470350" : (readings("th1 0x2504", ("temp", 21.2, {"units" : "c"}), ("humidity", 71, {"description" : "wet"}),
+                                     ("status", "wet"), ("battery", 10), ("rssi", 31)),
+                            ("rfxcom.temperature_humidity", ["temperature", "humidity"], "th1 0x2504", "THGN122/123, THGN132, THGR122/228/238/268")),
+  "520100250480d4470350" : (readings("th1 0x2504", ("temp", -21.2, {"units" : "c"}), ("humidity", 71, {"description" : "wet"}),
+                                     ("status", "wet"), ("battery", 10), ("rssi", 31)),
+                            ("rfxcom.temperature_humidity", ["temperature", "humidity"], "th1 0x2504", "THGN122/123, THGN132, THGR122/228/238/268")),
+  "52060325048000250079" : (readings("th6 0x2504", ("temp", -0.0, {"units" : "c"}), ("humidity", 37, {"description" : "dry"}),
+                                     ("status", "dry"), ("battery", 100), ("rssi", 43)),
+                            ("rfxcom.temperature_humidity", ["temperature", "humidity"], "th6 0x2504", "THGR918/928, THGRN228, THGN500")),
+  "52090400ff7fff6400f4" : (readings("th9 0x00ff", ("temp", 3276.7, {"units" : "c"}), ("humidity", 100, {"description" : "dry"}),
+                                     ("status", "dry"), ("battery", 50), ("rssi", 93)),
+                            ("rfxcom.temperature_humidity", ["temperature", "humidity"], "th9 0x00ff", "Viking 02035,02038 (02035 has no humidity)")),
+  # subtype 0x0A : not decoded by 1.68.0
+  "520a0512340123300262" : (readings("tha 0x1234", ("temp", 29.1, {"units" : "c"}), ("humidity", 48, {"description" : "normal"}),
+                                     ("status", "normal"), ("battery", 30), ("rssi", 37)),
+                            ("rfxcom.temperature_humidity", ["temperature", "humidity"], "tha 0x1234", "Rubicson")),
+}
+
+
+class DecodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stop = threading.Event()
+        self.rfx = create_rfxcom(self.stop, None, stats_period = 0)
+        self.messages = []
+        self.detected = []
+        self.rfx.cb_send_xpl = lambda message = None, schema = None, data = None : self.messages.append((schema, data))
+        self.rfx.cb_device_detected = lambda **kwargs : self.detected.append(kwargs)
+
+    def tearDown(self):
+        self.stop.set()
+        self.rfx._tx_wakeup.set()
+
+    def check(self, vectors):
+        for (packet, (messages, (device_type, features, address, reference))) in sorted(vectors.items()):
+            del self.messages[:]
+            del self.detected[:]
+            self.rfx._detected.clear()
+            self.rfx.process_packet(bytearray(binascii.unhexlify(packet)))
+            self.assertEqual(self.messages, messages, packet)
+            for ((schema, data), (expected_schema, expected_data)) in zip(self.messages, messages):
+                if schema == "sensor.basic" and data["type"] == "temp":
+                    # -0.0 == 0.0 : check the sign too
+                    self.assertEqual(math.copysign(1, data["current"]), math.copysign(1, expected_data["current"]), packet)
+            self.assertEqual(self.detected, [{"device_type" : device_type,
+                                              "type" : "xpl_stats",
+                                              "feature" : feature,
+                                              "data" : {"device" : address, "reference" : reference}} for feature in features], packet)
+
+    def test_type_20(self):
+        self.check(VECTORS_20)
+
+    def test_type_50(self):
+        self.check(VECTORS_50)
+
+    def test_type_52(self):
+        self.check(VECTORS_52)
+
+    def test_merge_readings(self):
+        self.rfx.merge_readings = True
+        self.rfx.process_packet(bytearray(binascii.unhexlify("520100250480d4470350")))
+        self.assertEqual(self.messages, [("sensor.basic", {"device" : "th1 0x2504", "temp" : -21.2, "units" : "c", "humidity" : 71,
+                                                           "description" : "wet", "status" : "wet", "battery" : 10, "rssi" : 31})])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Tests of the framing of the received data : packets split over several reads, bad data, truncated packets
+    and packets of the types not handled by the plugin
+
+    Usage : python -m unittest discover -s tests (or pytest tests)
+"""
+
+import binascii
+import threading
+import unittest
+
+from benchmark import MemorySerial, create_rfxcom, PACKET_52
+
+
+# type 50 packet (with its length byte) : device temp1 0x2504, -21.2°C
+PACKET_50 = "08500100250480d450"
+
+# packets of types not handled by the plugin (with their length byte) : Security2 (0x21) and 0x5E
+PACKET_21 = bytes(bytearray([0x1C, 0x21, 0x00, 0x01]) + bytearray(range(25)))
+PACKET_5E = bytes(bytearray([0x0C, 0x5E, 0x01, 0x02]) + bytearray(9))
+
+
+class FramingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stop = threading.Event()
+        self.rfx = None
+
+    def tearDown(self):
+        self.stop.set()
+        if self.rfx != None:
+            self.rfx._tx_wakeup.set()
+
+    def frame(self, data, in_waiting = True, process = False):
+        """ Read all the data and return the framed packets (with their length byte)
+            @param in_waiting : if False, the data is read by the number of bytes missing to complete a packet
+            @param process : if True, the packets are processed as usual
+        """
+        device = MemorySerial(data, in_waiting)
+        self.rfx = create_rfxcom(self.stop, device, stats_period = 0)
+        packets = []
+        if not process:
+            self.rfx.process_packet = lambda packet : packets.append(bytes(bytearray([len(packet)]) + packet))
+        while device.pos < len(data):
+            self.rfx.read()
+        return packets
+
+    def test_packets(self):
+        data = binascii.unhexlify(PACKET_52 + PACKET_50 + PACKET_52)
+        for in_waiting in (True, False):
+            self.assertEqual(self.frame(data, in_waiting), [binascii.unhexlify(PACKET_52), binascii.unhexlify(PACKET_50), binascii.unhexlify(PACKET_52)])
+            self.assertEqual(self.rfx.stats["discarded_bytes"], 0)
+
+    def test_bad_data(self):
+        data = b"\x00\xff\x13" + binascii.unhexlify(PACKET_52)
+        self.assertEqual(self.frame(data), [binascii.unhexlify(PACKET_52)])
+        self.assertEqual(self.rfx.stats["discarded_bytes"], 3)
+        self.assertEqual(self.rfx.stats["resync"], 1)
+
+    def test_bad_length(self):
+        # a known type with a length which is not its one
+        packet = bytearray(binascii.unhexlify(PACKET_52))
+        packet[0] = 0x0B
+        data = bytes(packet) + b"\x00" + binascii.unhexlify(PACKET_50)
+        self.assertEqual(self.frame(data), [binascii.unhexlify(PACKET_50)])
+        self.assertEqual(self.rfx.stats["discarded_bytes"], 12)
+
+    def test_truncated_packet(self):
+        # a packet which has lost its last 2 bytes swallows the beginning of the next one
+        data = binascii.unhexlify(PACKET_52)[:-2] + binascii.unhexlify(PACKET_52 + PACKET_50)
+        self.assertEqual(self.frame(data), [binascii.unhexlify(PACKET_52), binascii.unhexlify(PACKET_50)])
+        self.assertEqual(self.rfx.stats["discarded_bytes"], 9)
+
+    def test_noise_after_packet(self):
+        # a noise byte after a good packet : the packet is kept, even if an unknown type seems to start inside it
+        packet = binascii.unhexlify("0a520105210400d4470350")
+        data = packet + b"\x61" + binascii.unhexlify(PACKET_50)
+        self.assertEqual(self.frame(data), [packet, binascii.unhexlify(PACKET_50)])
+        self.assertEqual(self.rfx.stats["discarded_bytes"], 1)
+
+    def test_unknown_type_resync(self):
+        # the resynchronization inside a packet of an unknown type is done only on a fully valid packet
+        data = PACKET_5E[:-4] + binascii.unhexlify(PACKET_52 + PACKET_50)
+        self.assertEqual(self.frame(data), [binascii.unhexlify(PACKET_52), binascii.unhexlify(PACKET_50)])
+        self.assertEqual(self.rfx.stats["discarded_bytes"], 9)
+
+    def test_unknown_types(self):
+        data = binascii.unhexlify(PACKET_52) + PACKET_21 + PACKET_5E + binascii.unhexlify(PACKET_52)
+        self.assertEqual(self.frame(data), [binascii.unhexlify(PACKET_52), PACKET_21, PACKET_5E, binascii.unhexlify(PACKET_52)])
+        self.assertEqual(self.rfx.stats["discarded_bytes"], 0)
+        self.assertEqual(self.rfx.stats["resync"], 0)
+
+    def test_unknown_types_processed(self):
+        data = PACKET_21 + PACKET_5E + PACKET_21
+        self.frame(data, process = True)
+        self.assertEqual(self.rfx.stats["packets"], 3)
+        self.assertEqual(self.rfx.stats["unknown"], {0x21 : 2, 0x5E : 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
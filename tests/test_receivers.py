@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Tests of the additional receivers : receive only RFXCOM, merge of the copies of a packet heard by several
+    receivers (best rssi kept) and coverage of each receiver
+
+    Usage : python -m unittest discover -s tests (or pytest tests)
+"""
+
+import binascii
+import logging
+import threading
+import unittest
+
+from benchmark import MemorySerial, COMMAND_11, PACKET_52
+from domogik_packages.plugin_rfxcom.lib.rfxcom import Rfxcom, RfxcomException, ReceiverMerger
+
+
+class ReceiveOnlyTest(unittest.TestCase):
+
+    def setUp(self):
+        # the stop event is set before the creation : a write thread would end at once
+        self.stop = threading.Event()
+        self.stop.set()
+        self.threads = []
+        self.messages = []
+
+    def create(self, **kwargs):
+        rfx = Rfxcom(logging.getLogger("rfxcom-test"), None, self.stop, "memory", lambda **kwargs : None,
+                     lambda message = None, schema = None, data = None : self.messages.append((schema, data)),
+                     self.threads.append, stats_period = 0, **kwargs)
+        rfx.rfxcom = MemorySerial(binascii.unhexlify(PACKET_52))
+        return rfx
+
+    def test_write_thread(self):
+        self.create()
+        self.assertEqual([thread.name for thread in self.threads], ["write_packets_process"])
+
+    def test_no_write_thread(self):
+        self.create(receive_only = True)
+        self.assertEqual(self.threads, [])
+
+    def test_no_command(self):
+        rfx = self.create(receive_only = True)
+        self.assertRaises(RfxcomException, rfx.write_packet, COMMAND_11.format(rfx.get_seqnbr(), 1), "c0")
+        self.assertRaises(RfxcomException, rfx.send_scene, "scene", [rfx.encode_11("0x0123456", 1, "on", 0, False, False)])
+        self.assertEqual(len(rfx.write_rfx), 0)
+
+    def test_receive(self):
+        rfx = self.create(receive_only = True)
+        rfx.read()
+        self.assertEqual(rfx.stats["packets"], 1)
+        self.assertEqual([data["type"] for (schema, data) in self.messages], ["temp", "humidity", "status", "battery", "rssi"])
+
+
+class MergerTest(unittest.TestCase):
+    """ The merger is driven by calling _merge and _flush with given times, without its thread
+    """
+
+    def setUp(self):
+        self.stop = threading.Event()
+        self.stop.set()
+        self.rfx = Rfxcom(logging.getLogger("rfxcom-test"), None, self.stop, "rfxcom0", lambda **kwargs : None, lambda **kwargs : None,
+                          lambda thread : None, stats_period = 0, receive_only = True)
+        self.processed = []
+        self.rfx.process_packet = self.processed.append
+        self.merger = ReceiverMerger(self.rfx, 0.2, 0)
+        for receiver in ("rfxcom0", "rfxcom1", "rfxcom2"):
+            self.merger.add_receiver(receiver)
+
+    def copy(self, rssi, seqnbr = 0, sensor = 0x2504):
+        """ Copy of a type 52 packet (without its length byte) heard with the given rssi (0 to 15)
+        """
+        packet = bytearray(binascii.unhexlify(PACKET_52))[1:]
+        packet[2] = seqnbr
+        packet[3:5] = bytearray([sensor >> 8, sensor & 0xFF])
+        packet[9] = rssi << 4
+        return packet
+
+    def test_best_rssi(self):
+        # each receiver has its own seqnbr : the copies are merged all the same
+        self.merger._merge("rfxcom0", self.copy(3, 10), 0)
+        self.merger._merge("rfxcom1", self.copy(9, 20), 0.05)
+        self.merger._merge("rfxcom2", self.copy(5, 30), 0.1)
+        self.merger._flush(0.15)
+        self.assertEqual(self.processed, [])
+        self.merger._flush(0.2)
+        self.assertEqual(self.processed, [self.copy(9, 20)])
+        self.assertEqual(self.merger.coverage, {"rfxcom0" : {"heard" : 1, "best" : 0, "exclusive" : 0},
+                                                "rfxcom1" : {"heard" : 1, "best" : 1, "exclusive" : 0},
+                                                "rfxcom2" : {"heard" : 1, "best" : 0, "exclusive" : 0}})
+
+    def test_first_copy_kept(self):
+        # same rssi : the first copy is kept
+        self.merger._merge("rfxcom0", self.copy(7, 1), 0)
+        self.merger._merge("rfxcom1", self.copy(7, 2), 0.01)
+        self.merger._flush(1)
+        self.assertEqual(self.processed, [self.copy(7, 1)])
+
+    def test_exclusive(self):
+        self.merger._merge("rfxcom2", self.copy(2), 0)
+        self.merger._flush(1)
+        self.assertEqual(self.processed, [self.copy(2)])
+        self.assertEqual(self.merger.coverage["rfxcom2"], {"heard" : 1, "best" : 1, "exclusive" : 1})
+
+    def test_window(self):
+        # a copy heard after the window is a new packet
+        self.merger._merge("rfxcom0", self.copy(3), 0)
+        self.merger._flush(0.2)
+        self.merger._merge("rfxcom1", self.copy(9), 0.25)
+        self.merger._flush(0.5)
+        self.assertEqual(self.processed, [self.copy(3), self.copy(9)])
+
+    def test_order(self):
+        # the packets of different sensors are processed in the order they were first heard
+        self.merger._merge("rfxcom0", self.copy(3, sensor = 1), 0)
+        self.merger._merge("rfxcom1", self.copy(4, sensor = 2), 0.05)
+        self.merger._merge("rfxcom2", self.copy(8, sensor = 1), 0.1)
+        self.merger._flush(0.21)
+        self.assertEqual(self.processed, [self.copy(8, sensor = 1)])
+        self.merger._flush(0.3)
+        self.assertEqual(self.processed, [self.copy(8, sensor = 1), self.copy(4, sensor = 2)])
+
+    def test_report(self):
+        # one rfxcom.coverage message by receiver, the coverage being counted over several packets
+        messages = []
+        self.rfx.cb_send_xpl = lambda message = None, schema = None, data = None : messages.append((schema, data))
+        self.merger._merge("rfxcom0", self.copy(3, sensor = 1), 0)
+        self.merger._merge("rfxcom1", self.copy(9, sensor = 1), 0.05)
+        self.merger._merge("rfxcom0", self.copy(4, sensor = 2), 0.1)
+        self.merger._flush(1)
+        self.merger.report()
+        self.assertEqual(messages, [("rfxcom.coverage", {"receiver" : "rfxcom0", "heard" : 2, "best" : 1, "exclusive" : 1}),
+                                    ("rfxcom.coverage", {"receiver" : "rfxcom1", "heard" : 1, "best" : 1, "exclusive" : 0}),
+                                    ("rfxcom.coverage", {"receiver" : "rfxcom2", "heard" : 0, "best" : 0, "exclusive" : 0})])
+
+
+if __name__ == "__main__":
+    unittest.main()
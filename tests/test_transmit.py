@@ -0,0 +1,369 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Tests of the transmit path : transmit window, acknowledges matching by seqnbr, retries and deadlines, order
+    of the commands (priorities, commands of a unit, coalescing, full queue)
+
+    The write thread is not used : the transmit window is processed by calling _tx_poll with a given time, and
+    the responses of the RFXCOM are given to _process_02.
+
+    Usage : python -m unittest discover -s tests (or pytest tests)
+"""
+
+import threading
+import unittest
+
+from benchmark import MemorySerial, create_rfxcom, COMMAND_11
+from domogik_packages.plugin_rfxcom.lib.rfxcom import monotonic, retry_delay, ACK_TIMEOUT, COMMAND_DEADLINE, TRANSMIT_TRIES, WAIT_BETWEEN_TRIES, WAIT_BETWEEN_TRIES_MAX
+
+
+class RecordingSerial(MemorySerial):
+    """ Serial device which keeps the written packets
+    """
+
+    def __init__(self):
+        MemorySerial.__init__(self, b"")
+        self.written = []
+
+    def write(self, data):
+        self.written.append(bytearray(data))
+
+
+class TransmitTestCase(unittest.TestCase):
+    """ Rfxcom without write thread and with a recording device
+    """
+
+    def setUp(self):
+        self.create()
+
+    def create(self, **kwargs):
+        # the stop event is set before the creation : the write thread ends at once
+        stop = threading.Event()
+        stop.set()
+        self.device = RecordingSerial()
+        kwargs.setdefault("tx_pacing", False)
+        self.rfx = create_rfxcom(stop, self.device, stats_period = 0, **kwargs)
+        self.sent = []
+        self.rfx.cb_send_xpl = lambda message = None, schema = None, data = None : self.sent.append(message if message != None else (schema, data))
+        self.now = monotonic()
+
+    def command(self, trig, **kwargs):
+        """ Queue a lighting2 command (to a different unit for each command)
+            @return : its seqnbr
+        """
+        seqnbr = self.rfx.get_seqnbr()
+        self.rfx.write_packet(COMMAND_11.format(seqnbr, int(seqnbr, 16)), trig, **kwargs)
+        return int(seqnbr, 16)
+
+    def respond(self, seqnbr, message = 0x00):
+        """ Response of the transmitter : 0x00 ACK, 0x02 NAK (retry), 0x03 NAK (no retry)
+        """
+        self.rfx._process_02(bytearray([0x02, 0x01, seqnbr, message]))
+
+    def poll(self, delay = 0):
+        """ Process the transmit window <delay> seconds after the start of the test
+        """
+        return self.rfx._tx_poll(self.now + delay)
+
+    def written(self):
+        """ seqnbrs of the written commands, then forget them
+        """
+        seqnbrs = [packet[3] for packet in self.device.written]
+        del self.device.written[:]
+        return seqnbrs
+
+
+class WindowTest(TransmitTestCase):
+
+    def test_window(self):
+        self.create(tx_window = 2)
+        for trig in ("c0", "c1", "c2"):
+            self.command(trig)
+        self.poll()
+        self.assertEqual(self.written(), [0, 1])
+        self.assertEqual(sorted(self.rfx._in_flight), [0, 1])
+        # the acknowledges are matched by seqnbr, in any order
+        self.respond(1)
+        self.poll()
+        self.assertEqual(self.written(), [2])
+        self.assertEqual(self.sent, ["c1"])
+        self.respond(2)
+        self.respond(0)
+        self.assertEqual(self.poll(), None)
+        self.assertEqual(self.sent, ["c1", "c2", "c0"])
+        self.assertEqual(self.rfx._in_flight, {})
+        self.assertEqual(self.rfx.stats["acknowledged"], 3)
+        self.assertEqual(self.rfx.stats["transmitted"], 3)
+
+    def test_nak(self):
+        self.command("c0")
+        self.command("c1")
+        self.poll()
+        self.assertEqual(self.written(), [0])
+        # NAK : sent again after the retry delay, before the next command
+        self.respond(0, 0x02)
+        self.poll(0.1)
+        self.assertEqual(self.written(), [])
+        self.poll(1.1)
+        self.assertEqual(self.written(), [0])
+        self.assertEqual(self.rfx.stats["retransmitted"], 1)
+        self.respond(0)
+        self.poll(1.2)
+        self.assertEqual(self.written(), [1])
+        self.assertEqual(self.sent, ["c0"])
+
+    def test_late_ack(self):
+        # an acknowledge received after a NAK, while the command waits to be sent again
+        self.command("c0")
+        self.poll()
+        self.respond(0, 0x02)
+        self.poll(0.1)
+        self.respond(0)
+        self.poll(0.2)
+        self.poll(2)
+        self.assertEqual(self.written(), [0])
+        self.assertEqual(self.sent, ["c0"])
+        self.assertEqual(self.rfx.stats["retransmitted"], 0)
+
+    def test_unknown_response(self):
+        self.command("c0")
+        self.poll()
+        self.respond(42)
+        self.poll(0.1)
+        self.assertEqual(sorted(self.rfx._in_flight), [0])
+        self.assertEqual(self.sent, [])
+
+    def test_pacing(self):
+        # the commands are not paced until the RFXCOM NAKs a command as it is transmitting : the NAKed command is
+        # then sent again at the end of the transmission of the previous ones, without backoff delay
+        self.create(tx_window = 4, tx_pacing = True)
+        for trig in ("c0", "c1", "c2"):
+            self.command(trig)
+        self.poll()
+        self.assertEqual(self.written(), [0, 1, 2])
+        self.respond(1, 0x02)
+        self.poll(0.01)
+        self.assertEqual(self.written(), [])
+        self.assertEqual(self.rfx.stats["paced"], 1)
+        # 3 commands of PACKET_AIRTIME[0x11] (0.3 second) sent, one of them NAKed
+        self.poll(0.61)
+        self.assertEqual(self.written(), [1])
+        self.assertEqual(self.rfx.stats["retransmitted"], 1)
+
+    def test_seqnbr_threads(self):
+        # commands encoded by several xPL threads at once : the seqnbrs are used in turn
+        seqnbrs = []
+        def encode():
+            for idx in range(2560):
+                seqnbrs.append(self.rfx.encode_11("0x0123456", 1, "on", 0, False, False)[3])
+        threads = [threading.Thread(None, encode, "test-encode-{0}".format(idx), (), {}) for idx in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([seqnbrs.count(seqnbr) for seqnbr in range(256)], [40] * 256)
+
+
+class RetryTest(TransmitTestCase):
+
+    def run_until_failed(self, end, step = 0.25):
+        """ Process the transmit window every <step> seconds until a command fails or <end>
+            @return : time of the failure
+        """
+        delay = 0
+        while self.rfx.stats["failed"] == 0 and delay < end:
+            self.poll(delay)
+            delay += step
+        return delay
+
+    def failures(self):
+        return [data["text"] for (schema, data) in [sent for sent in self.sent if isinstance(sent, tuple)] if schema == "log.basic"]
+
+    def test_ack_timeout(self):
+        self.command("c0")
+        failed_at = self.run_until_failed(COMMAND_DEADLINE)
+        # sent TRANSMIT_TRIES times, each time waiting ACK_TIMEOUT seconds for the acknowledge
+        self.assertTrue(failed_at >= TRANSMIT_TRIES * ACK_TIMEOUT)
+        self.assertEqual(self.written(), [0] * TRANSMIT_TRIES)
+        self.assertEqual(self.rfx.stats["retransmitted"], TRANSMIT_TRIES - 1)
+        self.assertEqual(self.rfx.stats["failed"], 1)
+        self.assertEqual(len(self.failures()), 1)
+        self.assertTrue(self.failures()[0].endswith("no acknowledge after {0} tries".format(TRANSMIT_TRIES)))
+        self.assertEqual(self.rfx._in_flight, {})
+
+    def test_deadline(self):
+        self.command("c0", deadline = 2)
+        failed_at = self.run_until_failed(COMMAND_DEADLINE)
+        self.assertTrue(2 <= failed_at <= 2.5)
+        self.assertEqual(self.written(), [0])
+        self.assertTrue(self.failures()[0].endswith("not acknowledged before its deadline"))
+
+    def test_not_sent_before_deadline(self):
+        # the window is full : the second command reaches its deadline in the queue
+        self.command("c0")
+        self.command("c1", deadline = 1)
+        self.run_until_failed(COMMAND_DEADLINE)
+        self.assertEqual(self.written(), [0])
+        self.assertTrue(self.failures()[0].endswith("not sent before its deadline"))
+        self.assertEqual(len(self.rfx.write_rfx), 0)
+
+    def test_nak_no_retry(self):
+        self.command("c0")
+        self.poll()
+        self.respond(0, 0x03)
+        self.poll(0.1)
+        self.assertEqual(self.rfx.stats["failed"], 1)
+        self.assertTrue(self.failures()[0].endswith("NAK, AC address zero in id1-id4 not allowed"))
+        self.assertEqual(self.rfx._in_flight, {})
+
+    def test_retry_delay(self):
+        for tries in range(1, 8):
+            delay = min(WAIT_BETWEEN_TRIES * 2 ** (tries - 1), WAIT_BETWEEN_TRIES_MAX)
+            for i in range(20):
+                self.assertTrue(delay / 2.0 <= retry_delay(tries) <= delay)
+
+
+class SchedulerTest(TransmitTestCase):
+
+    def lighting1(self, name, address, command):
+        self.rfx.queue_packet(self.rfx.encode_10(address, command, "arc"), name)
+
+    def lighting2(self, name, unit, command, level = 0):
+        self.rfx.queue_packet(self.rfx.encode_11("0x0123456", unit, command, level, False, False), name)
+
+    def security(self, name, command):
+        self.rfx.queue_packet(self.rfx.encode_20("0x123456", command, ""), name)
+
+    def transmit(self):
+        """ Send all the queued commands one by one, each one being acknowledged
+            @return : the commands sent (in their order) and their level (lighting2 only)
+        """
+        sent = []
+        delay = 0
+        self.poll(delay)
+        while self.device.written:
+            packet = self.device.written.pop(0)
+            sent.append(packet)
+            self.respond(packet[3])
+            delay += 0.01
+            self.poll(delay)
+        return sent
+
+    def test_unit_order(self):
+        # a set level then an off for the same unit : the off replaces the set level
+        self.lighting2("preset", 1, "preset", 50)
+        self.lighting2("off", 1, "off")
+        self.transmit()
+        self.assertEqual(self.sent, ["off"])
+        self.assertEqual(self.rfx.stats["coalesced"], 1)
+
+    def test_unit_order_not_coalesced(self):
+        # an off after a relative dim : both are sent in their order, after the commands of the other units
+        self.lighting1("dim", "a1", "dim")
+        self.lighting1("off", "a1", "off")
+        self.lighting1("on-a2", "a2", "on")
+        self.transmit()
+        self.assertEqual(self.sent, ["on-a2", "dim", "off"])
+
+    def test_unit_order_last_command(self):
+        # only the last queued command of a unit can be replaced
+        self.lighting1("on", "a1", "on")
+        self.lighting1("dim", "a1", "dim")
+        self.lighting1("off", "a1", "off")
+        self.transmit()
+        self.assertEqual(self.sent, ["on", "dim", "off"])
+        self.assertEqual(self.rfx.stats["coalesced"], 0)
+
+    def test_coalescing(self):
+        for level in (0, 25, 50, 75, 100):
+            self.lighting2("preset-{0}".format(level), 1, "preset", level)
+        self.lighting2("preset-unit2", 2, "preset", 50)
+        packets = self.transmit()
+        self.assertEqual(self.sent, ["preset-100", "preset-unit2"])
+        self.assertEqual([packet[10] for packet in packets], [15, 8])
+        self.assertEqual(self.rfx.stats["coalesced"], 4)
+
+    def test_level(self):
+        # the level is given in percent : the Lighting2 level is 0 to 15
+        levels = [self.rfx.encode_11("0x0123456", 1, "preset", level, False, False)[10] for level in (0, 3, 50, 100, 150)]
+        self.assertEqual(levels, [0, 0, 8, 15, 15])
+
+    def test_group_order(self):
+        # a group command is not replaced by the next one over a command of a unit of its address
+        self.lighting2("group_off", 0, "group_off")
+        self.lighting2("on", 1, "on")
+        self.lighting2("group_off-2", 0, "group_off")
+        self.transmit()
+        self.assertEqual(self.sent, ["group_off", "on", "group_off-2"])
+        self.assertEqual(self.rfx.stats["coalesced"], 0)
+
+    def test_group_barrier(self):
+        # the commands of the units queued before a group command are sent before it, even from a lower class, and
+        # are not replaced any more ; the commands queued after it are sent after it
+        self.lighting2("preset", 1, "preset", 50)
+        self.lighting2("on-2", 2, "on")
+        self.lighting2("group_off", 0, "group_off")
+        self.lighting2("on", 1, "on")
+        self.lighting2("off", 1, "off")
+        self.transmit()
+        self.assertEqual(self.sent, ["on-2", "preset", "group_off", "off"])
+        self.assertEqual(self.rfx.stats["coalesced"], 1)
+
+    def test_scene(self):
+        # a command of the scene replaced by a newer one is done : the scene is reported once, when the other one
+        # is acknowledged
+        self.rfx.send_scene("scene", [self.rfx.encode_11("0x0123456", unit, "on", 0, False, False) for unit in (1, 2)])
+        self.lighting2("off", 1, "off")
+        self.transmit()
+        scenes = [data for (schema, data) in self.sent[1:] if schema == "rfxcom.scene"]
+        self.assertEqual(self.sent[0], "off")
+        self.assertEqual([(data["scene"], data["commands"], data["failed"]) for data in scenes], [("scene", 2, 0)])
+        self.assertEqual(self.rfx.stats["scenes"], 1)
+
+    def test_busy_unit(self):
+        # the next command of a unit waits for the acknowledge of the previous one : the commands of the other
+        # units are sent meanwhile, from the same class or a lower one
+        self.create(tx_window = 4)
+        self.lighting2("on", 1, "on")
+        self.poll()
+        self.lighting2("off", 1, "off")
+        self.lighting2("on-2", 2, "on")
+        self.lighting2("preset-3", 3, "preset", 50)
+        self.poll(0.01)
+        self.assertEqual([(packet[8], packet[9]) for packet in self.device.written], [(1, 0x01), (2, 0x01), (3, 0x02)])
+        first = self.device.written[0][3]
+        del self.device.written[:]
+        self.respond(first)
+        self.poll(0.02)
+        self.assertEqual([(packet[8], packet[9]) for packet in self.device.written], [(1, 0x00)])
+
+    def test_priorities(self):
+        self.lighting2("preset", 1, "preset", 50)
+        self.lighting2("on", 2, "on")
+        self.security("motion", "motion")
+        self.transmit()
+        self.assertEqual(self.sent, ["motion", "on", "preset"])
+
+    def test_full_queue(self):
+        self.create(tx_queue_size = 3)
+        # the window is taken by a first command : the next ones stay in the queue
+        self.lighting2("first", 9, "on")
+        self.poll()
+        for unit in (1, 2, 3):
+            self.lighting2("preset-{0}".format(unit), unit, "preset", 50)
+        # full : a command of a higher class drops the newest command of the lowest class
+        self.lighting2("on-4", 4, "on")
+        # full : a command of the lowest class is refused
+        self.lighting2("preset-5", 5, "preset", 50)
+        self.assertEqual(len(self.rfx.write_rfx), 3)
+        self.assertEqual(self.rfx.stats["failed"], 2)
+        self.assertEqual([sent[1]["text"].endswith("transmit queue full, dropped for a command of a higher priority") for sent in self.sent], [True, False])
+        self.assertTrue(self.sent[1][1]["text"].endswith("transmit queue full"))
+        del self.sent[:]
+        self.respond(self.device.written.pop(0)[3])
+        self.transmit()
+        self.assertEqual(self.sent, ["first", "on-4", "preset-1", "preset-2"])
+
+
+if __name__ == "__main__":
+    unittest.main()